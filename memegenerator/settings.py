@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'memes.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,7 +56,7 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'memes.authentication.CachedTokenAuthentication',
      
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
@@ -135,6 +136,68 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cache alias holding the pre-rendered template list and top memes responses
+MEMES_RESPONSE_CACHE = 'default'
+# 0: every rating invalidates the cached leaderboard. N > 0: ratings leave it alone and
+# cached leaderboards expire after N seconds.
+MEMES_LEADERBOARD_MAX_STALENESS = 0
+# ?rank=bayes: averages are shrunk towards PRIOR_MEAN as if every meme had PRIOR_WEIGHT extra
+# votes at that score. Changing these takes effect after rebuild_rating_aggregates.
+MEMES_LEADERBOARD_PRIOR_MEAN = 3.0
+MEMES_LEADERBOARD_PRIOR_WEIGHT = 10
+# Days of per-day rating buckets kept for the ?window= leaderboards (compact_rating_buckets)
+MEMES_LEADERBOARD_BUCKET_DAYS = 8
+
+# GET /api/memes/feed/: per-user seen-sets hold at most MAX_IDS meme ids (8 bytes each) and
+# stay in the response cache for TTL seconds after their last update
+MEMES_FEED_SEEN_MAX_IDS = 100000
+MEMES_FEED_SEEN_TTL = 24 * 60 * 60
+
+# ?weighted=rating random picks: the in-memory alias table is rebuilt after ratings change or
+# once it is MAX_AGE seconds old, but at most once per MIN_INTERVAL seconds
+MEMES_WEIGHTED_RANDOM_MIN_INTERVAL = 10
+MEMES_WEIGHTED_RANDOM_MAX_AGE = 300
+
+# Maximum number of memes accepted by one POST /api/memes/bulk/ request
+MEMES_BULK_MAX_ITEMS = 10000
+
+# Local template image store and the number of decoded template images kept in memory per process
+MEMES_TEMPLATE_ASSET_DIR = BASE_DIR / 'template_assets'
+MEMES_TEMPLATE_IMAGE_CACHE_SIZE = 32
+# Fetch template images from loopback and private network addresses too (development only)
+MEMES_TEMPLATE_ALLOW_PRIVATE_URLS = False
+
+# Server-side meme rendering cache (GET /api/memes/<id>/image/)
+MEMES_RENDER_CACHE_DIR = BASE_DIR / 'render_cache'
+MEMES_RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Per-process cache of authenticated API tokens: maximum entries and seconds an entry is trusted
+# (also how long another process may keep accepting a token after it is deleted)
+MEMES_AUTH_CACHE_SIZE = 10000
+MEMES_AUTH_CACHE_TTL = 60
+
+# Meme view counters are buffered per process and written once the oldest buffered view is
+# FLUSH_INTERVAL seconds old or MAX_PENDING views are buffered. A process killed without a
+# graceful shutdown loses at most MAX_PENDING views.
+MEMES_VIEW_COUNT_FLUSH_INTERVAL = 10
+MEMES_VIEW_COUNT_MAX_PENDING = 10000
+
+# Admin changelists of unfiltered tables larger than this many rows show PostgreSQL's row
+# estimate instead of running COUNT(*)
+MEMES_ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Upper bounds (seconds) of the request latency histogram buckets exported at /metrics
+MEMES_METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
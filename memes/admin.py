@@ -1,6 +1,81 @@
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from . import ratings
 from .models import MemeTemplate, Meme, Rating
 
-admin.site.register(MemeTemplate)
-admin.site.register(Meme)
-admin.site.register(Rating)
+
+# Changelist paginator that reads the planner's row estimate (pg_class.reltuples) instead of
+# running COUNT(*) over an unfiltered table once it is larger than
+# MEMES_ADMIN_ESTIMATED_COUNT_THRESHOLD rows. Filtered changelists and other databases count.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = self._estimated_count()
+            if estimate is not None and estimate >= settings.MEMES_ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+    def _estimated_count(self):
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [self.object_list.model._meta.db_table])
+            row = cursor.fetchone()
+        # -1 until the table is first vacuumed or analyzed
+        return int(row[0]) if row and row[0] >= 0 else None
+
+
+@admin.register(MemeTemplate)
+class MemeTemplateAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'image_url', 'image_width', 'image_height')
+    search_fields = ('name',)  # Meme.template autocomplete
+    readonly_fields = ('image_checksum', 'image_width', 'image_height')
+
+
+@admin.register(Meme)
+class MemeAdmin(admin.ModelAdmin):
+    # Rating figures are the aggregates stored on Meme: no join or GROUP BY over ratings
+    list_display = ('id', 'top_text', 'bottom_text', 'template', 'created_by', 'created_at',
+                    'rating_count', 'rating_avg', 'view_count')
+    list_select_related = ('template', 'created_by')
+    autocomplete_fields = ('template',)
+    raw_id_fields = ('created_by',)
+    readonly_fields = ('created_at', 'updated_at', 'rating_sum', 'rating_count', 'rating_avg', 'rating_bayes',
+                       'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5', 'view_count')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # Write only the edited fields, so aggregates and view counts written by other requests
+    # after the meme was loaded are not overwritten with the loaded values
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.save(update_fields=[*form.changed_data, 'updated_at'])
+        else:
+            obj.save()
+
+
+@admin.register(Rating)
+class RatingAdmin(admin.ModelAdmin):
+    list_display = ('id', 'meme', 'user', 'score', 'created_at')
+    list_select_related = ('user', 'meme__template', 'meme__created_by')  # Rendered by Meme.__str__
+    raw_id_fields = ('meme', 'user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # A rating belongs to one meme and user for good; only its score can change
+    def get_readonly_fields(self, request, obj=None):
+        return ('meme', 'user', 'created_at') if obj else ('created_at',)
+
+    # Go through memes.ratings so the meme aggregates follow (deletions are handled by
+    # Rating.delete and RatingQuerySet.delete)
+    def save_model(self, request, obj, form, change):
+        ratings.rate_meme(obj.meme_id, obj.user, obj.score)
+        if not change:
+            obj.pk = Rating.objects.values_list('pk', flat=True).get(meme_id=obj.meme_id, user_id=obj.user_id)
@@ -0,0 +1,192 @@
+# Local store of template images.
+#
+# Each MemeTemplate.image_url is downloaded once, validated, decoded and normalized (RGB,
+# fitted inside CANONICAL_SIZE) and saved as a PNG named after its sha256 checksum in
+# MEMES_TEMPLATE_ASSET_DIR. The checksum and dimensions are recorded on the template, so
+# rendering never goes back to the remote URL. Decoded images of hot templates are held in
+# a bounded in-memory LRU (MEMES_TEMPLATE_IMAGE_CACHE_SIZE images per process).
+#
+# image_url is user input: ports other than 80 and 443 and hosts resolving to loopback, private,
+# link-local or other non-public addresses are refused (unless MEMES_TEMPLATE_ALLOW_PRIVATE_URLS)
+# and redirects are not followed, so templates cannot be used to reach internal services. The
+# host is resolved once and the download connects to the address that was checked, so a DNS
+# server answering with a public address first and an internal one next cannot get around it.
+
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from .lru import BoundedLRU
+from .models import MemeTemplate
+
+
+logger = logging.getLogger(__name__)
+
+CANONICAL_SIZE = (1024, 1024)
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP'}
+FETCH_TIMEOUT = 5  # seconds
+ALLOWED_PORTS = (80, 443)
+
+_decoded = BoundedLRU(settings.MEMES_TEMPLATE_IMAGE_CACHE_SIZE)
+
+
+class AssetError(Exception):
+    pass
+
+
+def _is_public(address):
+    address = ipaddress.ip_address(address.split('%')[0])  # Drop IPv6 zone ids
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+# Refuse URLs that are not http(s), on another port than 80 or 443, or whose host resolves to a
+# non-public address. Returns the address to connect to, None when private URLs are allowed.
+def check_url(url):
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError as exc:
+        raise AssetError(f'Invalid template image URL: {exc}') from exc
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise AssetError(f'Unsupported template image URL: {url}')
+    if settings.MEMES_TEMPLATE_ALLOW_PRIVATE_URLS:
+        return None
+    if port not in ALLOWED_PORTS:
+        raise AssetError(f'Template image URL port {port} is not allowed')
+    try:
+        addresses = [sockaddr[0] for *_, sockaddr in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)]
+    except (OSError, UnicodeError) as exc:
+        raise AssetError(f'Could not resolve template image host {parts.hostname}: {exc}') from exc
+    if not addresses or not all(_is_public(address) for address in addresses):
+        raise AssetError(f'Template image host {parts.hostname} is not a public address')
+    return addresses[0]
+
+
+# Sends https requests made to an address on behalf of `hostname`: TLS (SNI and the certificate
+# check) still uses the host name of the URL
+class _PinnedHostAdapter(HTTPAdapter):
+    def __init__(self, hostname):
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.update(server_hostname=self.hostname, assert_hostname=self.hostname)
+        super().init_poolmanager(*args, **kwargs)
+
+
+# `url` with its host replaced by `address` and the Host header naming the original host
+def _pin(session, url, address):
+    parts = urlsplit(url)
+    host = f'[{address}]' if ':' in address else address
+    if parts.scheme == 'https':
+        session.mount('https://', _PinnedHostAdapter(parts.hostname))
+    netloc = f'{host}:{parts.port}' if parts.port else host
+    return parts._replace(netloc=netloc).geturl(), {'Host': parts.netloc.rpartition('@')[2]}
+
+
+# Download an image, refusing non-public hosts, redirects and bodies larger than MAX_DOWNLOAD_BYTES
+def download(url):
+    address = check_url(url)
+    try:
+        with requests.Session() as session:
+            headers = {}
+            if address is not None:
+                url, headers = _pin(session, url, address)
+            with session.get(url, headers=headers, timeout=FETCH_TIMEOUT, stream=True, allow_redirects=False) as response:
+                if response.is_redirect:
+                    raise AssetError(f"Template image URL redirects to {response.headers.get('Location')}")
+                response.raise_for_status()
+                data = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > MAX_DOWNLOAD_BYTES:
+                        raise AssetError(f'Template image is larger than {MAX_DOWNLOAD_BYTES} bytes')
+    except requests.RequestException as exc:
+        raise AssetError(f'Could not fetch template image: {exc}') from exc
+    return bytes(data)
+
+
+# Validate and decode raw image bytes, returning (png bytes, width, height) in canonical form
+def normalize(data):
+    try:
+        with Image.open(io.BytesIO(data)) as probe:
+            if probe.format not in ALLOWED_FORMATS:
+                raise AssetError(f'Unsupported template image format: {probe.format}')
+            probe.verify()
+        image = Image.open(io.BytesIO(data))
+        image.seek(0)  # First frame of animated images
+        image = image.convert('RGB')
+    except (OSError, SyntaxError, Image.DecompressionBombError) as exc:
+        raise AssetError(f'Invalid template image: {exc}') from exc
+
+    image.thumbnail(CANONICAL_SIZE, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue(), image.width, image.height
+
+
+def asset_path(checksum):
+    return os.path.join(settings.MEMES_TEMPLATE_ASSET_DIR, f'{checksum}.png')
+
+
+# Fetch, normalize and store the image of a template, recording checksum and dimensions
+def ingest_template(template, force=False):
+    if template.image_checksum and not force and os.path.exists(asset_path(template.image_checksum)):
+        return template
+
+    png, width, height = normalize(download(template.image_url))
+    checksum = hashlib.sha256(png).hexdigest()
+
+    path = asset_path(checksum)
+    if not os.path.exists(path):
+        os.makedirs(settings.MEMES_TEMPLATE_ASSET_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=settings.MEMES_TEMPLATE_ASSET_DIR, prefix='.')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(png)
+        os.replace(tmp_path, path)
+
+    # Unless image_url was changed in the meantime (the new image is ingested after that change)
+    MemeTemplate.objects.filter(pk=template.pk, image_url=template.image_url).update(
+        image_checksum=checksum, image_width=width, image_height=height
+    )
+    template.image_checksum, template.image_width, template.image_height = checksum, width, height
+    return template
+
+
+# Ingest a freshly created template (or a new image_url), logging instead of failing the request
+def ingest_template_quietly(template_id):
+    template = MemeTemplate.objects.filter(pk=template_id).first()
+    if template is None:
+        return
+    try:
+        ingest_template(template)
+    except (AssetError, OSError) as exc:
+        logger.warning('Could not ingest image of template %s: %s', template_id, exc)
+
+
+# Decoded canonical image of a template; callers must copy() it before drawing on it
+def load_image(template):
+    if template.image_checksum:
+        image = _decoded.get(template.image_checksum)
+        if image is not None:
+            return image
+    if not template.image_checksum or not os.path.exists(asset_path(template.image_checksum)):
+        ingest_template(template, force=True)
+
+    with Image.open(asset_path(template.image_checksum)) as stored:
+        image = stored.convert('RGB')
+    _decoded.put(template.image_checksum, image)
+    return image
@@ -0,0 +1,145 @@
+# Async-native versions of the hot read endpoints, mounted under /api/async/.
+#
+# Under an ASGI server these run on the event loop and query through Django's async ORM instead
+# of holding a worker thread for the whole request. They return the same bodies as the DRF
+# views under /api/ (and share their response cache and querysets), take the same ?fields=,
+# ?expand= and ?pagination=cursor parameters and answer conditional requests the same way;
+# writes stay on the sync DRF views. Serializers only read loaded fields here (expanded
+# relations are joined by fieldsets.apply, others are rendered as ids), so they never touch the
+# database from the event loop; counting a view may flush the view counters, so it runs in a
+# worker thread.
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import caching, conditional, counters, fieldsets, leaderboard, pagination, sampling
+from .models import Meme, MemeTemplate
+from .serializers import MemeSerializer, MemeTemplateSerializer
+from .views import meme_list_queryset, meme_validators, top_rated_payload
+
+
+def _json(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def _not_found(detail):
+    return JsonResponse({'detail': detail}, status=404)
+
+
+async def _template_version(expand):
+    return await caching.aget_version(caching.TEMPLATES) if 'template' in expand else None
+
+
+# GET /api/async/templates/ - List all meme templates (same cached body as /api/templates/)
+@require_GET
+async def template_list(request):
+    etag, last_modified = conditional.version_validators(await caching.aget_version(caching.TEMPLATES), 'templates', 'json')
+    response = conditional.not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    async def build():
+        return MemeTemplateSerializer([template async for template in MemeTemplate.objects.all()], many=True).data
+
+    body = await caching.acached_json(caching.TEMPLATES, 'list', build)
+    return conditional.set_validators(HttpResponse(body, content_type='application/json'), etag, last_modified)
+
+
+# GET /api/async/memes/ - List memes, page-number paginated like /api/memes/
+# GET /api/async/memes/?pagination=cursor - Keyset pagination on (created_at, id), no total count
+@require_GET
+async def meme_list(request):
+    try:
+        fields, expand = fieldsets.parse(request.GET)
+    except fieldsets.FieldsetError as exc:
+        return _json({"error": str(exc)}, status=400)
+    url = request.build_absolute_uri()
+
+    if pagination.wants_cursor(request):
+        try:
+            position = pagination.cursor_position(request)
+        except pagination.CursorError as exc:
+            return _not_found(str(exc))
+        queryset = meme_list_queryset(fields, expand, pagination.CreatedAtCursorPagination.ordering)
+        memes, next_position, previous_position = await pagination.akeyset_page(
+            queryset, position, pagination.CreatedAtCursorPagination.page_size)
+        etag, _ = meme_validators(request, expand, memes, await _template_version(expand), None)
+        body = {
+            'next': pagination.cursor_link(url, next_position),
+            'previous': pagination.cursor_link(url, previous_position),
+        }
+    else:
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            return _not_found('Invalid page.')
+        count = await Meme.objects.acount()
+        if page < 1 or (page - 1) * page_size >= max(count, 1):
+            return _not_found('Invalid page.')
+
+        offset = (page - 1) * page_size
+        memes = [meme async for meme in meme_list_queryset(fields, expand)[offset:offset + page_size]]
+        etag, _ = meme_validators(request, expand, memes, await _template_version(expand), count)
+        body = {
+            'count': count,
+            'next': replace_query_param(url, 'page', page + 1) if offset + page_size < count else None,
+            'previous': None if page == 1 else (
+                remove_query_param(url, 'page') if page == 2 else replace_query_param(url, 'page', page - 1)),
+        }
+
+    # Pages only get an ETag, as on /api/memes/
+    response = conditional.not_modified(request, etag)
+    if response is not None:
+        return response
+    body['results'] = MemeSerializer(memes, many=True, fields=fields, expand=expand).data
+    return conditional.set_validators(_json(body), etag)
+
+
+# GET /api/async/memes/<id>/ - Retrieve a specific meme (?fields= and ?expand= as on /api/memes/<id>/)
+@require_GET
+async def meme_detail(request, pk):
+    try:
+        fields, expand = fieldsets.parse(request.GET)
+    except fieldsets.FieldsetError as exc:
+        return _json({"error": str(exc)}, status=400)
+    try:
+        meme = await fieldsets.apply(Meme.objects.all(), fields, expand, ('updated_at',)).aget(pk=pk)
+    except Meme.DoesNotExist:
+        return _not_found('No Meme matches the given query.')
+    await sync_to_async(counters.record_view)(meme.pk)
+    etag, last_modified = meme_validators(request, expand, [meme], await _template_version(expand))
+    response = conditional.not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+    return conditional.set_validators(_json(MemeSerializer(meme, fields=fields, expand=expand).data), etag, last_modified)
+
+
+# GET /api/async/memes/random/ - Get a random meme
+@require_GET
+async def random_meme(request):
+    meme = await sampling.arandom_meme()
+    if meme is None:
+        return _json({"error": "No memes found"}, status=404)
+    await sync_to_async(counters.record_view)(meme.pk)
+    return _json(MemeSerializer(meme).data)
+
+
+# GET /api/async/memes/top/ - Get top 10 rated memes (same cached body as /api/memes/top/)
+@require_GET
+async def top_rated_memes(request):
+    try:
+        window, rank = leaderboard.parse(request.GET)
+    except leaderboard.LeaderboardError as exc:
+        return _json({"error": str(exc)}, status=400)
+
+    async def build():
+        return top_rated_payload(await leaderboard.atop_memes(window, rank))
+
+    body = await caching.acached_json(caching.LEADERBOARD, leaderboard.cache_key(window, rank), build,
+                                      timeout=caching.leaderboard_timeout())
+    return HttpResponse(body, content_type='application/json')
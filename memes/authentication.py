@@ -0,0 +1,85 @@
+# Token authentication with an in-process cache of token key -> (user, token).
+#
+# DRF's TokenAuthentication runs a Token + User join on every authenticated request. Successful
+# lookups are kept in a bounded LRU (MEMES_AUTH_CACHE_SIZE entries) for up to MEMES_AUTH_CACHE_TTL
+# seconds. Saving or deleting a Token or a User (including deactivating it) drops the affected
+# entries in this process right away; other processes pick the change up when their entries
+# expire, so the TTL bounds how long a revoked token can keep working there. Cached keys are
+# indexed by user id, so invalidating a user does not scan the cache.
+
+import copy
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+from .lru import BoundedLRU
+
+
+_tokens = BoundedLRU(settings.MEMES_AUTH_CACHE_SIZE, ttl=settings.MEMES_AUTH_CACHE_TTL)
+# user id -> keys of its tokens cached in _tokens (or since evicted from it)
+_user_keys = {}
+_user_keys_lock = threading.Lock()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        cached = _tokens.get(key)
+        if cached is None:
+            # Failed lookups raise here and are never cached
+            cached = super().authenticate_credentials(key)
+            _tokens.put(key, cached)
+            _remember(cached[0].pk, key)
+        # Each request gets its own copies, so nothing set on request.user leaks into the cache
+        user, token = cached
+        return copy.copy(user), copy.copy(token)
+
+
+def _remember(user_id, key):
+    with _user_keys_lock:
+        _user_keys.setdefault(user_id, set()).add(key)
+        # Forget evicted keys once there are twice as many users as cache entries; afterwards
+        # at most as many are left, so this runs at most once per MEMES_AUTH_CACHE_SIZE lookups
+        if len(_user_keys) > 2 * _tokens.maxsize:
+            for other_id, keys in list(_user_keys.items()):
+                keys.intersection_update([cached_key for cached_key in keys if cached_key in _tokens])
+                if not keys:
+                    del _user_keys[other_id]
+
+
+def _invalidate(discard):
+    discard()
+    # Again after commit: a request may have cached the old rows in between
+    transaction.on_commit(discard)
+
+
+def invalidate_token(key):
+    _invalidate(lambda: _tokens.pop(key))
+
+
+def invalidate_user(user_id):
+    def discard():
+        with _user_keys_lock:
+            keys = _user_keys.pop(user_id, ())
+        for key in keys:
+            _tokens.pop(key)
+    _invalidate(discard)
+
+
+def clear():
+    _tokens.clear()
+    with _user_keys_lock:
+        _user_keys.clear()
+
+
+def stats():
+    lookups = _tokens.hits + _tokens.misses
+    return {
+        'hits': _tokens.hits,
+        'misses': _tokens.misses,
+        'hit_rate': _tokens.hits / lookups if lookups else None,
+        'entries': len(_tokens),
+        'max_entries': _tokens.maxsize,
+        'ttl': _tokens.ttl,
+    }
@@ -0,0 +1,171 @@
+# Replay a weighted request mix against the API, in process or over HTTP.
+#
+# A mix is a JSONL file with one request per line:
+#   {"name": "retrieve", "method": "GET", "path": "/api/memes/{meme}/", "weight": 30}
+#   {"name": "rate", "method": "POST", "path": "/api/memes/{meme}/rate/", "body": {"rating": "{score}"}, "auth": true}
+# A schedule of requests is drawn from the mix by weight with a fixed seed, and {meme},
+# {template}, {user} and {score} are filled with random existing ids (or a 1-5 score), so the
+# same seed on the same dataset replays the same requests. Requests with "auth" send the token
+# of a random user. Workers take requests from the schedule until it is exhausted.
+
+import json
+import random
+import threading
+import time
+from pathlib import Path
+
+import requests
+from django.db import connections
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .loadgen import LoadResult
+from .models import Meme, MemeTemplate
+
+
+DEFAULT_MIX = Path(__file__).with_name('bench_mix.jsonl')
+MAX_TOKENS = 10000
+
+
+def load_mix(path):
+    mix = []
+    with open(path) as lines:
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'path' not in entry:
+                raise ValueError(f'{path}:{line_number}: missing "path"')
+            entry.setdefault('method', 'GET')
+            entry.setdefault('name', f'{entry["method"]} {entry["path"]}')
+            entry.setdefault('weight', 1)
+            mix.append(entry)
+    return mix
+
+
+class Placeholders:
+    def __init__(self, rng):
+        self.rng = rng
+        # Ordered, so the same seed draws the same schedule from the same data
+        self.memes = list(Meme.objects.order_by('pk').values_list('pk', flat=True))
+        self.templates = list(MemeTemplate.objects.order_by('pk').values_list('pk', flat=True))
+        self.tokens = list(Token.objects.order_by('key').values_list('key', 'user_id')[:MAX_TOKENS])
+
+    def value(self, name):
+        if name == 'score':
+            return self.rng.randint(1, 5)
+        if name == 'user':
+            return self.rng.choice(self.tokens)[1]
+        return self.rng.choice({'meme': self.memes, 'template': self.templates}[name])
+
+    # Fill the placeholders of a path or body; a string that is only a placeholder becomes the value
+    def fill(self, value):
+        if isinstance(value, dict):
+            return {key: self.fill(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.fill(item) for item in value]
+        if not isinstance(value, str) or '{' not in value:
+            return value
+        if value.startswith('{') and value.endswith('}') and value[1:-1] in ('meme', 'template', 'user', 'score'):
+            return self.value(value[1:-1])
+        return value.format_map({name: self.value(name) for name in ('meme', 'template', 'user', 'score')
+                                 if f'{{{name}}}' in value})
+
+
+# Draw `count` concrete requests (name, method, path, body, token) from the mix
+def build_schedule(mix, count, seed=0):
+    rng = random.Random(seed)
+    placeholders = Placeholders(rng)
+    schedule = []
+    for entry in rng.choices(mix, weights=[entry['weight'] for entry in mix], k=count):
+        token = rng.choice(placeholders.tokens)[0] if entry.get('auth') and placeholders.tokens else None
+        schedule.append((entry['name'], entry['method'].upper(), placeholders.fill(entry['path']),
+                         placeholders.fill(entry.get('body')), token))
+    return schedule
+
+
+# Requests through Django's test client: the full middleware and view stack, no network
+class InProcessClient:
+    def __init__(self, host='localhost'):
+        # Server errors come back as 500 responses instead of exceptions, like over HTTP
+        self.client = APIClient(SERVER_NAME=host, raise_request_exception=False)
+
+    def send(self, method, path, body, token):
+        headers = {'HTTP_AUTHORIZATION': f'Token {token}'} if token else {}
+        response = self.client.generic(method, path, json.dumps(body) if body is not None else '',
+                                       content_type='application/json', **headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def send(self, method, path, body, token):
+        headers = {'Authorization': f'Token {token}'} if token else {}
+        return self.session.request(method, self.base_url + path, json=body, headers=headers).status_code
+
+    def close(self):
+        self.session.close()
+
+
+# Run the schedule with `concurrency` threads, each with its own client from make_client()
+# (with a concurrency of 1, in the calling thread). Returns (wall seconds, {name: LoadResult}).
+def run_schedule(schedule, concurrency, make_client):
+    pending = iter(schedule)
+    lock = threading.Lock()
+    outcomes = []
+
+    def worker():
+        client = make_client()
+        observed = []
+        try:
+            while True:
+                with lock:
+                    request = next(pending, None)
+                if request is None:
+                    break
+                name, method, path, body, token = request
+                start = time.perf_counter()
+                try:
+                    ok = client.send(method, path, body, token) < 400
+                except requests.RequestException:
+                    ok = False
+                observed.append((name, time.perf_counter() - start, ok))
+        finally:
+            client.close()
+            with lock:
+                outcomes.extend(observed)
+
+    def threaded_worker():
+        try:
+            worker()
+        finally:
+            # Database connections opened by in-process requests belong to this thread
+            connections.close_all()
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=threaded_worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - start
+
+    results = {}
+    for name, latency, ok in outcomes:
+        result = results.setdefault(name, LoadResult(name, wall))
+        if ok:
+            result.latencies.append(latency)
+        else:
+            result.errors += 1
+    return wall, results
@@ -0,0 +1,75 @@
+# Bulk meme creation. A batch is validated item by item with one prefetch of the templates and
+# users it references, then the valid memes are inserted with chunked bulk_create calls inside
+# a single transaction. Invalid items are reported without aborting the rest of the batch.
+
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import Meme, MemeTemplate
+from . import search
+from .parsers import InvalidLine
+from .serializers import BulkMemeItemSerializer, meme_texts
+
+
+BULK_CHUNK_SIZE = 1000
+
+
+def _does_not_exist(pk):
+    return [f'Invalid pk "{pk}" - object does not exist.']
+
+
+# Create memes from a list of item dicts. Returns one result per item, in order:
+# {'index': i, 'id': <meme id>} or {'index': i, 'errors': {...}}.
+def create_memes(items, user=None):
+    results = [None] * len(items)
+    validated = []
+    for index, item in enumerate(items):
+        if isinstance(item, InvalidLine):
+            results[index] = {'index': index, 'errors': {'non_field_errors': [item.message]}}
+            continue
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'errors': {'non_field_errors': ['Expected an object.']}}
+            continue
+        serializer = BulkMemeItemSerializer(data=item)
+        if serializer.is_valid():
+            validated.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'errors': serializer.errors}
+
+    # One query for all templates and one for all users referenced by the batch
+    templates = MemeTemplate.objects.in_bulk({data['template'] for _, data in validated})
+    user_ids = set(
+        User.objects.filter(pk__in={data['created_by'] for _, data in validated if 'created_by' in data})
+        .values_list('pk', flat=True)
+    )
+    default_user_id = user.pk if user is not None and user.is_authenticated else None
+
+    memes, meme_indexes = [], []
+    for index, data in validated:
+        errors = {}
+        template = templates.get(data['template'])
+        if template is None:
+            errors['template'] = _does_not_exist(data['template'])
+        created_by_id = data.get('created_by', default_user_id)
+        if created_by_id is None:
+            errors['created_by'] = ['This field is required.']
+        elif created_by_id not in user_ids and created_by_id != default_user_id:
+            errors['created_by'] = _does_not_exist(created_by_id)
+        if errors:
+            results[index] = {'index': index, 'errors': errors}
+            continue
+
+        top_text, bottom_text = meme_texts(template, data)
+        memes.append(Meme(template=template, top_text=top_text, bottom_text=bottom_text, created_by_id=created_by_id))
+        meme_indexes.append(index)
+
+    with transaction.atomic():
+        for start in range(0, len(memes), BULK_CHUNK_SIZE):
+            Meme.objects.bulk_create(memes[start:start + BULK_CHUNK_SIZE])
+        transaction.on_commit(partial(search.index_memes, memes))  # bulk_create sends no post_save
+
+    for index, meme in zip(meme_indexes, memes):
+        results[index] = {'index': index, 'id': meme.pk}
+    return results
@@ -0,0 +1,119 @@
+# Versioned response cache for endpoints that are read far more often than they change
+# (template list, top memes leaderboard).
+#
+# Each namespace has a version number stored in the cache (MEMES_RESPONSE_CACHE alias, LocMem
+# by default, any Django backend works). Cached bodies are stored under the current version
+# as rendered JSON bytes and served as-is. Writers bump the version, which orphans every body
+# cached for the old one. Versions start from the current time in milliseconds so a version
+# lost with an evicted or restarted cache never collides with an older one.
+
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+
+TEMPLATES = 'templates'
+LEADERBOARD = 'leaderboard'
+
+
+def _cache():
+    return caches[settings.MEMES_RESPONSE_CACHE]
+
+
+def _version_key(namespace):
+    return f'memes:version:{namespace}'
+
+
+def get_version(namespace):
+    cache = _cache()
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        cache.add(_version_key(namespace), int(time.time() * 1000), None)
+        version = cache.get(_version_key(namespace))
+    return version
+
+
+async def aget_version(namespace):
+    cache = _cache()
+    version = await cache.aget(_version_key(namespace))
+    if version is None:
+        await cache.aadd(_version_key(namespace), int(time.time() * 1000), None)
+        version = await cache.aget(_version_key(namespace))
+    return version
+
+
+def bump_version(namespace):
+    cache = _cache()
+    current = cache.get(_version_key(namespace)) or 0
+    cache.set(_version_key(namespace), max(int(time.time() * 1000), current + 1), None)
+
+
+# Bump now, and again once the surrounding transaction commits: a body rebuilt from the
+# not yet committed state between the two bumps is discarded by the second one
+def invalidate(namespace):
+    bump_version(namespace)
+    transaction.on_commit(lambda: bump_version(namespace))
+
+
+# Ratings changed: invalidate the leaderboard, unless it is allowed to be stale for up to
+# MEMES_LEADERBOARD_MAX_STALENESS seconds, in which case cached entries simply expire
+def ratings_changed():
+    if not settings.MEMES_LEADERBOARD_MAX_STALENESS:
+        invalidate(LEADERBOARD)
+
+
+def leaderboard_timeout():
+    return settings.MEMES_LEADERBOARD_MAX_STALENESS or None
+
+
+# Rendered JSON body for `key` in `namespace`, built with build() on a miss
+def cached_json(namespace, key, build, timeout=None):
+    cache = _cache()
+    cache_key = f'memes:response:{namespace}:{get_version(namespace)}:{key}'
+    body = cache.get(cache_key)
+    if body is None:
+        body = JSONRenderer().render(build())
+        cache.set(cache_key, body, timeout)
+    return body
+
+
+# Async cached_json for async views: build is a coroutine function. Bodies are shared with
+# cached_json under the same namespace and key.
+async def acached_json(namespace, key, build, timeout=None):
+    cache = _cache()
+    cache_key = f'memes:response:{namespace}:{await aget_version(namespace)}:{key}'
+    body = await cache.aget(cache_key)
+    if body is None:
+        body = JSONRenderer().render(await build())
+        await cache.aset(cache_key, body, timeout)
+    return body
+
+
+# Response for a pre-rendered JSON body. JSON clients get the bytes untouched; other
+# renderers (e.g. the browsable API) and response.data decode the body on demand.
+class PrerenderedResponse(Response):
+    def __init__(self, body, status=None, headers=None):
+        self.body = body
+        super().__init__(None, status=status, headers=headers)
+
+    @property
+    def data(self):
+        if self._data is None and self.body is not None:
+            self._data = json.loads(self.body)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def rendered_content(self):
+        if self.accepted_renderer.format != 'json':
+            return super().rendered_content
+        self['Content-Type'] = self.accepted_media_type
+        return self.body
@@ -0,0 +1,41 @@
+# HTTP conditional requests: ETag / Last-Modified validators and 304 Not Modified responses.
+#
+# Validators are computed from data that is cheap to get before (or instead of) serializing a
+# body: the updated_at of a meme, the rows of a list page, or the response cache version of a
+# namespace. Clients repeating a request with If-None-Match / If-Modified-Since then get a
+# 304 without a body.
+
+import hashlib
+from datetime import datetime, timezone
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+# Strong ETag of everything a representation depends on
+def make_etag(*parts):
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+
+# 304 (or 412) response when the request's preconditions say the client copy is current,
+# else None. last_modified is a datetime.
+def not_modified(request, etag=None, last_modified=None):
+    timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+# Validators of a response built from a versioned cache namespace (memes.caching): versions
+# are millisecond timestamps of the last change, so they double as Last-Modified
+def version_validators(version, *parts):
+    return make_etag(version, *parts), datetime.fromtimestamp(version / 1000, tz=timezone.utc)
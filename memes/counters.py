@@ -0,0 +1,113 @@
+# Write-behind meme view counters.
+#
+# Counting a view must not cost a database write per request, so views are added up in memory
+# per process and written in one batched statement (UPDATE ... FROM (VALUES ...)) by the first
+# view recorded after the oldest buffered one is MEMES_VIEW_COUNT_FLUSH_INTERVAL seconds old,
+# or as soon as MEMES_VIEW_COUNT_MAX_PENDING views are buffered. The buffer is also flushed at
+# interpreter exit (graceful worker shutdown).
+#
+# Loss bound: a process that dies without a graceful shutdown loses the views it has not written
+# yet, which are never more than MEMES_VIEW_COUNT_MAX_PENDING. Views recorded while the
+# database is unavailable are kept for the next flush up to the same bound; beyond it they
+# are dropped and logged.
+
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from .models import Meme
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_CHUNK_SIZE = 1000
+
+_lock = threading.Lock()
+_pending = Counter()  # meme id -> views not written yet
+_pending_total = 0
+_oldest_pending = None  # time.monotonic() of the oldest buffered view
+
+
+_ADD_VIEWS = """
+WITH delta (meme_id, views) AS (VALUES {values})
+UPDATE {table} SET view_count = view_count + delta.views
+FROM delta
+WHERE {table}.id = delta.meme_id
+"""
+
+
+def record_view(meme_id):
+    global _pending_total, _oldest_pending
+    with _lock:
+        if not _pending_total:
+            _oldest_pending = time.monotonic()
+        _pending[meme_id] += 1
+        _pending_total += 1
+        due = (_pending_total >= settings.MEMES_VIEW_COUNT_MAX_PENDING
+               or time.monotonic() - _oldest_pending >= settings.MEMES_VIEW_COUNT_FLUSH_INTERVAL)
+    if due:
+        flush()
+
+
+def _take():
+    global _pending, _pending_total, _oldest_pending
+    with _lock:
+        taken, _pending = _pending, Counter()
+        _pending_total, _oldest_pending = 0, None
+    return taken
+
+
+# Write the buffered views and return how many were written. updated_at is left alone: it is
+# the meme's ETag / Last-Modified, and a view must not make cached copies of the meme stale
+# (their view_count may lag like any buffered count).
+def flush():
+    views = _take()
+    if not views:
+        return 0
+    # In id order, the order memes.ratings locks memes in, so concurrent writers cannot deadlock
+    items = sorted(views.items())
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(items), FLUSH_CHUNK_SIZE):
+                chunk = items[start:start + FLUSH_CHUNK_SIZE]
+                values = ', '.join(['(%s, %s)'] * len(chunk))
+                params = [param for item in chunk for param in item]
+                cursor.execute(_ADD_VIEWS.format(values=values, table=Meme._meta.db_table), params)
+    except DatabaseError:
+        _requeue(views)
+        logger.exception('Could not write %d meme views', sum(views.values()))
+        return 0
+    return sum(views.values())
+
+
+def _requeue(views):
+    global _pending_total, _oldest_pending
+    total = sum(views.values())
+    with _lock:
+        if _pending_total + total > settings.MEMES_VIEW_COUNT_MAX_PENDING:
+            logger.error('Dropping %d meme views: the view buffer is full', total)
+            return
+        _pending.update(views)
+        _pending_total += total
+        if _oldest_pending is None:
+            _oldest_pending = time.monotonic()
+
+
+# Forget the buffered views without writing them (tests)
+def discard():
+    _take()
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception('Could not flush meme views at exit')
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,152 @@
+# Personalized feed of the memes a user has not rated yet (GET /api/memes/feed/).
+#
+# Each user has a seen-set: the sorted ids of the memes they rated, packed as 8-byte integers
+# and stored in the response cache (MEMES_RESPONSE_CACHE). It is built from the user's ratings
+# on a miss and updated in place after every rating. A user's seen-set holds at most
+# MEMES_FEED_SEEN_MAX_IDS ids (8 bytes each, 800 KB at the default 100,000); beyond that the
+# most recently created memes are kept, since the feed serves newest first.
+#
+# Pages walk memes by keyset (newest first, or most rated first with ?order=popular) and drop
+# candidates found in the seen-set with a binary search, so no query joins the ratings table.
+# The seen-set is only a filter hint: memes that pass it are checked against the user's ratings
+# with one (meme, user) index lookup per batch of candidates, so a stale or truncated seen-set
+# never lets a rated meme through.
+
+import base64
+import binascii
+from array import array
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .models import Meme, Rating
+
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_SCANNED = 5000  # Candidates read per request before returning a short page
+ORDERS = {
+    'new': ('-pk',),
+    'popular': ('-rating_count', '-pk'),  # meme_rating_count_idx
+}
+
+
+class FeedError(Exception):
+    pass
+
+
+def _cache():
+    return caches[settings.MEMES_RESPONSE_CACHE]
+
+
+def _key(user_id):
+    return f'memes:feed:seen:{user_id}'
+
+
+def _pack(ids):
+    return array('q', ids).tobytes()
+
+
+def _unpack(data):
+    ids = array('q')
+    ids.frombytes(data)
+    return ids
+
+
+# Sorted ids of the memes `user_id` rated (at most MEMES_FEED_SEEN_MAX_IDS, the largest)
+def seen_ids(user_id):
+    data = _cache().get(_key(user_id))
+    if data is not None:
+        return _unpack(data)
+    # Index range scan of the user's ratings
+    ids = list(Rating.objects.filter(user_id=user_id).order_by('-meme_id')
+               .values_list('meme_id', flat=True)[:settings.MEMES_FEED_SEEN_MAX_IDS])
+    ids.reverse()
+    _cache().set(_key(user_id), _pack(ids), settings.MEMES_FEED_SEEN_TTL)
+    return array('q', ids)
+
+
+# Add newly rated memes to a cached seen-set (a missing one is built on the next read)
+def mark_seen(user_id, meme_ids):
+    data = _cache().get(_key(user_id))
+    if data is None:
+        return
+    ids = _unpack(data)
+    for meme_id in meme_ids:
+        index = bisect_left(ids, meme_id)
+        if index == len(ids) or ids[index] != meme_id:
+            insort(ids, meme_id)
+    del ids[:max(len(ids) - settings.MEMES_FEED_SEEN_MAX_IDS, 0)]
+    _cache().set(_key(user_id), ids.tobytes(), settings.MEMES_FEED_SEEN_TTL)
+
+
+# Drop a cached seen-set (e.g. a rating was deleted); it is rebuilt on the next read
+def forget(user_id):
+    _cache().delete(_key(user_id))
+
+
+def _contains(ids, meme_id):
+    index = bisect_left(ids, meme_id)
+    return index < len(ids) and ids[index] == meme_id
+
+
+def _position(order, meme):
+    return (meme.pk,) if order == 'new' else (meme.rating_count, meme.pk)
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode('.'.join(map(str, position)).encode()).decode()
+
+
+def decode_cursor(order, cursor):
+    try:
+        position = tuple(int(part) for part in base64.urlsafe_b64decode(cursor.encode()).decode().split('.'))
+    except (ValueError, binascii.Error, UnicodeError):
+        position = ()
+    if len(position) != len(ORDERS[order]):
+        raise FeedError('Invalid cursor')
+    return position
+
+
+# Memes after `position` in feed order
+def _candidates(order, position):
+    memes = Meme.objects.order_by(*ORDERS[order])
+    if position is None:
+        return memes
+    if order == 'new':
+        return memes.filter(pk__lt=position[0])
+    rating_count, pk = position
+    # The redundant rating_count bound starts the index scan at the position
+    return memes.filter(Q(rating_count__lt=rating_count) | Q(rating_count=rating_count, pk__lt=pk),
+                        rating_count__lte=rating_count)
+
+
+# One page of the memes `user` has not rated: (memes, position to continue from or None when
+# the feed is exhausted). Reads candidates in growing batches; after MAX_SCANNED candidates the
+# page is returned short, with a position to continue from.
+def feed_page(user, order='new', position=None, page_size=PAGE_SIZE):
+    seen = seen_ids(user.pk)
+    memes, scanned, batch = [], 0, page_size * 2
+    while scanned < MAX_SCANNED:
+        limit = min(batch, MAX_SCANNED - scanned)
+        candidates = list(_candidates(order, position)[:limit])
+        scanned += len(candidates)
+        exhausted = len(candidates) < limit
+
+        unseen = [meme for meme in candidates if not _contains(seen, meme.pk)]
+        if unseen:
+            rated = set(Rating.objects.filter(user=user, meme_id__in=[meme.pk for meme in unseen])
+                        .values_list('meme_id', flat=True))
+            unseen = [meme for meme in unseen if meme.pk not in rated]
+
+        needed = page_size - len(memes)
+        memes += unseen[:needed]
+        if len(unseen) >= needed:
+            return memes, None if exhausted and len(unseen) == needed else _position(order, memes[-1])
+        if exhausted:
+            return memes, None
+        position = _position(order, candidates[-1])
+        batch *= 2
+    return memes, position
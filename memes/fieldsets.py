@@ -0,0 +1,60 @@
+# Sparse fieldsets (?fields=id,top_text) and inline related objects (?expand=template,created_by)
+# for meme responses.
+#
+# The requested fields decide what is read from the database, not just what is rendered:
+# the queryset is narrowed with only(), and expanded relations are joined with select_related()
+# and narrowed to the columns their nested serializers render, so a page of memes with their
+# templates and authors is still a single query.
+
+from .models import RATING_HISTOGRAM_FIELDS, Meme
+from .serializers import EXPANDABLE_MEME_FIELDS, MemeSerializer
+
+
+# Rendered fields read from other model fields than their own name
+_SOURCES = {
+    'rating_histogram': RATING_HISTOGRAM_FIELDS,
+}
+
+
+class FieldsetError(Exception):
+    pass
+
+
+def _names(value):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+# Parse ?fields= and ?expand= into (fields or None for all, expanded relations)
+def parse(query_params):
+    fields = None
+    if 'fields' in query_params:
+        fields = _names(query_params['fields'])
+        unknown = sorted(set(fields) - set(MemeSerializer.Meta.fields))
+        if unknown or not fields:
+            raise FieldsetError(f"Unknown fields: {', '.join(unknown)}" if unknown else "fields must not be empty")
+
+    expand = _names(query_params.get('expand', ''))
+    unknown = sorted(set(expand) - set(EXPANDABLE_MEME_FIELDS))
+    if unknown:
+        raise FieldsetError(f"Cannot expand: {', '.join(unknown)}")
+    # Expanding a field that is not returned has no effect
+    expand = [name for name in expand if fields is None or name in fields]
+    return fields, expand
+
+
+# Narrow a meme queryset to the columns needed to render `fields` with `expand`, plus `extra`
+# model fields the caller reads itself (e.g. the cursor pagination ordering)
+def apply(queryset, fields, expand, extra=()):
+    if expand:
+        queryset = queryset.select_related(*expand)
+    if fields is None and not expand:
+        return queryset
+
+    model_fields = {field.name for field in Meme._meta.concrete_fields}
+    names = []
+    for name in fields or MemeSerializer.Meta.fields:
+        names += _SOURCES.get(name, [name] if name in model_fields else [])
+    for relation in expand:
+        names += [f'{relation}__{name}' for name in EXPANDABLE_MEME_FIELDS[relation].Meta.fields]
+    return queryset.only(*names, *extra)
+
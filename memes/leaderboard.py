@@ -0,0 +1,177 @@
+# Top memes leaderboards: GET /api/memes/top/?window=day|week|all&rank=bayes|avg|count.
+#
+# All-time leaderboards read the aggregates stored on Meme through their descending indexes
+# (one index range scan of 10 rows). Windowed leaderboards read the MemeRatingWindow totals
+# of the window the same way. memes.ratings adds every rating change to the per-day
+# MemeRatingBucket rows and to the totals of the windows holding its day; once the UTC day
+# changes, the first read of a window sums its totals again from the buckets of the days it
+# now covers.
+
+import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast, TruncDate
+from django.utils import timezone
+
+from .models import Meme, MemeRatingBucket, MemeRatingWindow, Rating, RatingWindow
+from .ratings import bucket_day
+
+
+LIMIT = 10
+WINDOWS = {'day': 1, 'week': 7, 'all': None}  # Window length in days
+RANKS = ('bayes', 'avg', 'count')
+
+# All-time leaderboards: (filter on rated memes, order of the matching Meme index)
+_ALL_TIME = {
+    'avg': ({'rating_avg__isnull': False}, '-rating_avg'),
+    'bayes': ({'rating_bayes__isnull': False}, '-rating_bayes'),
+    'count': ({'rating_count__gt': 0}, '-rating_count'),
+}
+
+# Windowed leaderboards: (filter on rated memes, order of the matching MemeRatingWindow index)
+_WINDOWED = {
+    'avg': ({'rating_avg__isnull': False}, ('-rating_avg', '-rating_count', 'meme')),
+    'bayes': ({'rating_bayes__isnull': False}, ('-rating_bayes', '-rating_count', 'meme')),
+    'count': ({'rating_count__gt': 0}, ('-rating_count', 'meme')),
+}
+
+
+class LeaderboardError(Exception):
+    pass
+
+
+# Parse ?window= and ?rank=, returning (window, rank)
+def parse(query_params):
+    window = query_params.get('window', 'all')
+    rank = query_params.get('rank', 'avg')
+    if window not in WINDOWS:
+        raise LeaderboardError(f"window must be one of {', '.join(WINDOWS)}")
+    if rank not in RANKS:
+        raise LeaderboardError(f"rank must be one of {', '.join(RANKS)}")
+    return window, rank
+
+
+def cache_key(window, rank):
+    return f'top:{window}:{rank}'
+
+
+# First bucket day of a window of `days` days (the current UTC day counts as the first day)
+def window_start(days):
+    return bucket_day(timezone.now()) - datetime.timedelta(days=days - 1)
+
+
+# Bayesian average of `total` over `count` votes, as an expression
+def bayes_expression(total, count):
+    prior_weight = settings.MEMES_LEADERBOARD_PRIOR_WEIGHT
+    return ((Value(float(settings.MEMES_LEADERBOARD_PRIOR_MEAN * prior_weight)) + Cast(total, FloatField()))
+            / (Value(float(prior_weight)) + count))
+
+
+# Totals of a window summed from the buckets from `start` on
+_REBUILD_WINDOW = """
+INSERT INTO {table} (window_id, meme_id, rating_sum, rating_count, rating_avg, rating_bayes)
+SELECT %s, meme_id, SUM(rating_sum), SUM(rating_count),
+       CAST(SUM(rating_sum) AS DOUBLE PRECISION) / SUM(rating_count),
+       (CAST(%s AS DOUBLE PRECISION) + SUM(rating_sum)) / (CAST(%s AS DOUBLE PRECISION) + SUM(rating_count))
+FROM {buckets}
+WHERE day >= %s
+GROUP BY meme_id
+HAVING SUM(rating_count) > 0
+"""
+
+
+# Sum the totals of `window` again from the buckets unless they already start at `start`
+def refresh_window(window, start):
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Rating writes wait for the rebuild, and the buckets of those before it are committed
+            cursor.execute(f'LOCK TABLE {MemeRatingWindow._meta.db_table} IN EXCLUSIVE MODE')
+        if RatingWindow.objects.filter(name=window, start=start).exists():
+            return
+        MemeRatingWindow.objects.filter(window=window).delete()
+        RatingWindow.objects.update_or_create(name=window, defaults={'start': start})
+        prior_weight = settings.MEMES_LEADERBOARD_PRIOR_WEIGHT
+        cursor.execute(
+            _REBUILD_WINDOW.format(table=MemeRatingWindow._meta.db_table, buckets=MemeRatingBucket._meta.db_table),
+            [window, settings.MEMES_LEADERBOARD_PRIOR_MEAN * prior_weight, prior_weight, start],
+        )
+
+
+# Memes rated within the window, best first. Totals summed from another start day match no row.
+def _window_rows(window, rank, start):
+    rated, order = _WINDOWED[rank]
+    return (MemeRatingWindow.objects.filter(window=window, window__start=start, **rated)
+            .order_by(*order).values_list('meme', flat=True)[:LIMIT])
+
+
+# Top memes of a leaderboard, best first
+def top_memes(window='all', rank='avg'):
+    if WINDOWS[window] is None:
+        rated, order = _ALL_TIME[rank]
+        return list(Meme.objects.filter(**rated).order_by(order)[:LIMIT])
+    start = window_start(WINDOWS[window])
+    meme_ids = list(_window_rows(window, rank, start))
+    if not meme_ids:
+        # Nothing rated within the window, or its totals are from a previous day
+        refresh_window(window, start)
+        meme_ids = list(_window_rows(window, rank, start))
+    memes = Meme.objects.in_bulk(meme_ids)
+    return [memes[meme_id] for meme_id in meme_ids if meme_id in memes]
+
+
+async def atop_memes(window='all', rank='avg'):
+    if WINDOWS[window] is None:
+        rated, order = _ALL_TIME[rank]
+        return [meme async for meme in Meme.objects.filter(**rated).order_by(order)[:LIMIT]]
+    start = window_start(WINDOWS[window])
+    meme_ids = [meme_id async for meme_id in _window_rows(window, rank, start)]
+    if not meme_ids:
+        await sync_to_async(refresh_window)(window, start)
+        meme_ids = [meme_id async for meme_id in _window_rows(window, rank, start)]
+    memes = await Meme.objects.ain_bulk(meme_ids)
+    return [memes[meme_id] for meme_id in meme_ids if meme_id in memes]
+
+
+# Recompute rating_bayes of every meme and window total from its stored sum and count (after
+# the prior changed). Returns the number of memes.
+def rebuild_bayes():
+    bayes = Case(When(rating_count__gt=0, then=bayes_expression('rating_sum', F('rating_count'))), default=None)
+    MemeRatingWindow.objects.update(rating_bayes=bayes)
+    return Meme.objects.update(rating_bayes=bayes)
+
+
+# Replace the buckets of the retained days with totals grouped from the ratings table, and the
+# window totals with sums of the new buckets
+def rebuild_buckets():
+    start = window_start(settings.MEMES_LEADERBOARD_BUCKET_DAYS)
+    days = (Rating.objects.annotate(day=TruncDate('created_at', tzinfo=datetime.timezone.utc))
+            .filter(day__gte=start).order_by().values('meme', 'day')
+            .annotate(total=Sum('score'), count=Count('id')))
+    with transaction.atomic():
+        MemeRatingWindow.objects.all().delete()
+        RatingWindow.objects.all().delete()
+        MemeRatingBucket.objects.all().delete()
+        buckets = MemeRatingBucket.objects.bulk_create(
+            [MemeRatingBucket(meme_id=row['meme'], day=row['day'], rating_sum=row['total'],
+                              rating_count=row['count']) for row in days.iterator()],
+            batch_size=1000,
+        )
+        for window, days in WINDOWS.items():
+            if days is not None:
+                refresh_window(window, window_start(days))
+    return len(buckets)
+
+
+# Delete buckets that fell out of the retained days, emptied buckets (all their ratings were
+# deleted) and buckets of deleted memes, and likewise emptied and orphaned window totals.
+# Returns the number of buckets deleted.
+def compact_buckets():
+    start = window_start(settings.MEMES_LEADERBOARD_BUCKET_DAYS)
+    MemeRatingWindow.objects.filter(Q(rating_count=0) | ~Q(meme__in=Meme.objects.values('pk'))).delete()
+    deleted, _ = MemeRatingBucket.objects.filter(
+        Q(day__lt=start) | Q(rating_count=0) | ~Q(meme__in=Meme.objects.values('pk'))
+    ).delete()
+    return deleted
@@ -0,0 +1,96 @@
+# Minimal asyncio HTTP/1.1 load generator for comparing endpoints at high concurrency.
+#
+# Each worker holds one keep-alive connection and sends GET requests back to back for the
+# duration of the run, so `concurrency` is the number of requests in flight. Only plain
+# http:// URLs with Content-Length bodies are supported, which is what Django serves for the
+# endpoints under test.
+
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+class LoadResult:
+    def __init__(self, path, duration):
+        self.path = path
+        self.duration = duration
+        self.latencies = []  # seconds, successful requests only
+        self.errors = 0
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / self.duration
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'requests_per_second': self.throughput,
+            'p50_ms': (self.percentile(0.5) or 0) * 1000,
+            'p95_ms': (self.percentile(0.95) or 0) * 1000,
+            'p99_ms': (self.percentile(0.99) or 0) * 1000,
+        }
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed by server')
+    status = int(status_line.split()[1])
+    length, close = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            close = True
+    await reader.readexactly(length)
+    return status, close
+
+
+async def _worker(host, port, request, deadline, result):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request)
+            status, close = await _read_response(reader)
+            if status < 400:
+                result.latencies.append(time.perf_counter() - start)
+            else:
+                result.errors += 1
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            result.errors += 1
+            close = True
+        if close and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+# Hammer base_url + path with `concurrency` connections for `duration` seconds
+async def run_load(base_url, path, concurrency, duration, headers=None):
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    lines = [f'GET {url.path.rstrip("/")}{path} HTTP/1.1', f'Host: {url.netloc}', 'Connection: keep-alive']
+    lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    result = LoadResult(path, duration)
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(_worker(host, port, request, deadline, result) for _ in range(concurrency)))
+    return result
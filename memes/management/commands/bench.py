@@ -0,0 +1,65 @@
+# Replay a weighted request mix (JSONL, see memes/benchmark.py) and report throughput and
+# p50/p95/p99 latency per endpoint. In process by default, or against a running server:
+#   python manage.py bench --requests 5000 --concurrency 16 --output before.json
+#   python manage.py bench --url http://127.0.0.1:8000 --mix my_mix.jsonl --output after.json
+
+import json
+from datetime import datetime, timezone
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from memes.benchmark import DEFAULT_MIX, HTTPClient, InProcessClient, build_schedule, load_mix, run_schedule
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the API with a replayed request mix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mix', default=str(DEFAULT_MIX), help='JSONL request mix')
+        parser.add_argument('--requests', type=int, default=2000, help='Number of requests to send')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the request schedule')
+        parser.add_argument('--url', help='Base URL of a running server (default: in process)')
+        parser.add_argument('--host', default='localhost', help='Host header of in-process requests')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            mix = load_mix(options['mix'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Cannot read request mix: {exc}')
+        if not mix:
+            raise CommandError('The request mix is empty.')
+
+        schedule = build_schedule(mix, options['requests'], seed=options['seed'])
+        if options['url']:
+            make_client = partial(HTTPClient, options['url'])
+        else:
+            make_client = partial(InProcessClient, options['host'])
+        wall, results = run_schedule(schedule, options['concurrency'], make_client)
+
+        endpoints = [result.as_dict() for result in sorted(results.values(), key=lambda result: result.path)]
+        for stats in endpoints:
+            self.stdout.write(
+                f'{stats["path"]:>16}: {stats["requests"]:7d} ok {stats["errors"]:5d} errors  '
+                f'{stats["requests_per_second"]:9.1f} req/s  p50 {stats["p50_ms"]:8.2f} ms  '
+                f'p95 {stats["p95_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms'
+            )
+        self.stdout.write(f'total: {len(schedule)} requests in {wall:.2f}s, {len(schedule) / wall:.1f} req/s')
+
+        if options['output']:
+            report = {
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'target': options['url'] or 'in-process',
+                'mix': options['mix'],
+                'requests': len(schedule),
+                'concurrency': options['concurrency'],
+                'seed': options['seed'],
+                'wall_seconds': wall,
+                'requests_per_second': len(schedule) / wall,
+                'endpoints': endpoints,
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
@@ -0,0 +1,53 @@
+# Compare queries and latency per authenticated request with and without the token cache.
+#   python manage.py bench_auth --requests 1000
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from memes import authentication
+from memes.models import Meme
+from memes.seeding import seed_memes, seed_owner
+from memes.views import MemeViewSet
+
+
+class Command(BaseCommand):
+    help = 'Benchmark TokenAuthentication against memes.authentication.CachedTokenAuthentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Number of requests per authentication class')
+
+    def handle(self, *args, **options):
+        seed_memes(1)
+        user, _ = seed_owner()
+        token, _ = Token.objects.get_or_create(user=user)
+        meme = Meme.objects.order_by('pk').first()
+        factory = APIRequestFactory()
+        authentication.clear()
+
+        for auth_class in (TokenAuthentication, authentication.CachedTokenAuthentication):
+            view = MemeViewSet.as_view({'get': 'retrieve'}, authentication_classes=[auth_class])
+            timings = []
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(options['requests']):
+                    request = factory.get(f'/api/memes/{meme.pk}/', HTTP_AUTHORIZATION=f'Token {token.key}')
+                    start = time.perf_counter()
+                    response = view(request, pk=meme.pk)
+                    response.render()
+                    timings.append((time.perf_counter() - start) * 1000)
+                    if response.status_code != 200:
+                        raise CommandError(f'{auth_class.__name__}: request failed with status {response.status_code}')
+            self.stdout.write(
+                f'{auth_class.__name__:>26}: {len(queries) / options["requests"]:.2f} queries/request  '
+                f'mean {statistics.mean(timings):.3f} ms'
+            )
+
+        stats = authentication.stats()
+        self.stdout.write(f'token cache: {stats["hits"]} hits, {stats["misses"]} misses, '
+                          f'hit rate {stats["hit_rate"]:.1%}')
@@ -0,0 +1,49 @@
+# Compare random meme selection strategies on a large memes table.
+#   python manage.py bench_random --rows 1000000 --samples 200
+
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from memes.models import Meme
+from memes.sampling import random_meme
+from memes.seeding import seed_memes
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ORDER BY RANDOM() against memes.sampling.random_meme'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Seed the memes table up to this many rows')
+        parser.add_argument('--samples', type=int, default=200, help='Number of picks per strategy')
+        parser.add_argument('--gaps', type=float, default=0.1,
+                            help='Fraction of seeded memes to delete so the id space has holes')
+
+    def handle(self, *args, **options):
+        added = seed_memes(options['rows'])
+        if added and options['gaps'] > 0:
+            # Punch random holes into the freshly seeded id range
+            ids = list(Meme.objects.order_by('-pk').values_list('pk', flat=True)[:added])
+            doomed = random.sample(ids, int(len(ids) * options['gaps']))
+            for start in range(0, len(doomed), 10000):
+                Meme.objects.filter(pk__in=doomed[start:start + 10000]).delete()
+        self.stdout.write(f'memes table: {Meme.objects.count()} rows')
+
+        strategies = [
+            ('order_by(?)', lambda: Meme.objects.order_by('?').first()),
+            ('sampling.random_meme', random_meme),
+        ]
+        for name, pick in strategies:
+            timings = []
+            for _ in range(options['samples']):
+                start = time.perf_counter()
+                pick()
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f'{name:>22}: mean {statistics.mean(timings):8.2f} ms  '
+                f'p50 {timings[len(timings) // 2]:8.2f} ms  '
+                f'p99 {timings[int(len(timings) * 0.99) - 1]:8.2f} ms'
+            )
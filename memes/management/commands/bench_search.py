@@ -0,0 +1,66 @@
+# Measure caption search latency on a large memes table, per kind of query.
+#   python manage.py bench_search --rows 1000000 --queries 200 --target-ms 50
+
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from memes import search
+from memes.seeding import caption_words, random_captions, seed_memes
+
+
+class Command(BaseCommand):
+    help = 'Benchmark GET /api/memes/search/ queries against memes.search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Seed the memes table up to this many rows')
+        parser.add_argument('--words', type=int, default=20000, help='Vocabulary size of the seeded captions')
+        parser.add_argument('--queries', type=int, default=200, help='Number of queries per kind')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the captions and queries')
+        parser.add_argument('--target-ms', type=float, default=50.0, help='Fail when a p99 is above this')
+
+    def handle(self, *args, **options):
+        words = caption_words(options['words'], seed=options['seed'])
+        added = seed_memes(options['rows'], captions=random_captions(words, seed=options['seed']))
+        self.stdout.write(f'memes table: {added} rows added, searching on {connection.vendor}')
+
+        rng = random.Random(options['seed'])
+        common, rare = words[:100], words[100:]
+
+        # A rare word with its last letter replaced
+        def misspelled():
+            return rng.choice(rare)[:-1] + 'x'
+
+        kinds = [
+            ('common word', lambda: rng.choice(common)),
+            ('rare word', lambda: rng.choice(rare)),
+            ('two words', lambda: f'{rng.choice(common)} {rng.choice(words)}'),
+            ('misspelled', misspelled),
+            ('page 5', lambda: rng.choice(common)),
+        ]
+
+        # The first query builds the in-process index on databases without the GIN indexes
+        search.search_memes(words[0])
+        slow = []
+        for name, make_query in kinds:
+            page = 5 if name == 'page 5' else 1
+            timings, found = [], 0
+            for _ in range(options['queries']):
+                q = make_query()
+                start = time.perf_counter()
+                memes, _ = search.search_memes(q, page=page)
+                timings.append((time.perf_counter() - start) * 1000)
+                found += bool(memes)
+            timings.sort()
+            p99 = timings[int(len(timings) * 0.99) - 1]
+            if p99 > options['target_ms']:
+                slow.append(name)
+            self.stdout.write(
+                f'{name:>12}: p50 {timings[len(timings) // 2]:8.2f} ms  p99 {p99:8.2f} ms  '
+                f'max {timings[-1]:8.2f} ms  {found}/{len(timings)} with results'
+            )
+        if slow:
+            raise CommandError(f"p99 above {options['target_ms']} ms for: {', '.join(slow)}")
+        self.stdout.write(self.style.SUCCESS(f"Every p99 is within {options['target_ms']} ms"))
@@ -0,0 +1,18 @@
+# Delete the leaderboard buckets no windowed leaderboard reads any more: days older than
+# MEMES_LEADERBOARD_BUCKET_DAYS, buckets emptied by deleted ratings and buckets of deleted
+# memes. Run it daily (e.g. from cron).
+#   python manage.py compact_rating_buckets
+
+from django.core.management.base import BaseCommand
+
+from memes import caching, leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Delete expired, empty and orphaned leaderboard buckets'
+
+    def handle(self, *args, **options):
+        deleted = leaderboard.compact_buckets()
+        # Deleted window totals may have been on a cached windowed leaderboard
+        caching.invalidate(caching.LEADERBOARD)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} leaderboard buckets.'))
@@ -0,0 +1,31 @@
+# Download and store the images of meme templates in the local asset store.
+#   python manage.py ingest_template_assets [--force]
+
+from django.core.management.base import BaseCommand
+
+from memes.assets import AssetError, ingest_template
+from memes.models import MemeTemplate
+
+
+class Command(BaseCommand):
+    help = 'Backfill the local template image store for templates that have not been ingested'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Re-fetch every template image')
+
+    def handle(self, *args, **options):
+        templates = MemeTemplate.objects.order_by('pk')
+        if not options['force']:
+            templates = templates.filter(image_checksum='')
+
+        ingested = failed = 0
+        for template in templates.iterator():
+            try:
+                ingest_template(template, force=options['force'])
+            except (AssetError, OSError) as exc:
+                failed += 1
+                self.stderr.write(f'Template {template.pk} ({template.image_url}): {exc}')
+            else:
+                ingested += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Ingested {ingested} template images, {failed} failed.'))
@@ -0,0 +1,36 @@
+# Load test read endpoints of a running server and report throughput and latency.
+# Start the server separately, e.g. WSGI with `gunicorn memegenerator.wsgi` and ASGI with
+# `uvicorn memegenerator.asgi:application`, then compare the sync and async endpoints:
+#   python manage.py loadtest --url http://127.0.0.1:8000 --concurrency 200 --duration 10 \
+#       /api/memes/top/ /api/async/memes/top/
+
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from memes.loadgen import run_load
+
+
+class Command(BaseCommand):
+    help = 'Measure requests per second and p50/p99 latency of endpoints under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Paths to load, one after the other')
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the running server')
+        parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per path')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            result = asyncio.run(run_load(options['url'], path, options['concurrency'], options['duration']))
+            stats = result.as_dict()
+            if options['json']:
+                self.stdout.write(json.dumps(stats))
+                continue
+            self.stdout.write(
+                f'{path:>28}: {stats["requests_per_second"]:9.1f} req/s  '
+                f'p50 {stats["p50_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms  '
+                f'errors {stats["errors"]}'
+            )
@@ -0,0 +1,58 @@
+# Create many users with API tokens from a CSV (header row) or JSONL file, e.g.
+#   python manage.py provision_users users.csv --tokens-out tokens.csv
+#   python manage.py provision_users - --format jsonl < users.jsonl
+# Fields: username, email, first_name, last_name, and password (hashed in --workers processes)
+# or password_hash (stored as is) or neither (unusable password).
+
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from memes import provisioning
+
+
+class Command(BaseCommand):
+    help = 'Bulk-create users and their API tokens from a CSV or JSONL file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file of users, - for standard input')
+        parser.add_argument('--format', choices=provisioning.FORMATS,
+                            help='Input format (default: from the file extension)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Password hashing processes (default: one per CPU, 0: hash in this process)')
+        parser.add_argument('--batch-size', type=int, default=provisioning.BATCH_SIZE,
+                            help='Users inserted per transaction')
+        parser.add_argument('--tokens-out', help='Write username,token rows of the created users to this CSV file')
+
+    def handle(self, *args, **options):
+        path, fmt = options['path'], options['format']
+        if fmt is None:
+            fmt = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv' if path.endswith('.csv') else None
+        if fmt is None:
+            raise CommandError('Cannot tell the format from the file name, pass --format')
+
+        start = time.perf_counter()
+        try:
+            if path == '-':
+                records = provisioning.read_records(sys.stdin, fmt)
+            else:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    records = provisioning.read_records(stream, fmt)
+        except (OSError, provisioning.ProvisioningError) as exc:
+            raise CommandError(str(exc))
+
+        result = provisioning.provision_users(records, workers=options['workers'], batch_size=options['batch_size'])
+
+        if options['tokens_out']:
+            with open(options['tokens_out'], 'w', newline='', encoding='utf-8') as out:
+                writer = csv.writer(out)
+                writer.writerow(['username', 'token'])
+                writer.writerows(result['tokens'].items())
+        for error in result['errors']:
+            self.stderr.write(f"line {error['line']} ({error['username'] or '-'}): {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {result['created']} users with tokens in {time.perf_counter() - start:.1f}s, "
+            f"skipped {len(result['errors'])}."
+        ))
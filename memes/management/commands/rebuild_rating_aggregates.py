@@ -0,0 +1,26 @@
+# Recompute the denormalized rating aggregates stored on Meme (sum, count, averages and the
+# per-score histogram) and the per-day leaderboard buckets from the Rating table, repairing
+# any drift (e.g. rows changed outside memes.ratings). Also run after changing
+# MEMES_LEADERBOARD_PRIOR_MEAN or MEMES_LEADERBOARD_PRIOR_WEIGHT.
+#   python manage.py rebuild_rating_aggregates
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from memes import caching, leaderboard, ratings
+
+
+class Command(BaseCommand):
+    help = ('Rebuild rating_sum, rating_count, rating_avg, rating_bayes and rating_1..rating_5 on '
+            'every meme, and the leaderboard buckets, from the ratings table')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = ratings.rebuild_aggregates()
+            leaderboard.rebuild_bayes()
+            buckets = leaderboard.rebuild_buckets()
+        # Cached leaderboards (and the weighted random sampler) still hold the old numbers
+        caching.invalidate(caching.LEADERBOARD)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt rating aggregates for {updated} memes and {buckets} leaderboard buckets.'))
@@ -0,0 +1,33 @@
+# Generate a skewed synthetic dataset for load tests and benchmarks.
+#   python manage.py seed_load --users 10000 --templates 200 --memes 1000000 --ratings 5000000 --seed 1
+
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from memes.seeding import seed_load
+
+
+class Command(BaseCommand):
+    help = 'Bulk-create users with tokens, templates, memes and ratings with Zipf-distributed popularity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--templates', type=int, default=100)
+        parser.add_argument('--memes', type=int, default=100000)
+        parser.add_argument('--ratings', type=int, default=500000)
+        parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent of popularity (higher is more skewed)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed gives the same dataset')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with transaction.atomic():
+            added = seed_load(options['users'], options['templates'], options['memes'], options['ratings'],
+                              exponent=options['exponent'], seed=options['seed'])
+            call_command('rebuild_rating_aggregates', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded ' + ', '.join(f'{count} {name}' for name, count in added.items()) +
+            f' in {time.perf_counter() - start:.1f}s.'
+        ))
@@ -0,0 +1,185 @@
+# Per-route request metrics in Prometheus text format.
+#
+# MetricsMiddleware times every request and counts the database queries it runs (and their
+# time) through connection.execute_wrapper, then records them under the resolved route name
+# (meme-list, meme-get-top-rated-memes, ...). Each thread writes to its own shard of plain
+# counters, so recording takes no lock; GET /metrics merges the shards of this process.
+
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+
+from . import authentication
+
+
+LATENCY_BUCKETS = tuple(settings.MEMES_METRICS_LATENCY_BUCKETS)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _RouteStats:
+    __slots__ = ('buckets', 'duration', 'queries', 'db_time', 'response_bytes', 'statuses')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+
+
+def _shard():
+    shard = getattr(_local, 'routes', None)
+    if shard is None:
+        shard = _local.routes = {}
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def record(route, status, duration, queries, db_time, response_bytes):
+    shard = _shard()
+    stats = shard.get(route)
+    if stats is None:
+        stats = shard[route] = _RouteStats()
+    stats.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+    stats.duration += duration
+    stats.queries += queries
+    stats.db_time += db_time
+    stats.response_bytes += response_bytes
+    stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+
+# Merge all shards into {route: _RouteStats}
+def snapshot():
+    with _shards_lock:
+        shards = list(_shards)
+    merged = {}
+    for shard in shards:
+        for route, stats in list(shard.items()):
+            total = merged.get(route)
+            if total is None:
+                total = merged[route] = _RouteStats()
+            total.buckets = [a + b for a, b in zip(total.buckets, stats.buckets)]
+            total.duration += stats.duration
+            total.queries += stats.queries
+            total.db_time += stats.db_time
+            total.response_bytes += stats.response_bytes
+            for code, count in list(stats.statuses.items()):
+                total.statuses[code] = total.statuses.get(code, 0) + count
+    return merged
+
+
+def reset():
+    with _shards_lock:
+        for shard in _shards:
+            shard.clear()
+
+
+# Append one metric family; samples are (name suffix, labels, value)
+def _metric(lines, name, kind, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+
+def render():
+    routes = sorted(snapshot().items())
+    lines = []
+
+    samples = []
+    for route, stats in routes:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+            cumulative += count
+            samples.append(('_bucket', {'route': route, 'le': bound}, cumulative))
+        samples.append(('_sum', {'route': route}, stats.duration))
+        samples.append(('_count', {'route': route}, cumulative))
+    _metric(lines, 'memes_http_request_duration_seconds', 'histogram', 'Request latency by route', samples)
+
+    _metric(lines, 'memes_http_requests_total', 'counter', 'Requests by route and status code',
+            [('', {'route': route, 'status': code}, count)
+             for route, stats in routes for code, count in sorted(stats.statuses.items())])
+    _metric(lines, 'memes_db_queries_total', 'counter', 'Database queries run by requests, by route',
+            [('', {'route': route}, stats.queries) for route, stats in routes])
+    _metric(lines, 'memes_db_query_duration_seconds_total', 'counter', 'Time spent in database queries, by route',
+            [('', {'route': route}, stats.db_time) for route, stats in routes])
+    _metric(lines, 'memes_http_response_bytes_total', 'counter', 'Response body bytes by route (streamed bodies excluded)',
+            [('', {'route': route}, stats.response_bytes) for route, stats in routes])
+
+    tokens = authentication.stats()
+    _metric(lines, 'memes_token_cache_hits_total', 'counter', 'Token authentication cache hits',
+            [('', {}, tokens['hits'])])
+    _metric(lines, 'memes_token_cache_misses_total', 'counter', 'Token authentication cache misses',
+            [('', {}, tokens['misses'])])
+    return '\n'.join(lines) + '\n'
+
+
+# GET /metrics - Metrics of this process in Prometheus text format
+def metrics_view(request):
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
+# Counts and times the queries run through the connection while installed
+class _QueryTimer:
+    __slots__ = ('count', 'time')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+
+
+def _observe(request, response, duration, timer):
+    match = request.resolver_match
+    route = match.view_name if match is not None else 'unmatched'
+    size = 0 if response.streaming else len(response.content)
+    record(route, response.status_code, duration, timer.count, timer.time, size)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = _QueryTimer()
+        start = time.perf_counter()
+        # One lookup of the per-context connection: the `connection` proxy repeats it per access
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(timer):
+            response = self.get_response(request)
+        _observe(request, response, time.perf_counter() - start, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = _QueryTimer()
+        start = time.perf_counter()
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(timer):
+            response = await self.get_response(request)
+        _observe(request, response, time.perf_counter() - start, timer)
+        return response
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:28
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Avg, Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Meme = apps.get_model('memes', 'Meme')
+    Rating = apps.get_model('memes', 'Rating')
+    ratings = Rating.objects.filter(meme=OuterRef('pk')).order_by().values('meme')
+    Meme.objects.update(
+        rating_sum=Coalesce(Subquery(ratings.annotate(total=Sum('score')).values('total')), 0,
+                            output_field=IntegerField()),
+        rating_count=Coalesce(Subquery(ratings.annotate(total=Count('id')).values('total')), 0,
+                              output_field=IntegerField()),
+        rating_avg=Subquery(ratings.annotate(avg=Avg('score')).values('avg')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meme',
+            name='rating_avg',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='meme',
+            index=models.Index(fields=['-rating_avg'], name='meme_rating_avg_idx'),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
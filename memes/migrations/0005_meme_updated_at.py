@@ -0,0 +1,27 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# Existing memes were last modified when they were created
+def backfill_updated_at(apps, schema_editor):
+    Meme = apps.get_model('memes', 'Meme')
+    Meme.objects.update(updated_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0004_template_image_assets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meme',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0005_meme_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meme',
+            name='view_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:04
+
+import datetime
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+# Bayesian averages of the rated memes, and the per-day buckets of the recent ratings
+def backfill_leaderboards(apps, schema_editor):
+    Meme = apps.get_model('memes', 'Meme')
+    Rating = apps.get_model('memes', 'Rating')
+    MemeRatingBucket = apps.get_model('memes', 'MemeRatingBucket')
+
+    prior_weight = settings.MEMES_LEADERBOARD_PRIOR_WEIGHT
+    Meme.objects.filter(rating_count__gt=0).update(rating_bayes=(
+        (models.Value(float(settings.MEMES_LEADERBOARD_PRIOR_MEAN * prior_weight)) + models.F('rating_sum'))
+        / (models.Value(float(prior_weight)) + models.F('rating_count'))
+    ))
+
+    start = timezone.now().astimezone(datetime.timezone.utc).date() - datetime.timedelta(
+        days=settings.MEMES_LEADERBOARD_BUCKET_DAYS - 1)
+    days = (Rating.objects.annotate(day=TruncDate('created_at', tzinfo=datetime.timezone.utc))
+            .filter(day__gte=start).order_by().values('meme', 'day')
+            .annotate(total=models.Sum('score'), count=models.Count('id')))
+    MemeRatingBucket.objects.bulk_create(
+        (MemeRatingBucket(meme_id=row['meme'], day=row['day'], rating_sum=row['total'], rating_count=row['count'])
+         for row in days.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0006_meme_view_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemeRatingBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_bayes',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='meme',
+            index=models.Index(fields=['-rating_bayes'], name='meme_rating_bayes_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meme',
+            index=models.Index(fields=['-rating_count'], name='meme_rating_count_idx'),
+        ),
+        migrations.AddField(
+            model_name='memeratingbucket',
+            name='meme',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='rating_buckets', to='memes.meme'),
+        ),
+        migrations.AddIndex(
+            model_name='memeratingbucket',
+            index=models.Index(fields=['day', 'meme'], name='bucket_day_meme_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='memeratingbucket',
+            unique_together={('meme', 'day')},
+        ),
+        migrations.RunPython(backfill_leaderboards, migrations.RunPython.noop),
+    ]
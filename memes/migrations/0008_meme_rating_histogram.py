@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:07
+
+from django.db import migrations, models
+
+
+# Per-score counts of the rated memes, from one grouped aggregate over the ratings
+def backfill_histograms(apps, schema_editor):
+    Meme = apps.get_model('memes', 'Meme')
+    Rating = apps.get_model('memes', 'Rating')
+    counts = Rating.objects.order_by().values('meme').annotate(**{
+        f'rating_{score}': models.Count('id', filter=models.Q(score=score)) for score in range(1, 6)
+    })
+    fields = [f'rating_{score}' for score in range(1, 6)]
+    Meme.objects.bulk_update(
+        [Meme(id=row['meme'], **{name: row[name] for name in fields}) for row in counts.iterator()],
+        fields, batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0007_meme_rating_bayes_buckets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meme',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='meme',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_histograms, migrations.RunPython.noop),
+    ]
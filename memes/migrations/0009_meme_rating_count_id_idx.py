@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0008_meme_rating_histogram'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='meme',
+            name='meme_rating_count_idx',
+        ),
+        migrations.AddIndex(
+            model_name='meme',
+            index=models.Index(fields=['-rating_count', '-id'], name='meme_rating_count_idx'),
+        ),
+    ]
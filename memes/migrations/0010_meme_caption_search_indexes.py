@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:05
+
+from django.db import migrations
+
+
+# Expressions of memes.search: GIN full-text index and pg_trgm trigram index of the captions.
+# Built concurrently so existing tables stay writable. Creating the extension needs a role
+# allowed to (a superuser, or the database owner for trusted extensions on Postgres 13+);
+# where pg_trgm is not available (contrib not installed) only the full-text index is created.
+CREATE_INDEXES = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS meme_caption_search_idx ON memes_meme
+       USING gin (to_tsvector('english'::regconfig, (top_text || ' ' || bottom_text)))""",
+]
+CREATE_TRIGRAM_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS meme_caption_trgm_idx ON memes_meme
+       USING gin ((top_text || ' ' || bottom_text) gin_trgm_ops)""",
+]
+DROP_INDEXES = [
+    'DROP INDEX CONCURRENTLY IF EXISTS meme_caption_trgm_idx',
+    'DROP INDEX CONCURRENTLY IF EXISTS meme_caption_search_idx',
+]
+
+
+# Other databases search the in-process index of memes.search
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')")
+        trigrams = cursor.fetchone()[0]
+    for statement in CREATE_INDEXES + (CREATE_TRIGRAM_INDEXES if trigrams else []):
+        schema_editor.execute(statement)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in DROP_INDEXES:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+
+    dependencies = [
+        ('memes', '0009_meme_rating_count_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
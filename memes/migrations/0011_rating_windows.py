@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memes', '0010_meme_caption_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingWindow',
+            fields=[
+                ('name', models.CharField(max_length=8, primary_key=True, serialize=False)),
+                ('start', models.DateField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MemeRatingWindow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('rating_avg', models.FloatField(null=True)),
+                ('rating_bayes', models.FloatField(null=True)),
+                ('meme', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='rating_windows', to='memes.meme')),
+                ('window', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memes', to='memes.ratingwindow')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['window', '-rating_avg', '-rating_count', 'meme'], name='window_rating_avg_idx'), models.Index(fields=['window', '-rating_bayes', '-rating_count', 'meme'], name='window_rating_bayes_idx'), models.Index(fields=['window', '-rating_count', 'meme'], name='window_rating_count_idx')],
+                'unique_together': {('window', 'meme')},
+            },
+        ),
+    ]
@@ -1,10 +1,12 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from . import caching
+
 
 # Create token auth for new users
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -13,6 +15,24 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
+# Drop cached token lookups when a token or its user changes
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance=None, created=False, **kwargs):
+    if not created:
+        from .authentication import invalidate_token
+        invalidate_token(instance.key)
+
+
+# Logins save only last_login, which authentication does not depend on
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user(sender, instance=None, created=False, update_fields=None, **kwargs):
+    if not created and update_fields != {'last_login'}:
+        from .authentication import invalidate_user
+        invalidate_user(instance.pk)
+
+
 # MemeTemplate Model
 class MemeTemplate(models.Model):
     name = models.CharField(max_length=100)  
@@ -20,9 +40,21 @@ class MemeTemplate(models.Model):
     default_top_text = models.CharField(max_length=100, blank=True) 
     default_bottom_text = models.CharField(max_length=100, blank=True)  
 
+    # Locally stored copy of the image, filled in by memes.assets
+    image_checksum = models.CharField(max_length=64, blank=True)  # sha256 of the normalized PNG
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+
     def __str__(self):
         return self.name
 
+# Largest primary key (BigAutoField) and foreign key; larger ids cannot be bound to queries
+MAX_ID = 2**63 - 1
+
+# Meme columns counting the ratings of each score, from 1 to 5
+RATING_HISTOGRAM_FIELDS = ['rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']
+
+
 # Meme Model
 class Meme(models.Model):
     template = models.ForeignKey(MemeTemplate, on_delete=models.CASCADE)  
@@ -30,10 +62,51 @@ class Meme(models.Model):
     bottom_text = models.CharField(max_length=100)  
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)  
     created_at = models.DateTimeField(auto_now_add=True)  
+    updated_at = models.DateTimeField(auto_now=True)  # ETag / Last-Modified of the meme
+
+    # Denormalized rating aggregates, maintained by memes.ratings on every rating write
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_avg = models.FloatField(null=True, blank=True)  # NULL until the meme is rated
+    # Average shrunk towards MEMES_LEADERBOARD_PRIOR_MEAN by MEMES_LEADERBOARD_PRIOR_WEIGHT votes
+    rating_bayes = models.FloatField(null=True, blank=True)
+    # Number of ratings of each score (rating_histogram on the API)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+
+    # Views (retrieve/random), buffered in memory and flushed in batches by memes.counters
+    view_count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-rating_avg'], name='meme_rating_avg_idx'),  # Top rated memes
+            models.Index(fields=['-rating_bayes'], name='meme_rating_bayes_idx'),  # ?rank=bayes
+            models.Index(fields=['-rating_count', '-id'], name='meme_rating_count_idx'),  # ?rank=count, popular feed
+            models.Index(fields=['created_at', 'id'], name='meme_created_at_id_idx'),  # Cursor pagination
+        ]
 
     def __str__(self):
         return f"Meme by {self.created_by.username} using {self.template.name}"
 
+# Deleting ratings through the ORM (admin, shell) keeps the meme aggregates in step. Rating has
+# no signal receivers on purpose: they would stop Django from deleting the ratings of a deleted
+# meme or user with one DELETE (fast delete) and make it load and signal every row instead.
+class RatingQuerySet(models.QuerySet):
+    def delete(self):
+        from .feed import forget
+        from .ratings import remove_ratings
+        with transaction.atomic():
+            user_ids = set(self.order_by().values_list('user_id', flat=True).distinct())
+            remove_ratings(self)
+            deleted = super().delete()
+        for user_id in user_ids:
+            forget(user_id)
+        return deleted
+
+
 # Rating Model
 class Rating(models.Model):
     meme = models.ForeignKey(Meme, on_delete=models.CASCADE, related_name='ratings')  
@@ -41,8 +114,121 @@ class Rating(models.Model):
     score = models.IntegerField(choices=[(i, i) for i in range(1, 6)])  # Rating score (1 to 5)
     created_at = models.DateTimeField(auto_now_add=True)  
 
+    objects = RatingQuerySet.as_manager()
+
     class Meta:
         unique_together = ('meme', 'user')  # Ensure each user can only rate a meme once
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='rating_created_at_id_idx'),  # Cursor pagination
+        ]
+
+    def delete(self, *args, **kwargs):
+        from .feed import forget
+        from .ratings import apply_rating_delta, bucket_day
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            if deleted[0]:
+                apply_rating_delta(self.meme_id, bucket_day(self.created_at), None, self.score)
+        forget(self.user_id)
+        return deleted
+
+    def __str__(self):
+        return f"Rating {self.score} for meme by {self.user.username}"
+
+
+# Per-day rating totals of a meme, by the day each rating was first cast (UTC). Maintained by
+# memes.ratings next to the Meme aggregates and read by the windowed leaderboards; days older
+# than MEMES_LEADERBOARD_BUCKET_DAYS are removed by the compact_rating_buckets command.
+class MemeRatingBucket(models.Model):
+    # No database constraint: a rating written while its meme is being deleted may still touch
+    # its buckets after the cascade collected them; compaction removes such orphans
+    meme = models.ForeignKey(Meme, on_delete=models.CASCADE, related_name='rating_buckets',
+                             db_constraint=False)
+    day = models.DateField()
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('meme', 'day')
+        indexes = [
+            models.Index(fields=['day', 'meme'], name='bucket_day_meme_idx'),  # Windowed leaderboards
+        ]
+
+    def __str__(self):
+        return f"{self.rating_count} ratings of meme {self.meme_id} on {self.day}"
+
+
+# A windowed leaderboard (?window=day|week) and the first bucket day its MemeRatingWindow
+# totals were summed from. memes.leaderboard rebuilds the totals once the UTC day changes.
+class RatingWindow(models.Model):
+    name = models.CharField(max_length=8, primary_key=True)
+    start = models.DateField()
+
+    def __str__(self):
+        return f"{self.name} window from {self.start}"
+
+
+# Rating totals of a meme over the buckets of a windowed leaderboard, with its averages, kept
+# up to date by memes.ratings next to the buckets. The leaderboards read their top 10 from the
+# score indexes instead of summing the buckets of the window.
+class MemeRatingWindow(models.Model):
+    window = models.ForeignKey(RatingWindow, on_delete=models.CASCADE, related_name='memes')
+    # No database constraint, as for MemeRatingBucket
+    meme = models.ForeignKey(Meme, on_delete=models.CASCADE, related_name='rating_windows',
+                             db_constraint=False)
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_avg = models.FloatField(null=True)
+    rating_bayes = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = ('window', 'meme')
+        indexes = [
+            models.Index(fields=['window', '-rating_avg', '-rating_count', 'meme'], name='window_rating_avg_idx'),
+            models.Index(fields=['window', '-rating_bayes', '-rating_count', 'meme'], name='window_rating_bayes_idx'),
+            models.Index(fields=['window', '-rating_count', 'meme'], name='window_rating_count_idx'),
+        ]
 
     def __str__(self):
-        return f"Rating {self.score} for meme by {self.user.username}"
\ No newline at end of file
+        return f"{self.rating_count} ratings of meme {self.meme_id} in the {self.window_id} window"
+
+
+# The ratings of a deleted user are fast deleted by the cascade (see RatingQuerySet): remove them
+# from the aggregates of the memes they rated with one grouped query first, in the transaction of
+# the deletion. Deleted memes need nothing: their buckets and window totals are deleted with them.
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def remove_user_ratings_from_aggregates(sender, instance=None, **kwargs):
+    from .feed import forget
+    from .ratings import remove_ratings
+    remove_ratings(Rating.objects.filter(user=instance))
+    forget(instance.pk)
+
+
+# Drop cached template lists when templates change
+@receiver(post_save, sender=MemeTemplate)
+@receiver(post_delete, sender=MemeTemplate)
+def invalidate_template_cache(sender, **kwargs):
+    caching.invalidate(caching.TEMPLATES)
+
+
+# Drop cached leaderboards when a meme shown on them is edited or deleted
+@receiver(post_save, sender=Meme)
+@receiver(post_delete, sender=Meme)
+def invalidate_leaderboard_cache(sender, created=False, **kwargs):
+    if not created:
+        caching.invalidate(caching.LEADERBOARD)
+
+
+# Keep the in-process caption index of memes.search (databases without its GIN indexes) in
+# step with this process's writes, once they are committed
+@receiver(post_save, sender=Meme)
+def index_meme_caption(sender, instance=None, **kwargs):
+    from .search import index_memes
+    transaction.on_commit(lambda: index_memes([instance]))
+
+
+@receiver(post_delete, sender=Meme)
+def unindex_meme_caption(sender, instance=None, **kwargs):
+    from .search import unindex_meme
+    meme_id = instance.pk
+    transaction.on_commit(lambda: unindex_meme(meme_id))
@@ -0,0 +1,143 @@
+# Keyset (cursor) pagination, opted into with ?pagination=cursor.
+#
+# A cursor is the (created_at, id) of the row a page starts after (or, walking back, before).
+# Pages are read with WHERE created_at >= c AND (created_at > c OR (created_at = c AND id > i))
+# ORDER BY created_at, id LIMIT n, a range scan of the (created_at, id) index starting at the
+# cursor, so deep pages cost the same as the first one, rows sharing a created_at are neither
+# skipped nor repeated, and no COUNT(*) is issued. The next/previous links carry the cursor
+# base64 encoded.
+
+import base64
+import binascii
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class CursorError(Exception):
+    pass
+
+
+# A position is (created_at, id, reverse): the page holds the rows after it, or before it when reversed
+def encode_cursor(position):
+    created_at, pk, reverse = position
+    parts = ((created_at - EPOCH) // MICROSECOND, pk, int(reverse))
+    return base64.urlsafe_b64encode('.'.join(map(str, parts)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk, reverse = (int(part) for part in base64.urlsafe_b64decode(cursor.encode()).decode().split('.'))
+        return EPOCH + micros * MICROSECOND, pk, bool(reverse)
+    except (ValueError, OverflowError, binascii.Error, UnicodeError):
+        raise CursorError('Invalid cursor')
+
+
+# Rows of `queryset` read for the page at `position` (None for the first page): one more than
+# the page holds, to know whether another page follows
+def _keyset_rows(queryset, position, page_size):
+    if position is None:
+        return queryset.order_by('created_at', 'id')[:page_size + 1]
+    created_at, pk, reverse = position
+    # The redundant created_at bound lets the database start the index scan at the cursor: it
+    # cannot derive a range from the OR alone
+    if reverse:
+        return (queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk),
+                                created_at__lte=created_at)
+                .order_by('-created_at', '-id')[:page_size + 1])
+    return (queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk),
+                            created_at__gte=created_at)
+            .order_by('created_at', 'id')[:page_size + 1])
+
+
+# (rows in (created_at, id) order, position of the next page or None, position of the previous
+# page or None) from the rows read by _keyset_rows
+def _keyset_page(rows, position, page_size):
+    page, more = rows[:page_size], len(rows) > page_size
+    if position is not None and position[2]:
+        page.reverse()
+        return page, _after(page[-1]) if page else None, _before(page[0]) if more else None
+    return page, _after(page[-1]) if more else None, _before(page[0]) if page and position else None
+
+
+def keyset_page(queryset, position, page_size):
+    return _keyset_page(list(_keyset_rows(queryset, position, page_size)), position, page_size)
+
+
+async def akeyset_page(queryset, position, page_size):
+    return _keyset_page([row async for row in _keyset_rows(queryset, position, page_size)], position, page_size)
+
+
+# `url` pointing at the page at `position`, None when there is no such page
+def cursor_link(url, position):
+    if position is None:
+        return None
+    return replace_query_param(url, 'cursor', encode_cursor(position))
+
+
+def _after(row):
+    return row.created_at, row.pk, False
+
+
+def _before(row):
+    return row.created_at, row.pk, True
+
+
+class CreatedAtCursorPagination(BasePagination):
+    ordering = ('created_at', 'id')
+    page_size = api_settings.PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        try:
+            position = cursor_position(request)
+        except CursorError as exc:
+            raise NotFound(str(exc))
+        page, self.next_position, self.previous_position = keyset_page(queryset, position, self.page_size)
+        return page
+
+    def get_next_link(self):
+        return cursor_link(self.base_url, self.next_position)
+
+    def get_previous_link(self):
+        return cursor_link(self.base_url, self.previous_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+# True when the client asked for cursor pagination (or is following a cursor link). Takes a
+# DRF or a plain Django request.
+def wants_cursor(request):
+    return request.GET.get('pagination') == 'cursor' or 'cursor' in request.GET
+
+
+# Position of the ?cursor= of `request`, None for the first page
+def cursor_position(request):
+    cursor = request.GET.get('cursor')
+    return decode_cursor(cursor) if cursor else None
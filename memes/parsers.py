@@ -0,0 +1,36 @@
+# Request body parsers.
+
+import json
+
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+
+
+# Placeholder for an NDJSON line that is not valid JSON (or not text in the request encoding),
+# so it can be reported per item
+class InvalidLine:
+    def __init__(self, line_number, message):
+        self.line_number = line_number
+        self.message = message
+
+
+# Newline-delimited JSON: one JSON value per line, parsed into a list. Blank lines are skipped.
+class NDJSONParser(BaseParser):
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        items = []
+        for line_number, line in enumerate(stream, 1):
+            try:
+                line = line.decode(encoding).strip()
+            except UnicodeDecodeError as exc:
+                items.append(InvalidLine(line_number, f'Invalid {encoding} on line {line_number}: {exc}'))
+                continue
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as exc:
+                items.append(InvalidLine(line_number, f'Invalid JSON on line {line_number}: {exc}'))
+        return items
@@ -0,0 +1,176 @@
+# Bulk provisioning of user accounts with their API tokens.
+#
+# Creating users one by one costs a User insert, a Token insert from the post_save receiver and
+# a password hash each. Here passwords are hashed in a pool of worker processes (hashing is
+# CPU-bound and deliberately slow), and users and tokens are inserted with bulk_create in
+# chunked transactions. bulk_create sends no post_save signals, so tokens are created here.
+#
+# Each record is a dict with a username and optional email, first_name and last_name, plus one
+# of: password (plain text, hashed here), password_hash (already hashed with a configured
+# hasher, e.g. exported from another Django site) or neither (unusable password, for
+# token-only API accounts).
+
+import csv
+import json
+import multiprocessing
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.hashers import (
+    UNUSABLE_PASSWORD_PREFIX, identify_hasher, is_password_usable, make_password,
+)
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+
+FORMATS = ('csv', 'jsonl')
+FIELDS = ('username', 'email', 'first_name', 'last_name', 'password', 'password_hash')
+BATCH_SIZE = 5000
+HASH_CHUNK_SIZE = 64  # Passwords sent to a worker at a time
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+# Parse a CSV (with a header row) or JSONL file of user records into [(line number, record)].
+# Lines that cannot be parsed are returned as (line number, error message) strings.
+def read_records(stream, fmt):
+    if fmt not in FORMATS:
+        raise ProvisioningError(f"format must be one of {', '.join(FORMATS)}")
+
+    records = []
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        unknown = sorted(set(reader.fieldnames or ()) - set(FIELDS))
+        if unknown:
+            raise ProvisioningError(f"Unknown columns: {', '.join(unknown)}")
+        for record in reader:
+            records.append((reader.line_num, {key: value for key, value in record.items() if value}))
+        return records
+
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            records.append((line_number, f'Invalid JSON on line {line_number}: {exc}'))
+            continue
+        if not isinstance(record, dict):
+            records.append((line_number, 'Expected an object.'))
+            continue
+        records.append((line_number, record))
+    return records
+
+
+# Error message for a record, or None when it can be provisioned
+def _validate(record):
+    unknown = sorted(set(record) - set(FIELDS))
+    if unknown:
+        return f"Unknown fields: {', '.join(unknown)}"
+    # Before the validators below, which expect strings
+    if not all(isinstance(record.get(name, ''), str) for name in FIELDS):
+        return 'Every field must be a string.'
+    username = record.get('username')
+    if not username:
+        return 'username is required.'
+    try:
+        User.username_validator(username)
+        if len(username) > User._meta.get_field('username').max_length:
+            raise ValidationError('username is too long.')
+        if record.get('email'):
+            validate_email(record['email'])
+    except ValidationError as exc:
+        return ' '.join(exc.messages)
+    if 'password' in record and 'password_hash' in record:
+        return 'Give either password or password_hash, not both.'
+    password_hash = record.get('password_hash')
+    if password_hash and is_password_usable(password_hash):
+        try:
+            identify_hasher(password_hash)
+        except ValueError:
+            return 'password_hash was not made by a configured password hasher.'
+    return None
+
+
+# Same format as make_password(None), without its character-by-character random string
+def unusable_password():
+    return UNUSABLE_PASSWORD_PREFIX + secrets.token_hex(20)
+
+
+# Hash plain-text passwords, in `workers` processes (0: in this process), keeping their order
+def hash_passwords(passwords, workers=None):
+    if not passwords:
+        return []
+    if workers == 0:
+        return [make_password(password) for password in passwords]
+    # Spawned rather than forked: forked workers would inherit this process's database
+    # connections. Each worker sets Django up from DJANGO_SETTINGS_MODULE like this process.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=django.setup) as executor:
+        return list(executor.map(make_password, passwords, chunksize=HASH_CHUNK_SIZE))
+
+
+# Create users and their tokens from [(line number, record)] as returned by read_records.
+# Usernames that already exist (or repeat in the input) and invalid records are skipped and
+# reported. Each chunk of batch_size users is inserted in its own transaction, so an
+# interrupted run keeps the finished chunks. Returns {'created': n, 'errors': [{'line',
+# 'username', 'error'}], 'tokens': {username: token key}}.
+def provision_users(records, workers=None, batch_size=BATCH_SIZE):
+    errors, valid, seen = [], [], set()
+    for line_number, record in records:
+        error = record if isinstance(record, str) else _validate(record)
+        if error is None and record['username'] in seen:
+            error = 'Duplicate username in the input.'
+        if error is None:
+            seen.add(record['username'])
+            valid.append((line_number, record))
+        else:
+            username = None if isinstance(record, str) else record.get('username')
+            errors.append({'line': line_number, 'username': username, 'error': error})
+
+    existing = set()
+    usernames = [record['username'] for _, record in valid]
+    for start in range(0, len(usernames), batch_size):
+        existing.update(User.objects.filter(username__in=usernames[start:start + batch_size])
+                        .values_list('username', flat=True))
+    for line_number, record in valid:
+        if record['username'] in existing:
+            errors.append({'line': line_number, 'username': record['username'], 'error': 'User already exists.'})
+    valid = [(line_number, record) for line_number, record in valid if record['username'] not in existing]
+
+    # Only plain-text passwords go through the pool; the others are stored as given
+    plain = [record['password'] for _, record in valid if 'password' in record]
+    hashed = iter(hash_passwords(plain, workers))
+    users = []
+    for _, record in valid:
+        if 'password' in record:
+            password = next(hashed)
+        else:
+            password = record.get('password_hash') or unusable_password()
+        users.append(User(username=record['username'], email=record.get('email', ''),
+                          first_name=record.get('first_name', ''), last_name=record.get('last_name', ''),
+                          password=password))
+
+    tokens = {}
+    for start in range(0, len(users), batch_size):
+        chunk = users[start:start + batch_size]
+        with transaction.atomic():
+            User.objects.bulk_create(chunk)
+            if any(user.pk is None for user in chunk):
+                # Databases that cannot return the ids of bulk inserted rows
+                ids = dict(User.objects.filter(username__in=[user.username for user in chunk])
+                           .values_list('username', 'pk'))
+                for user in chunk:
+                    user.pk = ids[user.username]
+            created = Token.objects.bulk_create(Token(key=Token.generate_key(), user_id=user.pk) for user in chunk)
+        tokens.update((user.username, token.key) for user, token in zip(chunk, created))
+
+    errors.sort(key=lambda error: error['line'])
+    return {'created': len(users), 'errors': errors, 'tokens': tokens}
@@ -0,0 +1,371 @@
+# Rating write path. Every change to a Rating goes through here so the denormalized
+# aggregates stored on Meme (rating_sum, rating_count, rating_avg, rating_bayes, the per-score
+# counts rating_1..rating_5), the per-day MemeRatingBucket totals and the MemeRatingWindow
+# totals of the windowed leaderboards stay in step with the rows.
+
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import caching, feed
+from .models import RATING_HISTOGRAM_FIELDS, Meme, MemeRatingBucket, MemeRatingWindow, Rating, RatingWindow
+from .parsers import InvalidLine
+from .serializers import RatingBatchItemSerializer
+
+
+MAX_UPSERT_ATTEMPTS = 3
+
+
+class ConcurrentRatingInsert(Exception):
+    pass
+
+
+# Set-wise aggregate update: one UPDATE joined to a VALUES list of per-meme deltas. Every SET
+# expression reads the pre-update column values, so the averages use the new sum and count.
+# The histogram is part of the meme representation, so updated_at (its ETag) moves too.
+_APPLY_DELTAS = """
+WITH delta (meme_id, score_delta, count_delta, d1, d2, d3, d4, d5) AS (VALUES {values})
+UPDATE {table} SET
+    rating_1 = rating_1 + delta.d1,
+    rating_2 = rating_2 + delta.d2,
+    rating_3 = rating_3 + delta.d3,
+    rating_4 = rating_4 + delta.d4,
+    rating_5 = rating_5 + delta.d5,
+    rating_sum = rating_sum + delta.score_delta,
+    rating_count = rating_count + delta.count_delta,
+    rating_avg = CAST(rating_sum + delta.score_delta AS DOUBLE PRECISION)
+                 / NULLIF(rating_count + delta.count_delta, 0),
+    rating_bayes = CASE WHEN rating_count + delta.count_delta > 0 THEN
+                   (CAST(%s AS DOUBLE PRECISION) + rating_sum + delta.score_delta)
+                   / (CAST(%s AS DOUBLE PRECISION) + rating_count + delta.count_delta) END,
+    updated_at = %s
+FROM delta
+WHERE {table}.id = delta.meme_id
+RETURNING id
+"""
+
+# Per-day totals read by the windowed leaderboards, upserted in the same transaction
+_APPLY_BUCKET_DELTAS = """
+INSERT INTO {table} (meme_id, day, rating_sum, rating_count) VALUES {values}
+ON CONFLICT (meme_id, day) DO UPDATE SET
+    rating_sum = {table}.rating_sum + EXCLUDED.rating_sum,
+    rating_count = {table}.rating_count + EXCLUDED.rating_count
+"""
+
+# Totals of the windowed leaderboards whose window holds the changed buckets (day >= start),
+# upserted in the same transaction. Windows not built yet are skipped: memes.leaderboard sums
+# them from the buckets on first read.
+_APPLY_WINDOW_DELTAS = """
+WITH delta (meme_id, day, score_delta, count_delta) AS (VALUES {values})
+INSERT INTO {table} (window_id, meme_id, rating_sum, rating_count, rating_avg, rating_bayes)
+SELECT w.name, delta.meme_id, SUM(delta.score_delta), SUM(delta.count_delta),
+       CAST(SUM(delta.score_delta) AS DOUBLE PRECISION) / NULLIF(SUM(delta.count_delta), 0),
+       CASE WHEN SUM(delta.count_delta) > 0 THEN
+       (CAST(%s AS DOUBLE PRECISION) + SUM(delta.score_delta))
+       / (CAST(%s AS DOUBLE PRECISION) + SUM(delta.count_delta)) END
+FROM delta JOIN {windows} w ON delta.day >= w.start
+GROUP BY w.name, delta.meme_id
+ON CONFLICT (window_id, meme_id) DO UPDATE SET
+    rating_sum = {table}.rating_sum + EXCLUDED.rating_sum,
+    rating_count = {table}.rating_count + EXCLUDED.rating_count,
+    rating_avg = CAST({table}.rating_sum + EXCLUDED.rating_sum AS DOUBLE PRECISION)
+                 / NULLIF({table}.rating_count + EXCLUDED.rating_count, 0),
+    rating_bayes = CASE WHEN {table}.rating_count + EXCLUDED.rating_count > 0 THEN
+                   (CAST(%s AS DOUBLE PRECISION) + {table}.rating_sum + EXCLUDED.rating_sum)
+                   / (CAST(%s AS DOUBLE PRECISION) + {table}.rating_count + EXCLUDED.rating_count) END
+"""
+
+
+# Leaderboard bucket (UTC day) of a rating created at `created_at`
+def bucket_day(created_at):
+    if timezone.is_aware(created_at):
+        created_at = created_at.astimezone(datetime.timezone.utc)
+    return created_at.date()
+
+
+# Shift the aggregates and daily buckets of many memes ({(meme_id, day): (score_delta,
+# count_delta, histogram_delta)} as built by rating_delta, day being the bucket_day of the
+# ratings) in three statements and return the number of memes updated (memes that no longer
+# exist are skipped)
+def apply_rating_deltas(deltas):
+    if not deltas:
+        return 0
+    per_meme = defaultdict(lambda: [0] * 7)
+    for (meme_id, day), (score_delta, count_delta, histogram_delta) in deltas.items():
+        for index, delta in enumerate((score_delta, count_delta, *histogram_delta)):
+            per_meme[meme_id][index] += delta
+
+    prior_weight = settings.MEMES_LEADERBOARD_PRIOR_WEIGHT
+    prior = [settings.MEMES_LEADERBOARD_PRIOR_MEAN * prior_weight, prior_weight]
+    # Rows in meme id order, so concurrent writers (and counter flushes) lock memes in the same
+    # order and cannot deadlock each other
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(per_meme))
+    params = [param for meme_id, delta in sorted(per_meme.items()) for param in (meme_id, *delta)]
+    params += [*prior, connection.ops.adapt_datetimefield_value(timezone.now())]
+    with connection.cursor() as cursor:
+        cursor.execute(_APPLY_DELTAS.format(values=values, table=Meme._meta.db_table), params)
+        # Counted from RETURNING: drivers do not report rowcount for statements starting with WITH
+        updated = {meme_id for meme_id, in cursor.fetchall()}
+
+        # Deleted memes get no buckets (the foreign key is not enforced by the database)
+        buckets = [(meme_id, day, score_delta, count_delta)
+                   for (meme_id, day), (score_delta, count_delta, _) in sorted(deltas.items()) if meme_id in updated]
+        if buckets:
+            values = ', '.join(['(%s, %s, %s, %s)'] * len(buckets))
+            params = [param for bucket in buckets for param in bucket]
+            cursor.execute(_APPLY_BUCKET_DELTAS.format(values=values, table=MemeRatingBucket._meta.db_table),
+                           params)
+            cursor.execute(_APPLY_WINDOW_DELTAS.format(values=values, table=MemeRatingWindow._meta.db_table,
+                                                       windows=RatingWindow._meta.db_table), params + prior * 2)
+    caching.ratings_changed()
+    return len(updated)
+
+
+# Aggregate delta (score_delta, count_delta, histogram_delta) of one rating changing from
+# `previous` to `score`, either being None when there is no rating before or after
+def rating_delta(score, previous):
+    histogram = [0] * len(RATING_HISTOGRAM_FIELDS)
+    if score is not None:
+        histogram[score - 1] += 1
+    if previous is not None:
+        histogram[previous - 1] -= 1
+    count_delta = (score is not None) - (previous is not None)
+    return (score or 0) - (previous or 0), count_delta, tuple(histogram)
+
+
+def apply_rating_delta(meme_id, day, score, previous):
+    return apply_rating_deltas({(meme_id, day): rating_delta(score, previous)})
+
+
+# Aggregate deltas removing the ratings of `queryset`, read with one query grouped by meme,
+# bucket day and score instead of loading the rows
+def deleted_ratings_deltas(queryset):
+    rows = (queryset.order_by()
+            .annotate(day=TruncDate('created_at', tzinfo=datetime.timezone.utc))
+            .values_list('meme_id', 'day', 'score')
+            .annotate(ratings=Count('pk')))
+    deltas = {}
+    for meme_id, day, score, count in rows:
+        score_delta, count_delta, histogram_delta = rating_delta(None, score)
+        previous = deltas.get((meme_id, day), (0, 0, (0,) * len(RATING_HISTOGRAM_FIELDS)))
+        deltas[(meme_id, day)] = (
+            previous[0] + score_delta * count,
+            previous[1] + count_delta * count,
+            tuple(a + b * count for a, b in zip(previous[2], histogram_delta)),
+        )
+    return deltas
+
+
+# Remove the ratings of `queryset`, about to be deleted in the same transaction, from the aggregates
+def remove_ratings(queryset):
+    return apply_rating_deltas(deleted_ratings_deltas(queryset))
+
+
+# Aggregate deltas for {meme_id: (new score, previous score or None, bucket day)}
+def rating_deltas(changes):
+    return {
+        (meme_id, day): rating_delta(score, previous)
+        for meme_id, (score, previous, day) in changes.items()
+    }
+
+
+# Aggregates of every rated meme recomputed from the ratings table in one grouped aggregate
+_REBUILD_AGGREGATES = """
+WITH totals AS (
+    SELECT meme_id, SUM(score) AS total, COUNT(*) AS votes,
+           SUM(CASE WHEN score = 1 THEN 1 ELSE 0 END) AS r1,
+           SUM(CASE WHEN score = 2 THEN 1 ELSE 0 END) AS r2,
+           SUM(CASE WHEN score = 3 THEN 1 ELSE 0 END) AS r3,
+           SUM(CASE WHEN score = 4 THEN 1 ELSE 0 END) AS r4,
+           SUM(CASE WHEN score = 5 THEN 1 ELSE 0 END) AS r5
+    FROM {ratings} GROUP BY meme_id
+)
+UPDATE {table} SET
+    rating_sum = totals.total,
+    rating_count = totals.votes,
+    rating_avg = CAST(totals.total AS DOUBLE PRECISION) / totals.votes,
+    rating_1 = totals.r1,
+    rating_2 = totals.r2,
+    rating_3 = totals.r3,
+    rating_4 = totals.r4,
+    rating_5 = totals.r5
+FROM totals
+WHERE {table}.id = totals.meme_id
+"""
+
+
+# Recompute rating_sum, rating_count, rating_avg and the histogram of every meme from the
+# ratings table, repairing any drift. Returns the number of memes.
+def rebuild_aggregates():
+    with transaction.atomic():
+        updated = Meme.objects.update(
+            rating_sum=0, rating_count=0, rating_avg=None, updated_at=timezone.now(),
+            **{name: 0 for name in RATING_HISTOGRAM_FIELDS},
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(_REBUILD_AGGREGATES.format(table=Meme._meta.db_table, ratings=Rating._meta.db_table))
+    return updated
+
+
+# PostgreSQL: the first statement locks the user's existing ratings of these memes and reads
+# their scores; the second upserts the new scores. They cannot be one statement: rows locked
+# by a FOR UPDATE CTE are skipped by an ON CONFLICT DO UPDATE of the same statement.
+_LOCK_PREVIOUS_POSTGRESQL = """
+SELECT meme_id, score, created_at FROM {table}
+WHERE user_id = %s AND meme_id IN ({placeholders})
+FOR UPDATE
+"""
+
+_UPSERT_POSTGRESQL = """
+INSERT INTO {table} (meme_id, user_id, score, created_at) VALUES {values}
+ON CONFLICT (meme_id, user_id) DO UPDATE SET score = EXCLUDED.score
+RETURNING meme_id, (xmax = 0) AS inserted
+"""
+
+
+def _upsert_postgresql(cursor, user_id, scores, now):
+    table = Rating._meta.db_table
+    placeholders = ', '.join(['%s'] * len(scores))
+    cursor.execute(_LOCK_PREVIOUS_POSTGRESQL.format(table=table, placeholders=placeholders), [user_id, *scores])
+    locked = {meme_id: (score, created_at) for meme_id, score, created_at in cursor.fetchall()}
+
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(scores))
+    params = [param for meme_id, score in scores.items() for param in (meme_id, user_id, score, now)]
+    cursor.execute(_UPSERT_POSTGRESQL.format(table=table, values=values), params)
+
+    previous = {}
+    for meme_id, inserted in cursor.fetchall():
+        if not inserted and meme_id not in locked:
+            # Another transaction inserted this rating after the lock above read the ratings,
+            # so its score is unknown. Roll back and run both statements again.
+            raise ConcurrentRatingInsert(meme_id)
+        previous[meme_id] = locked.get(meme_id, (None, None))
+    return previous
+
+
+# SQLite: the first statement is a write, which takes the database write lock and serializes
+# concurrent raters before any score is read. New ratings are inserted there; existing ones
+# are read and then updated with an upsert.
+def _upsert_sqlite(cursor, user_id, scores, now):
+    table = Rating._meta.db_table
+
+    def insert(items, on_conflict):
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(items))
+        params = [param for meme_id, score in items for param in (meme_id, user_id, score, now)]
+        cursor.execute(
+            f'INSERT INTO {table} (meme_id, user_id, score, created_at) VALUES {values} '
+            f'ON CONFLICT (meme_id, user_id) {on_conflict}',
+            params,
+        )
+
+    insert(list(scores.items()), 'DO NOTHING RETURNING meme_id')
+    previous = {meme_id: (None, None) for meme_id, in cursor.fetchall()}
+
+    existing = [meme_id for meme_id in scores if meme_id not in previous]
+    if existing:
+        placeholders = ', '.join(['%s'] * len(existing))
+        cursor.execute(
+            f'SELECT meme_id, score, created_at FROM {table} WHERE user_id = %s AND meme_id IN ({placeholders})',
+            [user_id, *existing],
+        )
+        previous.update((meme_id, (score, created_at)) for meme_id, score, created_at in cursor.fetchall())
+        insert([(meme_id, scores[meme_id]) for meme_id in existing],
+               'DO UPDATE SET score = excluded.score')
+    return previous
+
+
+# Insert or update the ratings of one user ({meme_id: score}) and return {meme_id: (previous
+# score, previous created_at)}, both None for a new rating. Must run inside a transaction; retries when a concurrent first rating of
+# the same meme by the same user slips in between.
+def upsert_ratings(user_id, scores, now=None):
+    now = connection.ops.adapt_datetimefield_value(now or timezone.now())
+    upsert = _upsert_postgresql if connection.vendor == 'postgresql' else _upsert_sqlite
+    for attempt in range(1, MAX_UPSERT_ATTEMPTS + 1):
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                return upsert(cursor, user_id, scores, now)
+        except ConcurrentRatingInsert:
+            if attempt == MAX_UPSERT_ATTEMPTS:
+                raise
+
+
+# created_at as read by a raw cursor (SQLite returns text for expressions it cannot type)
+def _parse_created_at(value):
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+# Create or update the rating of a user for a meme and update the meme aggregates atomically,
+# without loading the meme first. Raises Meme.DoesNotExist when there is no such meme.
+def rate_meme(meme_id, user, score):
+    rate_memes(user, {meme_id: score})
+
+
+# Create or update the ratings of a user for many memes ({meme_id: score}) in one transaction:
+# one upsert statement for the ratings and one set-wise update of the meme aggregates.
+# Returns {meme_id: previous score or None}. Raises Meme.DoesNotExist (rolling everything
+# back) when one of the memes does not exist.
+def rate_memes(user, scores):
+    now = timezone.now()
+    with transaction.atomic():
+        previous = upsert_ratings(user.pk, scores, now)
+        changes = {}
+        for meme_id, score in scores.items():
+            previous_score, created_at = previous[meme_id]
+            changes[meme_id] = (score, previous_score, bucket_day(_parse_created_at(created_at) or now))
+        if apply_rating_deltas(rating_deltas(changes)) != len(scores):
+            raise Meme.DoesNotExist('Some of the rated memes do not exist')
+        meme_ids = list(scores)
+        transaction.on_commit(lambda: feed.mark_seen(user.pk, meme_ids))
+    return {meme_id: previous_score for meme_id, (previous_score, _) in previous.items()}
+
+
+# Rate many memes for one user from a list of {'meme': id, 'rating': score} items. Items are
+# validated one by one and checked against a single lookup of the referenced memes; the
+# valid ones are written with rate_memes. When a meme appears more than once the last item
+# wins. Returns one result per item, in order.
+def rate_batch(user, items):
+    results = [None] * len(items)
+    validated = []
+    for index, item in enumerate(items):
+        if isinstance(item, InvalidLine):
+            results[index] = {'index': index, 'errors': {'non_field_errors': [item.message]}}
+            continue
+        serializer = RatingBatchItemSerializer(data=item) if isinstance(item, dict) else None
+        if serializer is None:
+            results[index] = {'index': index, 'errors': {'non_field_errors': ['Expected an object.']}}
+        elif serializer.is_valid():
+            validated.append((index, serializer.validated_data['meme'], serializer.validated_data['rating']))
+        else:
+            results[index] = {'index': index, 'errors': serializer.errors}
+
+    existing = set(Meme.objects.filter(pk__in={meme_id for _, meme_id, _ in validated}).values_list('pk', flat=True))
+    scores, last_index = {}, {}
+    for index, meme_id, score in validated:
+        if meme_id not in existing:
+            results[index] = {'index': index, 'errors': {'meme': [f'Invalid pk "{meme_id}" - object does not exist.']}}
+            continue
+        if meme_id in last_index:
+            superseded = last_index[meme_id]
+            results[superseded] = {'index': superseded, 'meme': meme_id, 'status': 'superseded'}
+        scores[meme_id] = score
+        last_index[meme_id] = index
+
+    previous = rate_memes(user, scores) if scores else {}
+    for meme_id, index in last_index.items():
+        results[index] = {
+            'index': index,
+            'meme': meme_id,
+            'rating': scores[meme_id],
+            'status': 'created' if previous[meme_id] is None else 'updated',
+        }
+    return results
@@ -0,0 +1,197 @@
+# Server-side meme rendering: draws top_text/bottom_text onto the template image.
+#
+# Template images come from the local asset store (memes.assets). Rendered images are kept in
+# an on-disk cache whose keys hash everything the output depends on (template image checksum,
+# texts, width, format), so a repeat request is a file send with no re-render. The cache is
+# bounded in bytes and evicts the least recently used files first.
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont
+
+from . import assets
+
+
+FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+MAX_WIDTH = 2048
+
+
+class RenderError(Exception):
+    pass
+
+
+# Key of a rendered image: changes whenever any input of the render changes
+def render_key(image_checksum, top_text, bottom_text, width, fmt):
+    digest = hashlib.sha256(image_checksum.encode())
+    for part in (top_text, bottom_text, str(width or ''), fmt):
+        digest.update(b'\0' + part.encode())
+    return digest.hexdigest()
+
+
+# Split text into lines that fit within max_width pixels
+def _wrap(draw, text, font, max_width):
+    lines, line = [], ''
+    for word in text.split():
+        candidate = f'{line} {word}'.strip()
+        if line and draw.textlength(candidate, font=font) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _draw_caption(draw, image, text, font, at_top):
+    margin = max(image.height // 40, 4)
+    stroke = max(font.size // 15, 1)
+    lines = _wrap(draw, text.upper(), font, image.width - 2 * margin)
+    line_height = font.size + stroke * 2
+    y = margin if at_top else image.height - margin - line_height * len(lines)
+    for line in lines:
+        x = (image.width - draw.textlength(line, font=font)) / 2
+        draw.text((x, y), line, font=font, fill='white', stroke_width=stroke, stroke_fill='black')
+        y += line_height
+
+
+# Composite the captions onto a decoded RGB template image and encode the result.
+# The template image itself is left untouched.
+def render_meme(template_image, top_text, bottom_text, width=None, fmt='png'):
+    if width and width != template_image.width:
+        height = max(round(template_image.height * width / template_image.width), 1)
+        image = template_image.resize((width, height), Image.LANCZOS)
+    else:
+        image = template_image.copy()
+
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=max(image.height // 9, 12))
+    _draw_caption(draw, image, top_text, font, at_top=True)
+    _draw_caption(draw, image, bottom_text, font, at_top=False)
+
+    output = io.BytesIO()
+    image.save(output, FORMATS[fmt][0])
+    return output.getvalue()
+
+
+# Size-bounded on-disk LRU cache of rendered images. Recency is the file mtime, which hits
+# refresh, so the order survives restarts; each process keeps its own index of the directory.
+class RenderCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = None  # OrderedDict of file name -> size, least recently used first
+        self._size = 0
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        self._size = sum(self._entries.values())
+
+    # Return the path of a cached render, or None on a miss
+    def get(self, name):
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted (possibly by another process)
+                self._size -= self._entries.pop(name, 0)
+                self.misses += 1
+                return None
+            if name not in self._entries:
+                self._entries[name] = os.path.getsize(path)
+                self._size += self._entries[name]
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return path
+
+    # Store a render and evict the least recently used files beyond max_bytes
+    def put(self, name, data):
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            # Write to a temporary file first so readers never see a partial image
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+
+            self._size += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                victim, size = self._entries.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, victim))
+                except FileNotFoundError:
+                    pass
+        return path
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Process-wide render cache, rebuilt if the cache settings change (e.g. in tests)
+def get_render_cache():
+    global _cache
+    directory = settings.MEMES_RENDER_CACHE_DIR
+    max_bytes = settings.MEMES_RENDER_CACHE_MAX_BYTES
+    with _cache_lock:
+        if _cache is None or (_cache.directory, _cache.max_bytes) != (str(directory), max_bytes):
+            _cache = RenderCache(directory, max_bytes)
+        return _cache
+
+
+# Return (path, content type, cache hit) of the rendered image for a meme
+def rendered_meme_path(meme, width=None, fmt='png'):
+    template = meme.template
+    try:
+        if not template.image_checksum:
+            assets.ingest_template(template)
+        name = f'{render_key(template.image_checksum, meme.top_text, meme.bottom_text, width, fmt)}.{fmt}'
+        cache = get_render_cache()
+        path = cache.get(name)
+        if path is not None:
+            return path, FORMATS[fmt][1], True
+        template_image = assets.load_image(template)
+    except assets.AssetError as exc:
+        raise RenderError(str(exc)) from exc
+    data = render_meme(template_image, meme.top_text, meme.bottom_text, width, fmt)
+    return cache.put(name, data), FORMATS[fmt][1], False
@@ -0,0 +1,177 @@
+# Random meme selection without ORDER BY RANDOM(), which makes the database sort the
+# whole memes table on every call.
+#
+# A random id is drawn between the smallest and largest meme ids and looked up by primary
+# key. Ids that fall into a gap left by deleted memes are rejected and redrawn, so every
+# existing meme is equally likely. With an id space that is at least half full a pick costs
+# three index lookups on average; after MAX_PROBES misses the pick falls back to a uniform
+# offset into the primary key index so a very sparse table still answers correctly.
+#
+# Weighted picks (?weighted=rating) favor memes in proportion to their smoothed score (the
+# Bayesian average, or the prior mean for unrated memes). They are drawn in O(1) from a Walker
+# alias table of every meme, held in memory per process (3 arrays of 8-byte items, so 24 bytes
+# per meme). The table is built on first use and rebuilt in a background thread when ratings
+# change (the leaderboard cache version moves) or once it is MEMES_WEIGHTED_RANDOM_MAX_AGE
+# seconds old, at most once per MEMES_WEIGHTED_RANDOM_MIN_INTERVAL seconds; the previous table
+# keeps serving picks meanwhile.
+
+import random
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db import connection
+
+from . import caching
+from .models import Meme
+
+
+MAX_PROBES = 8
+
+
+# Return a uniformly random meme, or None when there are no memes
+def random_meme():
+    # Separate lookups so each one is a single read from an end of the primary key index
+    # (SQLite only optimizes a lone MIN()/MAX() in a query)
+    ids = Meme.objects.order_by('pk').values_list('pk', flat=True)
+    low, high = ids.first(), ids.last()
+    if low is None:
+        return None
+
+    for _ in range(MAX_PROBES):
+        meme = Meme.objects.filter(pk=random.randint(low, high)).first()
+        if meme is not None:
+            return meme
+
+    # Mostly gaps: pick by position instead (COUNT plus OFFSET over the primary key index)
+    count = Meme.objects.count()
+    if count == 0:
+        return None
+    return Meme.objects.order_by('pk')[random.randrange(count)]
+
+
+# random_meme for async views, with the same probes through the async ORM
+async def arandom_meme():
+    ids = Meme.objects.order_by('pk').values_list('pk', flat=True)
+    low, high = await ids.afirst(), await ids.alast()
+    if low is None:
+        return None
+
+    for _ in range(MAX_PROBES):
+        meme = await Meme.objects.filter(pk=random.randint(low, high)).afirst()
+        if meme is not None:
+            return meme
+
+    count = await Meme.objects.acount()
+    if count == 0:
+        return None
+    offset = random.randrange(count)
+    return await Meme.objects.order_by('pk')[offset:offset + 1].afirst()
+
+
+# Walker alias table over `ids` with the given non-negative `weights`: sample() returns an id
+# with probability weight / total weight, using one uniform index and one biased coin flip
+class AliasTable:
+    def __init__(self, ids, weights):
+        self.ids = array('q', ids)
+        count = len(self.ids)
+        self.prob = array('d', [1.0]) * count
+        self.alias = array('q', range(count))
+        total = sum(weights)
+        if not count or total <= 0:
+            return
+
+        # Vose's method: pair each under-full column with an over-full one
+        scaled = [weight * count / total for weight in weights]
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Columns left over are full, up to rounding errors
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sample(self):
+        index = random.randrange(len(self.ids))
+        return self.ids[index] if random.random() < self.prob[index] else self.ids[self.alias[index]]
+
+
+# Smoothed score of each meme: [(id, weight)]
+def meme_weights():
+    prior_mean = settings.MEMES_LEADERBOARD_PRIOR_MEAN
+    return [(meme_id, prior_mean if bayes is None else bayes)
+            for meme_id, bayes in Meme.objects.values_list('pk', 'rating_bayes').iterator(chunk_size=10000)]
+
+
+# Per-process holder of the alias table used by weighted_random_meme
+class WeightedSampler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._table = None
+            self._version = None
+            self._built_at = 0.0
+            self._rebuilding = False
+
+    def rebuild(self):
+        # Read the version first: ratings changed during the build move it again
+        version = caching.get_version(caching.LEADERBOARD)
+        weights = meme_weights()
+        table = AliasTable([meme_id for meme_id, _ in weights], [weight for _, weight in weights])
+        with self._lock:
+            self._table, self._version, self._built_at = table, version, time.monotonic()
+        return table
+
+    def _stale(self):
+        age = time.monotonic() - self._built_at
+        if age < settings.MEMES_WEIGHTED_RANDOM_MIN_INTERVAL:
+            return False
+        return age >= settings.MEMES_WEIGHTED_RANDOM_MAX_AGE or caching.get_version(caching.LEADERBOARD) != self._version
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def _start_background_rebuild(self):
+        threading.Thread(target=self._rebuild_in_background, name='weighted-random-rebuild', daemon=True).start()
+
+    # Current table: built now on first use, refreshed in the background when stale
+    def table(self):
+        if self._table is None:
+            return self.rebuild()
+        with self._lock:
+            start = not self._rebuilding and self._stale()
+            if start:
+                self._rebuilding = True
+        if start:
+            self._start_background_rebuild()
+        return self._table
+
+
+weighted = WeightedSampler()
+
+
+# Return a random meme picked in proportion to its smoothed rating, or None when there are no
+# memes. Memes created after the table was built are not picked until the next rebuild.
+def weighted_random_meme():
+    table = weighted.table()
+    if not table:
+        return random_meme()
+    for _ in range(MAX_PROBES):
+        meme = Meme.objects.filter(pk=table.sample()).first()
+        if meme is not None:
+            return meme
+    # Deleted since the table was built
+    return random_meme()
@@ -0,0 +1,327 @@
+# Caption search: GET /api/memes/search/?q=&template=&page=&page_size=.
+#
+# On Postgres a query matches the full-text vector of top_text and bottom_text (English
+# stemming, websearch syntax: "quoted phrases", -excluded words, or) or, for misspellings,
+# is close to a word sequence of the captions by trigram word similarity. Both expressions
+# are served by the GIN indexes of migration 0010 and must stay identical to them. Matches
+# are ranked by ts_rank_cd plus the trigram similarity. Without the pg_trgm extension only
+# the full-text match is used, so misspelled words find nothing.
+#
+# Other databases (SQLite test and development runs) use an in-process inverted index of the
+# captions, updated as memes are written. Every query word must occur in a caption,
+# a word that occurs in no caption matches the closest caption words by trigram similarity
+# instead, and matches are ranked by BM25. There is no stemming there.
+
+import heapq
+import math
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from itertools import chain, islice
+
+from django.db import connection
+from django.db.models import Count, Max
+
+from .models import Meme
+
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_QUERY_LENGTH = 200
+
+_DOCUMENT = "({table}.top_text || ' ' || {table}.bottom_text)"
+_VECTOR = "to_tsvector('english'::regconfig, {document})"
+
+_SEARCH_SQL = """
+    SELECT {table}.id
+    FROM {table}, websearch_to_tsquery('english'::regconfig, %(q)s) AS query
+    WHERE ({vector} @@ query{fuzzy_match}){template_filter}
+    ORDER BY ts_rank_cd({vector}, query){fuzzy_rank} DESC, {table}.id DESC
+    LIMIT %(limit)s OFFSET %(offset)s
+"""
+_FUZZY_MATCH = " OR %(q)s <%% {document}"
+_FUZZY_RANK = " + word_similarity(%(q)s, {document})"
+
+_has_trigrams = None
+
+
+class SearchError(Exception):
+    pass
+
+
+def _int_param(query_params, name, default):
+    try:
+        return int(query_params.get(name, default))
+    except ValueError:
+        raise SearchError(f'{name} must be an integer')
+
+
+# Parse ?q=, ?template=, ?page= and ?page_size=, returning (q, template id or None, page, page_size)
+def parse(query_params):
+    q = query_params.get('q', '').strip()
+    if not q:
+        raise SearchError('q is required')
+    if len(q) > MAX_QUERY_LENGTH:
+        raise SearchError(f'q must be at most {MAX_QUERY_LENGTH} characters')
+    template = query_params.get('template')
+    if template is not None:
+        template = _int_param(query_params, 'template', None)
+    page = _int_param(query_params, 'page', 1)
+    if page < 1:
+        raise SearchError('page must be at least 1')
+    page_size = _int_param(query_params, 'page_size', PAGE_SIZE)
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise SearchError(f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+    return q, template, page, page_size
+
+
+# Whether pg_trgm is installed (migration 0010 skips the trigram index where it is not
+# available). Read once per process.
+def has_trigrams():
+    global _has_trigrams
+    if _has_trigrams is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            _has_trigrams = cursor.fetchone()[0]
+    return _has_trigrams
+
+
+def _search_postgresql(q, template, limit, offset):
+    table = connection.ops.quote_name(Meme._meta.db_table)
+    document = _DOCUMENT.format(table=table)
+    fuzzy = has_trigrams()
+    sql = _SEARCH_SQL.format(
+        table=table, vector=_VECTOR.format(document=document),
+        fuzzy_match=_FUZZY_MATCH.format(document=document) if fuzzy else '',
+        fuzzy_rank=_FUZZY_RANK.format(document=document) if fuzzy else '',
+        template_filter=f' AND {table}.template_id = %(template)s' if template is not None else '',
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'q': q, 'template': template, 'limit': limit, 'offset': offset})
+        return [row[0] for row in cursor.fetchall()]
+
+
+def tokens(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def _trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Inverted index of the meme captions: word -> {meme id: BM25 weight of the word in the meme}
+class InvertedIndex:
+    K1 = 1.2
+    B = 0.75
+    FUZZY_SIMILARITY = 0.5  # Least trigram similarity of a caption word to a misspelled query word
+    PRERANKED_POSTINGS = 1000  # Words in at least this many memes are ranked when the index is built
+
+    def __init__(self, rows):
+        self.postings = {}
+        self.templates = {}
+        self.words = {}  # meme id -> {word: occurrences}
+        self.lengths = {}
+        self.total_length = 0
+        self.changes = 0  # Memes added or removed since the index was built
+        for meme_id, template_id, top_text, bottom_text in rows:
+            words = tokens(f'{top_text} {bottom_text}')
+            self.words[meme_id] = Counter(words)
+            for word, occurrences in self.words[meme_id].items():
+                self.postings.setdefault(word, {})[meme_id] = occurrences
+            self.templates[meme_id] = template_id
+            self.lengths[meme_id] = len(words)
+            self.total_length += len(words)
+
+        # Replace occurrence counts with their BM25 weight once, so queries only add weights
+        for postings in self.postings.values():
+            documents = len(postings)
+            for meme_id, occurrences in postings.items():
+                postings[meme_id] = self._weight(occurrences, self.lengths[meme_id], documents)
+        self._words_by_trigram = None
+        self._ranked = {}
+        for word, postings in self.postings.items():
+            if len(postings) >= self.PRERANKED_POSTINGS:
+                self.ranked(word)
+
+    # BM25 weight of a word found `occurrences` times in a caption of `length` words, the word
+    # being in `documents` captions. Memes added later are weighed with the statistics of the
+    # time; the others keep theirs until the next rebuild.
+    def _weight(self, occurrences, length, documents):
+        idf = math.log(1 + (len(self.lengths) - documents + 0.5) / (documents + 0.5))
+        norm = self.K1 * (1 - self.B + self.B * length * len(self.lengths) / max(self.total_length, 1))
+        return idf * occurrences * (self.K1 + 1) / (occurrences + norm)
+
+    @staticmethod
+    def _rank_key(postings):
+        return lambda meme_id: (-postings[meme_id], -meme_id)
+
+    # Memes containing `word`, best first (sorted on the first query of a rarer word)
+    def ranked(self, word):
+        ranked = self._ranked.get(word)
+        if ranked is None:
+            ranked = self._ranked[word] = sorted(self.postings[word], key=self._rank_key(self.postings[word]))
+        return ranked
+
+    # Add or replace the caption of one meme
+    def add(self, meme_id, template_id, top_text, bottom_text):
+        self.remove(meme_id)
+        words = tokens(f'{top_text} {bottom_text}')
+        self.words[meme_id] = Counter(words)
+        self.templates[meme_id] = template_id
+        self.lengths[meme_id] = len(words)
+        self.total_length += len(words)
+        for word, occurrences in self.words[meme_id].items():
+            if word not in self.postings:
+                self.postings[word] = {}
+                if self._words_by_trigram is not None:
+                    for trigram in _trigrams(word):
+                        self._words_by_trigram[trigram].add(word)
+            postings = self.postings[word]
+            postings[meme_id] = self._weight(occurrences, len(words), len(postings) + 1)
+            if word in self._ranked:
+                insort(self._ranked[word], meme_id, key=self._rank_key(postings))
+        self.changes += 1
+
+    def remove(self, meme_id):
+        words = self.words.pop(meme_id, None)
+        if words is None:
+            return
+        del self.templates[meme_id]
+        self.total_length -= self.lengths.pop(meme_id)
+        for word in words:
+            postings = self.postings[word]
+            ranked = self._ranked.get(word)
+            if ranked is not None:
+                key = self._rank_key(postings)
+                del ranked[bisect_left(ranked, key(meme_id), key=key)]
+            del postings[meme_id]
+            if not postings:
+                del self.postings[word]
+                self._ranked.pop(word, None)
+                if self._words_by_trigram is not None:
+                    for trigram in _trigrams(word):
+                        self._words_by_trigram[trigram].discard(word)
+        self.changes += 1
+
+    # Caption words matching a query word, with their weight (1 for the word itself)
+    def _expand(self, word):
+        if word in self.postings:
+            return {word: 1.0}
+        if self._words_by_trigram is None:
+            self._words_by_trigram = defaultdict(set)
+            for candidate in self.postings:
+                for trigram in _trigrams(candidate):
+                    self._words_by_trigram[trigram].add(candidate)
+        trigrams = _trigrams(word)
+        shared = Counter(chain.from_iterable(self._words_by_trigram.get(trigram, ()) for trigram in trigrams))
+        similar = {}
+        for candidate, count in shared.items():
+            similarity = count / (len(trigrams) + len(_trigrams(candidate)) - count)
+            if similarity >= self.FUZZY_SIMILARITY:
+                similar[candidate] = similarity
+        return similar
+
+    # Ids of the best `limit` memes matching every word of `q`, best first
+    def search(self, q, template=None, limit=PAGE_SIZE):
+        terms = [self._expand(word) for word in dict.fromkeys(tokens(q))]
+        if not terms or not all(terms):
+            return []
+        if len(terms) == 1 and len(terms[0]) == 1:
+            ranked = self.ranked(next(iter(terms[0])))
+            if template is not None:
+                ranked = (meme_id for meme_id in ranked if self.templates[meme_id] == template)
+            return list(islice(ranked, limit))
+        # Start from the word with the fewest matches; the others only look up its matches
+        terms.sort(key=lambda expansions: sum(len(self.postings[word]) for word in expansions))
+        scores = {}
+        for word, similarity in terms[0].items():
+            for meme_id, weight in self.postings[word].items():
+                if template is None or self.templates[meme_id] == template:
+                    scores[meme_id] = max(scores.get(meme_id, 0), similarity * weight)
+        for expansions in terms[1:]:
+            postings = [(self.postings[word], similarity) for word, similarity in expansions.items()]
+            matched = {}
+            for meme_id, score in scores.items():
+                best = max((similarity * weights[meme_id] for weights, similarity in postings if meme_id in weights),
+                           default=None)
+                if best is not None:
+                    matched[meme_id] = score + best
+            scores = matched
+        return heapq.nlargest(limit, scores, key=lambda meme_id: (scores[meme_id], meme_id))
+
+
+RECHECK_INTERVAL = 1.0  # Seconds between checks for memes written by other processes
+REBUILD_CHANGES = 0.2  # Rebuild (refreshing every weight) after this fraction of the memes changed
+
+_index = None  # (state of the memes table or None, monotonic time of the check, InvertedIndex)
+_index_lock = threading.Lock()
+
+
+def _table_state():
+    return Meme.objects.aggregate(count=Count('id'), last_id=Max('id'), last_updated=Max('updated_at'))
+
+
+# Inverted index of the current memes. Memes saved or deleted in this process update their own
+# entries (index_memes, unindex_meme). Writes from other processes, and bulk updates that send
+# no signals, are found by comparing the count, last id and last updated_at of the memes table,
+# at most every RECHECK_INTERVAL seconds, and rebuild the index. Rating writes move updated_at
+# too, so under rating traffic the index is rebuilt at most once per interval.
+def fallback_index():
+    global _index
+    with _index_lock:
+        now = time.monotonic()
+        if _index is not None and now - _index[1] < RECHECK_INTERVAL:
+            return _index[2]
+        state = _table_state()
+        if _index is not None:
+            known, _, index = _index
+            # None: the index was updated in this process since the last check, which moved the state
+            if known in (None, state) and index.changes <= REBUILD_CHANGES * max(len(index.lengths), 1000):
+                _index = (state, now, index)
+                return index
+        rows = Meme.objects.values_list('pk', 'template_id', 'top_text', 'bottom_text').iterator(chunk_size=10000)
+        _index = (state, now, InvertedIndex(rows))
+        return _index[2]
+
+
+def _update_index(apply):
+    global _index
+    with _index_lock:
+        if _index is not None:
+            apply(_index[2])
+            _index = (None, _index[1], _index[2])
+
+
+# Memes created or edited in this process (memes.models receivers, memes.bulk), once committed
+def index_memes(memes):
+    def apply(index):
+        for meme in memes:
+            index.add(meme.pk, meme.template_id, meme.top_text, meme.bottom_text)
+    _update_index(apply)
+
+
+def unindex_meme(meme_id):
+    _update_index(lambda index: index.remove(meme_id))
+
+
+def reset():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+# Ids of the memes matching `q`, best first, from `offset` and at most `limit` of them
+def search_ids(q, template=None, limit=PAGE_SIZE, offset=0):
+    if connection.vendor == 'postgresql':
+        return _search_postgresql(q, template, limit, offset)
+    return fallback_index().search(q, template, offset + limit)[offset:]
+
+
+# One page of search results: (memes, whether there is a next page)
+def search_memes(q, template=None, page=1, page_size=PAGE_SIZE):
+    meme_ids = search_ids(q, template, page_size + 1, (page - 1) * page_size)
+    memes = Meme.objects.in_bulk(meme_ids[:page_size])
+    return [memes[meme_id] for meme_id in meme_ids[:page_size] if meme_id in memes], len(meme_ids) > page_size
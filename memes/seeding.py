@@ -0,0 +1,148 @@
+# Synthetic data generation for benchmarks and load tests.
+
+import random
+
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+
+from .models import Meme, MemeTemplate, Rating
+
+
+BENCH_USERNAME = 'bench-seeder'
+
+
+# Get or create the user and template that seeded memes are attached to
+def seed_owner():
+    user, _ = User.objects.get_or_create(username=BENCH_USERNAME)
+    template, _ = MemeTemplate.objects.get_or_create(
+        name='Bench Template',
+        defaults={'image_url': 'https://example.com/bench.jpg'},
+    )
+    return user, template
+
+
+# Bulk insert memes until the table holds at least `total` rows, returning how many were added.
+# captions(i) gives the (top_text, bottom_text) of the i-th added meme.
+def seed_memes(total, batch_size=10000, captions=None):
+    user, template = seed_owner()
+    captions = captions or (lambda i: (f'Top {i}', f'Bottom {i}'))
+    missing = total - Meme.objects.count()
+    added = 0
+    while added < missing:
+        size = min(batch_size, missing - added)
+        Meme.objects.bulk_create(
+            Meme(template=template, top_text=top_text, bottom_text=bottom_text, created_by=user)
+            for top_text, bottom_text in map(captions, range(added, added + size))
+        )
+        added += size
+    return max(added, 0)
+
+
+CAPTION_SYLLABLES = ('ba', 'ko', 'mi', 'ra', 'tu', 've', 'zo', 'li', 'pe', 'na', 'gu', 'shi', 'do', 'fe', 'ya', 'wo')
+
+
+# `size` distinct made-up words of 2 to 4 syllables, the same for the same seed
+def caption_words(size, seed=0):
+    rng = random.Random(seed)
+    words = {}
+    while len(words) < size:
+        words[''.join(rng.choices(CAPTION_SYLLABLES, k=rng.randint(2, 4)))] = None
+    return list(words)
+
+
+# captions callable for seed_memes: captions of 2 to 6 words each, drawn from `words` with
+# Zipf weights so that a few words are common and most are rare
+def random_captions(words, exponent=1.1, seed=0):
+    rng = random.Random(seed)
+    cum_weights = _zipf_cum_weights(len(words), exponent)
+
+    def captions(i):
+        return tuple(' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(2, 6))) for _ in range(2))
+    return captions
+
+
+# Create `users` rater accounts and have each of them rate `per_user` distinct random memes,
+# then return the number of ratings added. Meme aggregates are not updated here: run
+# rebuild_rating_aggregates afterwards.
+def seed_ratings(users, per_user, batch_size=10000):
+    prefix = f'bench-rater-{User.objects.filter(username__startswith="bench-rater-").count()}-'
+    User.objects.bulk_create(User(username=f'{prefix}{i}', password='!') for i in range(users))
+    rater_ids = list(User.objects.filter(username__startswith=prefix).values_list('pk', flat=True))
+    meme_ids = list(Meme.objects.values_list('pk', flat=True))
+
+    ratings = [
+        Rating(meme_id=meme_id, user_id=user_id, score=random.randint(1, 5))
+        for user_id in rater_ids
+        for meme_id in random.sample(meme_ids, min(per_user, len(meme_ids)))
+    ]
+    Rating.objects.bulk_create(ratings, batch_size=batch_size)
+    return len(ratings)
+
+
+# Cumulative Zipf weights for `n` ranks: rank k is drawn with probability proportional to
+# 1 / k ** exponent, so a few templates, creators and memes get most of the activity
+def _zipf_cum_weights(n, exponent):
+    total, cum_weights = 0.0, []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+# Scores lean positive, like most rating sites
+SCORE_WEIGHTS = [0.08, 0.12, 0.2, 0.3, 0.3]
+
+
+# Generate a load-test dataset: `users` users with API tokens, `templates` templates, `memes`
+# memes and about `ratings` ratings. Template use, meme authorship and meme popularity follow
+# Zipf distributions with the given exponent. The same seed gives the same dataset. Returns
+# the number of rows added per model; meme aggregates must be rebuilt afterwards.
+def seed_load(users, templates, memes, ratings, exponent=1.1, seed=0, batch_size=10000):
+    rng = random.Random(seed)
+    prefix = f'load-{seed}-{User.objects.filter(username__startswith=f"load-{seed}-").count()}-'
+
+    for start in range(0, users, batch_size):
+        User.objects.bulk_create(
+            User(username=f'{prefix}{i}', password='!') for i in range(start, min(start + batch_size, users))
+        )
+    user_ids = list(User.objects.filter(username__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+    Token.objects.bulk_create((Token(key=Token.generate_key(), user_id=user_id) for user_id in user_ids),
+                              batch_size=batch_size)
+
+    MemeTemplate.objects.bulk_create(
+        MemeTemplate(name=f'{prefix}template {i}', image_url=f'https://example.com/{prefix}{i}.jpg',
+                     default_top_text='Top', default_bottom_text='Bottom')
+        for i in range(templates)
+    )
+    template_ids = list(MemeTemplate.objects.filter(name__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+
+    template_weights = _zipf_cum_weights(len(template_ids), exponent)
+    user_weights = _zipf_cum_weights(len(user_ids), exponent)
+    for start in range(0, memes, batch_size):
+        size = min(batch_size, memes - start)
+        Meme.objects.bulk_create(
+            Meme(template_id=template_id, created_by_id=user_id,
+                 top_text=f'Top {start + i}', bottom_text=f'Bottom {start + i}')
+            for i, (template_id, user_id) in enumerate(zip(
+                rng.choices(template_ids, cum_weights=template_weights, k=size),
+                rng.choices(user_ids, cum_weights=user_weights, k=size),
+            ))
+        )
+    meme_ids = list(Meme.objects.filter(template_id__in=template_ids)
+                    .order_by('pk').values_list('pk', flat=True))
+
+    # Popular memes are rated by many users; raters are uniform. Repeated draws of the same
+    # pair are dropped, so with strong skew and few users fewer than `ratings` rows are created.
+    # Popularity ranks are shuffled so that popular memes are spread over the id range.
+    popularity = meme_ids[:]
+    rng.shuffle(popularity)
+    meme_weights = _zipf_cum_weights(len(popularity), exponent)
+    pairs = sorted(set(zip(rng.choices(popularity, cum_weights=meme_weights, k=ratings),
+                           rng.choices(user_ids, k=ratings))))
+    scores = rng.choices(range(1, 6), weights=SCORE_WEIGHTS, k=len(pairs))
+    for start in range(0, len(pairs), batch_size):
+        Rating.objects.bulk_create(
+            Rating(meme_id=meme_id, user_id=user_id, score=score)
+            for (meme_id, user_id), score in zip(pairs[start:start + batch_size], scores[start:start + batch_size])
+        )
+    return {'users': len(user_ids), 'templates': len(template_ids), 'memes': len(meme_ids), 'ratings': len(pairs)}
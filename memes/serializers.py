@@ -2,7 +2,7 @@
 # API interactions and validate incoming data.
 
 from rest_framework import serializers
-from .models import MemeTemplate, Meme, Rating
+from .models import MAX_ID, RATING_HISTOGRAM_FIELDS, MemeTemplate, Meme, Rating
 from django.contrib.auth.models import User
 
 
@@ -12,16 +12,51 @@ class MemeTemplateSerializer(serializers.ModelSerializer):
         model = MemeTemplate
         fields = ['id', 'name', 'image_url', 'default_top_text', 'default_bottom_text']
 
+# Texts of a new meme: the given text, or the template's default when it is not provided
+def meme_texts(template, data):
+    top_text = data.get('top_text', template.default_top_text if template else 'Default Top Text')
+    bottom_text = data.get('bottom_text', template.default_bottom_text if template else 'Default Bottom Text')
+    return top_text, bottom_text
+
+# Author of a meme as inlined with ?expand=created_by
+class MemeAuthorSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username']
+
+# Meme relations that ?expand= can inline, with the serializer they are rendered with
+EXPANDABLE_MEME_FIELDS = {
+    'template': MemeTemplateSerializer,
+    'created_by': MemeAuthorSerializer,
+}
+
 # Meme serializer
 class MemeSerializer(serializers.ModelSerializer):
     
     # Set default values for top_text and bottom_text
     top_text = serializers.CharField(default="Default Top Text", required=False)
     bottom_text = serializers.CharField(default="Default Bottom Text", required=False)
+    # Number of ratings of each score: {"1": n1, ..., "5": n5}
+    rating_histogram = serializers.SerializerMethodField()
     
     class Meta:
         model = Meme
-        fields = ['id', 'template', 'top_text', 'bottom_text', 'created_by', 'created_at']
+        fields = ['id', 'template', 'top_text', 'bottom_text', 'created_by', 'created_at', 'view_count',
+                  'rating_histogram']
+        read_only_fields = ['view_count']  # Counted by memes.counters, up to a flush interval behind
+
+    # fields: names to render (default all), expand: relations to render as nested objects
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        for name in expand:
+            if name in self.fields:
+                self.fields[name] = EXPANDABLE_MEME_FIELDS[name](read_only=True)
+
+    def get_rating_histogram(self, meme):
+        return {str(score): getattr(meme, name) for score, name in enumerate(RATING_HISTOGRAM_FIELDS, 1)}
 
     def create(self, validated_data):
        
@@ -33,8 +68,7 @@ class MemeSerializer(serializers.ModelSerializer):
             created_by = self.context['request'].user
 
         # Use template's default values if provided
-        top_text = validated_data.get('top_text', template.default_top_text if template else 'Default Top Text')
-        bottom_text = validated_data.get('bottom_text', template.default_bottom_text if template else 'Default Bottom Text')
+        top_text, bottom_text = meme_texts(template, validated_data)
 
        
         meme = Meme.objects.create(
@@ -45,12 +79,25 @@ class MemeSerializer(serializers.ModelSerializer):
         )
         return meme
 
+# One item of a bulk meme creation. Related objects are plain ids here: they are checked
+# against a single prefetch of all templates and users referenced by the batch.
+class BulkMemeItemSerializer(serializers.Serializer):
+    template = serializers.IntegerField(min_value=1, max_value=MAX_ID)
+    top_text = serializers.CharField(max_length=100, required=False)
+    bottom_text = serializers.CharField(max_length=100, required=False)
+    created_by = serializers.IntegerField(min_value=1, max_value=MAX_ID, required=False)
+
 # Rating serializer
 class RatingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Rating
         fields = ['id', 'meme', 'user', 'score', 'created_at']
         
+# One item of a batch of ratings, scored with the same choices as Rating.score
+class RatingBatchItemSerializer(serializers.Serializer):
+    meme = serializers.IntegerField(min_value=1, max_value=MAX_ID)
+    rating = serializers.ChoiceField(choices=Rating._meta.get_field('score').choices)
+        
 # User serializer
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -1,13 +1,47 @@
-from django.test import TestCase
+import contextlib
+import csv
+import difflib
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import threading
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
 from django.urls import reverse
 from rest_framework import status
-from .models import Meme, MemeTemplate, Rating
-from django.contrib.auth.models import User
+from django.utils import timezone
+from .models import Meme, MemeRatingBucket, MemeRatingWindow, MemeTemplate, Rating, RatingWindow
+from .admin import EstimatedCountPaginator, MemeAdmin
+from .lru import BoundedLRU
+from . import assets, authentication, caching, counters, feed, leaderboard, metrics, pagination, provisioning, ratings, rendering, sampling, search, seeding
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.auth.models import User, update_last_login
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.test import APIClient
 
 class MemeAPIViewsTest(TestCase):
     def setUp(self):
+        # Cached responses and buffered view counts outlive the per-test database rollback
+        cache.clear()
+        counters.discard()
+
         # Create users
         self.user1 = User.objects.create_user(username='user1', password='password1')
         self.user2 = User.objects.create_user(username='user2', password='password2')
@@ -320,6 +354,15 @@ class MemeAPIViewsTest(TestCase):
         self.assertIn("error", response.data)  
         self.assertEqual(Rating.objects.count(), 0)  # Rating should not be created
     
+    # Test that rating ids no meme can have is a 404, not a database error
+    def test_rate_meme_out_of_range_id(self):
+        client = APIClient()
+        client.force_authenticate(self.user1)
+        for meme_id in ('99999999999999999999', '0', '-1'):
+            response = client.post(f'/api/memes/{meme_id}/rate/', {'rating': 4}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, meme_id)
+        self.assertEqual(Rating.objects.count(), 0)
+
     # Test user rating the same meme twice    
     def test_rate_meme_update_existing_rating(self):
         url = reverse('meme-rate-meme', args=[self.meme1.id])
@@ -445,3 +488,1755 @@ class MemeAPIViewsTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.data, dict)
         self.assertEqual(len(response.data['data']), 0)  # No memes should be returned as no ratings exist
+
+    # Test that rating a meme maintains the stored aggregates, including when a rating is updated
+    def test_rate_meme_updates_aggregates(self):
+        self.rate_meme_for_test(self.meme1.id, 5, self.user1)
+        self.rate_meme_for_test(self.meme1.id, 2, self.user2)
+        self.rate_meme_for_test(self.meme1.id, 3, self.user1)  # user1 changes 5 -> 3
+
+        self.meme1.refresh_from_db()
+        self.assertEqual(self.meme1.rating_count, 2)
+        self.assertEqual(self.meme1.rating_sum, 5)
+        self.assertAlmostEqual(self.meme1.rating_avg, 2.5)
+
+    # Test that deleting a rating removes it from the aggregates
+    def test_delete_rating_updates_aggregates(self):
+        self.rate_meme_for_test(self.meme1.id, 4, self.user1)
+        Rating.objects.get(meme=self.meme1, user=self.user1).delete()
+
+        self.meme1.refresh_from_db()
+        self.assertEqual(self.meme1.rating_count, 0)
+        self.assertEqual(self.meme1.rating_sum, 0)
+        self.assertIsNone(self.meme1.rating_avg)
+
+    # Test that ratings deleted along with their user or meme are deleted with one statement
+    # (not loaded row by row) and leave the aggregates of the remaining memes in one update
+    def test_cascade_delete_updates_aggregates_once(self):
+        # Rating rows read by the deletion, apart from the grouped read of the removed totals
+        def rating_reads(captured):
+            return [q['sql'] for q in captured.captured_queries
+                    if q['sql'].startswith('SELECT') and 'FROM "memes_rating"' in q['sql'] and 'COUNT(' not in q['sql']]
+
+        def meme_updates(captured):
+            return [q['sql'] for q in captured.captured_queries if 'UPDATE memes_meme SET' in q['sql'].replace('"', '')]
+
+        extra = [Meme.objects.create(template=self.template1, created_by=self.user1) for _ in range(40)]
+        for meme in [self.meme1, self.meme2, self.meme3, *extra]:
+            ratings.rate_meme(meme.id, self.user3, 5)
+            ratings.rate_meme(meme.id, self.user2, 2)
+        # user3's ratings, and meme3 (created by user3) with its ratings
+        with CaptureQueriesContext(connection) as captured:
+            self.user3.delete()
+        self.assertEqual(len(meme_updates(captured)), 1)
+        self.assertEqual(rating_reads(captured), [])
+        self.assertFalse(Rating.objects.filter(user_id=self.user3.id).exists())
+
+        self.assertFalse(Meme.objects.filter(pk=self.meme3.id).exists())
+        for meme in Meme.objects.filter(pk__in=[self.meme1.id, self.meme2.id, extra[-1].id]):
+            self.assertEqual((meme.rating_sum, meme.rating_count, meme.rating_5, meme.rating_2), (2, 1, 0, 1))
+            self.assertAlmostEqual(meme.rating_avg, 2.0)
+        self.assertEqual(MemeRatingBucket.objects.get(meme=self.meme1).rating_count, 1)
+
+        with CaptureQueriesContext(connection) as captured:
+            Meme.objects.filter(pk__in=[meme.id for meme in extra]).delete()
+        self.assertEqual(meme_updates(captured), [])
+        self.assertEqual(rating_reads(captured), [])
+        self.assertFalse(MemeRatingBucket.objects.filter(meme__in=[meme.id for meme in extra]).exists())
+        self.meme1.refresh_from_db()
+        self.assertEqual((self.meme1.rating_sum, self.meme1.rating_count), (2, 1))
+
+    # Test that deleting ratings by queryset removes them from the aggregates with one update
+    def test_delete_ratings_queryset_updates_aggregates(self):
+        for meme in (self.meme1, self.meme2):
+            self.rate_meme_for_test(meme.id, 4, self.user1)
+            self.rate_meme_for_test(meme.id, 1, self.user2)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(Rating.objects.filter(user=self.user1).delete()[0], 2)
+        self.assertEqual(len([q for q in captured.captured_queries if 'UPDATE memes_meme SET' in q['sql'].replace('"', '')]), 1)
+        for meme in Meme.objects.filter(pk__in=[self.meme1.id, self.meme2.id]):
+            self.assertEqual((meme.rating_sum, meme.rating_count, meme.rating_4, meme.rating_1), (1, 1, 0, 1))
+        self.assertEqual(MemeRatingBucket.objects.get(meme=self.meme1).rating_sum, 1)
+
+    # Test that the rating histogram moves a vote between scores when a rating changes
+    def test_rating_histogram(self):
+        self.rate_meme_for_test(self.meme1.id, 5, self.user1)
+        self.rate_meme_for_test(self.meme1.id, 5, self.user2)
+        self.rate_meme_for_test(self.meme1.id, 2, self.user1)  # user1 changes 5 -> 2
+        Rating.objects.get(meme=self.meme1, user=self.user2).delete()
+        self.rate_meme_for_test(self.meme1.id, 3, self.user3)
+
+        response = self.client.get(reverse('meme-detail', args=[self.meme1.id]))
+        self.assertEqual(response.data['rating_histogram'], {'1': 0, '2': 1, '3': 1, '4': 0, '5': 0})
+
+        # Rendered from the narrowed queryset without deferred loads
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('meme-list'), {'fields': 'id,rating_histogram'})
+        histograms = {meme['id']: meme['rating_histogram'] for meme in response.data['results']}
+        self.assertEqual(histograms[self.meme1.id], {'1': 0, '2': 1, '3': 1, '4': 0, '5': 0})
+        self.assertEqual(histograms[self.meme2.id], {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0})
+
+    # Test that a rating changes the ETag of the meme, since it changes the histogram
+    def test_rating_changes_meme_etag(self):
+        url = reverse('meme-detail', args=[self.meme1.id])
+        etag = self.client.get(url)['ETag']
+        self.rate_meme_for_test(self.meme1.id, 4, self.user1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rating_histogram']['4'], 1)
+
+    # Test that the rebuild command repairs drifted aggregates
+    def test_rebuild_rating_aggregates_command(self):
+        self.rate_meme_for_test(self.meme1.id, 5, self.user1)
+        self.rate_meme_for_test(self.meme1.id, 4, self.user2)
+        Meme.objects.update(rating_sum=0, rating_count=7, rating_avg=1.0, rating_1=3, rating_5=0)
+
+        version = caching.get_version(caching.LEADERBOARD)
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertNotEqual(caching.get_version(caching.LEADERBOARD), version)
+
+        self.meme1.refresh_from_db()
+        self.meme2.refresh_from_db()
+        self.assertEqual((self.meme1.rating_sum, self.meme1.rating_count), (9, 2))
+        self.assertAlmostEqual(self.meme1.rating_avg, 4.5)
+        self.assertEqual([self.meme1.rating_1, self.meme1.rating_4, self.meme1.rating_5], [0, 1, 1])
+        self.assertEqual((self.meme2.rating_sum, self.meme2.rating_count, self.meme2.rating_1), (0, 0, 0))
+        self.assertIsNone(self.meme2.rating_avg)
+
+    # Test cursor pagination walks every meme in (created_at, id) order without a total count
+    def test_list_memes_cursor_pagination(self):
+        for i in range(12):
+            Meme.objects.create(
+                template=self.template1, top_text=f"Top {i}", bottom_text=f"Bottom {i}", created_by=self.user1
+            )
+        response = self.client.get(reverse('meme-list'), {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['previous'])
+
+        seen = [meme['id'] for meme in response.data['results']]
+        next_url = response.data['next']
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIsNotNone(response.data['previous'])
+            seen += [meme['id'] for meme in response.data['results']]
+            next_url = response.data['next']
+
+        expected = list(Meme.objects.order_by('created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    # Test cursor pages neither skip nor repeat memes sharing a created_at, walking both ways
+    def test_cursor_pagination_created_at_ties(self):
+        for i in range(23):
+            Meme.objects.create(template=self.template1, top_text=f"Top {i}", created_by=self.user1)
+        Meme.objects.update(created_at=timezone.now())
+        expected = list(Meme.objects.order_by('id').values_list('id', flat=True))
+
+        pages, url = [], reverse('meme-list') + '?pagination=cursor'
+        while url:
+            response = self.client.get(url)
+            pages.append([meme['id'] for meme in response.data['results']])
+            url = response.data['next']
+        self.assertEqual(sum(pages, []), expected)
+
+        url = response.data['previous']
+        for page in reversed(pages[:-1]):
+            response = self.client.get(url)
+            self.assertEqual([meme['id'] for meme in response.data['results']], page)
+            url = response.data['previous']
+        self.assertIsNone(url)
+
+        response = self.client.get(reverse('meme-list'), {'cursor': 'bad!'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    # Test cursor pagination on the ratings list
+    def test_list_ratings_cursor_pagination(self):
+        self.rate_meme_for_test(self.meme1.id, 5, self.user1)
+        self.rate_meme_for_test(self.meme2.id, 4, self.user1)
+        response = self.client.get(reverse('rating-list'), {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['meme'] for r in response.data['results']], [self.meme1.id, self.meme2.id])
+        self.assertIsNone(response.data['next'])
+
+    # Test bulk creation from a JSON array with per-item errors and template default texts
+    def test_bulk_create_memes_json(self):
+        url = reverse('meme-bulk-create')
+        items = [
+            {'template': self.template1.id, 'top_text': 'Bulk top', 'bottom_text': 'Bulk bottom', 'created_by': self.user1.id},
+            {'template': 9999, 'created_by': self.user1.id},
+            {'template': self.template2.id, 'created_by': self.user2.id},
+            {'template': self.template1.id, 'created_by': 9999, 'top_text': 'A' * 101},
+            'not an object',
+        ]
+        response = APIClient().post(url, items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 3))
+
+        results = response.data['results']
+        self.assertEqual([result['index'] for result in results], [0, 1, 2, 3, 4])
+        self.assertIn('template', results[1]['errors'])
+        self.assertEqual(set(results[3]['errors']), {'top_text'})
+        self.assertIn('non_field_errors', results[4]['errors'])
+
+        meme = Meme.objects.get(pk=results[2]['id'])
+        self.assertEqual((meme.top_text, meme.bottom_text), ("Top Text 2", "Bottom Text 2"))
+        self.assertEqual(Meme.objects.get(pk=results[0]['id']).top_text, 'Bulk top')
+
+    # Test bulk creation from an NDJSON body, including an invalid line
+    def test_bulk_create_memes_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'template': self.template1.id, 'created_by': self.user1.id}),
+            '{not json',
+            '',
+            json.dumps({'template': self.template3.id, 'created_by': self.user3.id}),
+        ])
+        response = self.client.post(reverse('meme-bulk-create'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 1))
+        self.assertIn('line 2', response.data['results'][1]['errors']['non_field_errors'][0])
+        self.assertEqual(Meme.objects.count(), 5)
+
+    # Test that lines that are not UTF-8 and out-of-range ids are reported per item
+    def test_bulk_create_memes_bad_lines_and_ids(self):
+        body = b'\n'.join([
+            json.dumps({'template': self.template1.id, 'created_by': self.user1.id}).encode(),
+            b'{"template": "\xff\xfe"}',
+            json.dumps({'template': 2**64, 'created_by': self.user1.id}).encode(),
+            json.dumps({'template': self.template1.id, 'created_by': -2**64}).encode(),
+        ])
+        response = self.client.post(reverse('meme-bulk-create'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 3))
+        results = response.data['results']
+        self.assertIn('line 2', results[1]['errors']['non_field_errors'][0])
+        self.assertIn('template', results[2]['errors'])
+        self.assertIn('created_by', results[3]['errors'])
+
+        client = APIClient()
+        client.force_authenticate(self.user1)
+        response = client.post(reverse('rating-batch'), b'\xff\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)  # No valid item
+        self.assertIn('line 1', response.data['results'][0]['errors']['non_field_errors'][0])
+
+    # Test that lookups do not grow with the batch size and inserts are batched
+    def test_bulk_create_memes_query_count(self):
+        url = reverse('meme-bulk-create')
+        client = APIClient()
+        def batch(size):
+            return [{'template': self.template1.id, 'created_by': self.user1.id} for _ in range(size)]
+
+        with CaptureQueriesContext(connection) as small:
+            client.post(url, batch(5), format='json')
+        with CaptureQueriesContext(connection) as large:
+            response = client.post(url, batch(500), format='json')
+        self.assertEqual(response.data['created'], 500)
+
+        def count(queries, verb):
+            return sum(1 for query in queries if query['sql'].startswith(verb))
+        self.assertEqual(count(small, 'SELECT'), 2)  # Templates and users
+        self.assertEqual(count(large, 'SELECT'), 2)
+        self.assertLess(count(large, 'INSERT'), 10)  # SQLite caps rows per INSERT by its parameter limit
+
+    # Test that a batch with only invalid items is rejected
+    def test_bulk_create_memes_all_invalid(self):
+        response = APIClient().post(reverse('meme-bulk-create'), [{'template': 9999}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Meme.objects.count(), 3)
+
+    # Test batched rating: created, updated, superseded and invalid items, with aggregates
+    def test_rate_batch(self):
+        self.rate_meme_for_test(self.meme2.id, 1, self.user1)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=self.user1).key)
+        items = [
+            {'meme': self.meme1.id, 'rating': 2},
+            {'meme': self.meme2.id, 'rating': 5},
+            {'meme': self.meme1.id, 'rating': '4'},
+            {'meme': self.meme3.id, 'rating': 6},
+            {'meme': 9999, 'rating': 3},
+            {'meme': 2**64, 'rating': 3},
+        ]
+        response = client.post(reverse('rating-batch'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['rated'], response.data['failed']), (2, 3))
+
+        results = response.data['results']
+        self.assertEqual(results[0]['status'], 'superseded')
+        self.assertEqual(results[1]['status'], 'updated')
+        self.assertEqual((results[2]['status'], results[2]['rating']), ('created', 4))
+        self.assertIn('rating', results[3]['errors'])
+        self.assertIn('meme', results[4]['errors'])
+        self.assertIn('meme', results[5]['errors'])
+
+        self.meme1.refresh_from_db()
+        self.meme2.refresh_from_db()
+        self.assertEqual((self.meme1.rating_sum, self.meme1.rating_count), (4, 1))
+        self.assertEqual((self.meme2.rating_sum, self.meme2.rating_count), (5, 1))
+        self.assertEqual(Rating.objects.filter(user=self.user1).count(), 2)
+
+    # Test that a batch of ratings costs a fixed number of statements
+    def test_rate_batch_query_count(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=self.user1).key)
+        for i in range(30):
+            Meme.objects.create(template=self.template1, top_text=f"Top {i}", bottom_text=f"Bottom {i}", created_by=self.user2)
+        items = [{'meme': meme_id, 'rating': 3} for meme_id in Meme.objects.values_list('id', flat=True)]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(reverse('rating-batch'), items, format='json')
+        self.assertEqual(response.data['rated'], 33)
+        self.assertLessEqual(len([q for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]), 7)
+
+    # Test that aggregate and view count writes list memes in id order (a fixed lock order)
+    def test_meme_writes_in_id_order(self):
+        def written_ids(sql):
+            return [int(meme_id) for meme_id in re.findall(r'\((\d+), ', sql.split(' AS (VALUES ')[-1].split(' VALUES ')[-1])]
+
+        day = ratings.bucket_day(timezone.now())
+        deltas = {(meme.id, day): ratings.rating_delta(3, None) for meme in (self.meme3, self.meme1, self.meme2)}
+        with CaptureQueriesContext(connection) as queries:
+            ratings.apply_rating_deltas(deltas)
+        ids = sorted([self.meme1.id, self.meme2.id, self.meme3.id])
+        writes = [q['sql'] for q in queries if 'VALUES' in q['sql']]
+        self.assertEqual(len(writes), 3)  # Aggregates, buckets, window totals
+        for sql in writes:
+            self.assertEqual(written_ids(sql), ids, sql)
+
+        counters.discard()
+        for meme in (self.meme3, self.meme1, self.meme2):
+            counters.record_view(meme.id)
+        with CaptureQueriesContext(connection) as queries:
+            counters.flush()
+        self.assertEqual([written_ids(q['sql']) for q in queries if 'VALUES' in q['sql']], [ids])
+
+    # Test that batched rating requires authentication
+    def test_rate_batch_requires_authentication(self):
+        response = APIClient().post(reverse('rating-batch'), [{'meme': self.meme1.id, 'rating': 3}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    # Test that the template list is served from the cache until a template changes
+    def test_list_templates_cached(self):
+        url = reverse('template-list')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(len(json.loads(response.content)), 3)
+
+        MemeTemplate.objects.create(name="Template 4", image_url="https://example.com/template4.jpg")
+        self.assertEqual(len(self.client.get(url).data), 4)
+
+    # Test that rating a meme invalidates the cached leaderboard
+    def test_top_rated_memes_cache_invalidated_by_rating(self):
+        url = reverse('meme-get-top-rated-memes')
+        self.rate_meme_for_test(self.meme1.id, 3, self.user1)
+        self.assertEqual([m['id'] for m in self.client.get(url).data['data']], [self.meme1.id])
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        self.rate_meme_for_test(self.meme2.id, 5, self.user1)
+        self.assertEqual([m['id'] for m in self.client.get(url).data['data']], [self.meme2.id, self.meme1.id])
+
+    # Test that with a max staleness ratings do not invalidate the cached leaderboard
+    @override_settings(MEMES_LEADERBOARD_MAX_STALENESS=60)
+    def test_top_rated_memes_max_staleness(self):
+        url = reverse('meme-get-top-rated-memes')
+        self.assertEqual(len(self.client.get(url).data['data']), 0)
+        self.rate_meme_for_test(self.meme1.id, 4, self.user1)
+        self.assertEqual(len(self.client.get(url).data['data']), 0)  # Stale for up to 60 seconds
+
+
+    # Test for GET /api/memes/export/ (NDJSON stream of every meme)
+    def test_export_memes_ndjson(self):
+        response = self.client.get(reverse('meme-export'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.meme1.id, self.meme2.id, self.meme3.id])
+        self.assertEqual(rows[0]['top_text'], "Custom Top Text 1")
+        self.assertEqual(rows[0]['created_by_id'], self.user1.id)
+
+    # Test for GET /api/ratings/export/?type=csv&since=... (CSV stream of recent ratings)
+    def test_export_ratings_csv_since(self):
+        self.rate_meme_for_test(self.meme1.id, 3, self.user1)
+        self.rate_meme_for_test(self.meme2.id, 5, self.user2)
+        old = Rating.objects.get(meme=self.meme1)
+        Rating.objects.filter(pk=old.pk).update(created_at=old.created_at - timedelta(days=2))
+
+        since = (old.created_at - timedelta(days=1)).isoformat()
+        response = self.client.get(reverse('rating-export'), {'type': 'csv', 'since': since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['id', 'meme_id', 'user_id', 'score', 'created_at'])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][1:4], [str(self.meme2.id), str(self.user2.id), '5'])
+
+    # Test that an export with an unknown type or malformed since is rejected
+    def test_export_invalid_params(self):
+        self.assertEqual(self.client.get(reverse('meme-export'), {'type': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('rating-export'), {'since': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    # Test that the async read endpoints return the same bodies (links aside) and validators as the DRF views
+    def test_async_read_endpoints_match_sync(self):
+        self.rate_meme_for_test(self.meme1.id, 4, self.user1)
+        for i in range(12):
+            Meme.objects.create(template=self.template2, top_text=f"Top {i}", created_by=self.user2)
+        sparse = {'fields': 'id,top_text,template', 'expand': 'template'}
+        pairs = [
+            (reverse('template-list'), reverse('async-template-list'), {}),
+            (reverse('meme-list'), reverse('async-meme-list'), {}),
+            (reverse('meme-list'), reverse('async-meme-list'), {'page': 2, **sparse}),
+            (reverse('meme-list'), reverse('async-meme-list'), {'pagination': 'cursor', 'expand': 'created_by'}),
+            (reverse('meme-detail', args=[self.meme2.id]), reverse('async-meme-detail', args=[self.meme2.id]), {}),
+            (reverse('meme-detail', args=[self.meme2.id]), reverse('async-meme-detail', args=[self.meme2.id]), sparse),
+            (reverse('meme-get-top-rated-memes'), reverse('async-meme-top'), {}),
+        ]
+        for sync_url, async_url, params in pairs:
+            with self.subTest(url=async_url, params=params):
+                response = self.client.get(async_url, params)
+                sync_response = self.client.get(sync_url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response['Content-Type'], 'application/json')
+                self.assertEqual(json.loads(response.content.decode().replace('/api/async/', '/api/')),
+                                 json.loads(sync_response.content))
+                self.assertEqual(response.has_header('ETag'), sync_response.has_header('ETag'))
+                self.assertEqual(response.get('Last-Modified'), sync_response.get('Last-Modified'))
+                if response.has_header('ETag'):
+                    repeated = self.client.get(async_url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+                    self.assertEqual(repeated.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Following the async cursor links walks the same memes as the DRF ones
+        seen, url = [], reverse('async-meme-list') + '?pagination=cursor'
+        while url:
+            body = json.loads(self.client.get(url).content)
+            seen += [meme['id'] for meme in body['results']]
+            url = body['next']
+        self.assertEqual(seen, list(Meme.objects.order_by('created_at', 'id').values_list('id', flat=True)))
+        self.assertEqual(self.client.get(reverse('async-meme-list'), {'fields': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('async-meme-list'), {'cursor': 'bad!'}).status_code, 404)
+
+    # Test async meme list paging and missing memes
+    def test_async_meme_list_and_not_found(self):
+        for i in range(12):
+            Meme.objects.create(template=self.template1, created_by=self.user1)
+        first = json.loads(self.client.get(reverse('async-meme-list')).content)
+        self.assertEqual((first['count'], len(first['results'])), (15, 10))
+        second = json.loads(self.client.get(first['next']).content)
+        self.assertEqual(len(second['results']), 5)
+        self.assertIsNone(second['next'])
+        self.assertEqual(self.client.get(reverse('async-meme-list'), {'page': 99}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(reverse('async-meme-detail', args=[9999])).status_code, status.HTTP_404_NOT_FOUND)
+
+    # Test the async random meme endpoint
+    def test_async_random_meme(self):
+        response = self.client.get(reverse('async-meme-random'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(json.loads(response.content)['id'], [self.meme1.id, self.meme2.id, self.meme3.id])
+        Meme.objects.all().delete()
+        self.assertEqual(self.client.get(reverse('async-meme-random')).status_code, status.HTTP_404_NOT_FOUND)
+
+
+    # Test ?fields= trims the payload and the columns read from the database
+    def test_list_memes_sparse_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('meme-list'), {'fields': 'id,top_text'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0], {'id': self.meme1.id, 'top_text': "Custom Top Text 1"})
+        self.assertNotIn('bottom_text', queries.captured_queries[-1]['sql'])
+
+    # Test ?expand= inlines the template and author of every meme of a page in one query
+    def test_list_memes_expand(self):
+        for i in range(10):
+            Meme.objects.create(template=self.template2, created_by=self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('meme-list'), {'pagination': 'cursor', 'expand': 'template,created_by'})
+        first = response.data['results'][0]
+        self.assertEqual(first['template']['name'], "Template 1")
+        self.assertEqual(first['created_by'], {'id': self.user1.id, 'username': 'user1'})
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(reverse('meme-detail', args=[self.meme2.id]), {'fields': 'id,template', 'expand': 'template'})
+        self.assertEqual(response.data, {'id': self.meme2.id, 'template': {
+            'id': self.template2.id, 'name': "Template 2", 'image_url': "https://example.com/template2.jpg",
+            'default_top_text': "Top Text 2", 'default_bottom_text': "Bottom Text 2",
+        }})
+
+    # Test unknown fields or relations are rejected
+    def test_list_memes_invalid_fieldset(self):
+        self.assertEqual(self.client.get(reverse('meme-list'), {'fields': 'id,secret'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('meme-detail', args=[self.meme1.id]), {'expand': 'ratings'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    # Test conditional GET of a meme: 304 after one query, new validators once it changes
+    def test_retrieve_meme_conditional(self):
+        url = reverse('meme-detail', args=[self.meme1.id])
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.meme1.top_text = "Edited"
+        self.meme1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertNotEqual(self.client.get(url, {'fields': 'id'})['ETag'], response['ETag'])
+
+    # Test conditional GET of the template list: 304 without any query
+    def test_list_templates_conditional(self):
+        url = reverse('template-list')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        MemeTemplate.objects.create(name="Template 4", image_url="https://example.com/template4.jpg")
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    # Test that meme list pages carry an ETag that changes with the page
+    def test_list_memes_conditional(self):
+        url = reverse('meme-list')
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Meme.objects.create(template=self.template1, created_by=self.user1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+        self.assertNotIn('ETag', self.client.get(url, {'expand': 'created_by'}))
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        authentication.clear()
+        counters.discard()
+        self.user = User.objects.create_user(username='cached', password='password')
+        self.token = Token.objects.get(user=self.user)
+        self.auth = authentication.CachedTokenAuthentication()
+
+    # Test that a repeat lookup of the same token runs no query
+    def test_token_lookup_cached(self):
+        with self.assertNumQueries(1):
+            user, token = self.auth.authenticate_credentials(self.token.key)
+        hits = authentication.stats()['hits']
+        with self.assertNumQueries(0):
+            cached_user, cached_token = self.auth.authenticate_credentials(self.token.key)
+        self.assertEqual((cached_user.pk, cached_token.key), (self.user.pk, self.token.key))
+        self.assertIsNot(cached_user, user)
+        self.assertEqual(authentication.stats()['hits'], hits + 1)
+
+    # Test that unknown tokens are rejected every time and never cached
+    def test_invalid_token_not_cached(self):
+        for _ in range(2):
+            with self.assertNumQueries(1), self.assertRaises(AuthenticationFailed):
+                self.auth.authenticate_credentials('not-a-token')
+
+    # Test that deactivating the user drops the cached token
+    def test_deactivated_user_invalidated(self):
+        self.auth.authenticate_credentials(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.token.key)
+
+    # Test that logins (last_login saves) keep the cached token and other saves drop only the user's
+    def test_user_invalidation_by_index(self):
+        other = User.objects.create_user(username='other', password='password')
+        other_key = Token.objects.get(user=other).key
+        self.auth.authenticate_credentials(self.token.key)
+        self.auth.authenticate_credentials(other_key)
+
+        update_last_login(None, self.user)
+        self.assertIn(self.token.key, authentication._tokens)
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.assertNotIn(self.token.key, authentication._tokens)
+        self.assertIn(other_key, authentication._tokens)
+        self.assertNotIn(self.user.pk, authentication._user_keys)
+
+    # Test that the user index forgets evicted keys instead of growing past the cache
+    def test_user_index_pruned(self):
+        with patch.object(authentication, '_tokens', BoundedLRU(2)):
+            for user_id in range(10):
+                authentication._tokens.put(f'key{user_id}', None)
+                authentication._remember(user_id, f'key{user_id}')
+                self.assertLessEqual(len(authentication._user_keys), 4)
+            self.assertEqual(authentication._user_keys[9], {'key9'})
+
+    # Test that deleting the token drops the cached entry
+    def test_deleted_token_invalidated(self):
+        self.auth.authenticate_credentials(self.token.key)
+        self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.token.key)
+
+    # Test that cached entries expire after MEMES_AUTH_CACHE_TTL seconds
+    def test_cached_token_expires(self):
+        self.auth.authenticate_credentials(self.token.key)
+        later = time.monotonic() + authentication._tokens.ttl + 1
+        with patch('memes.lru.time.monotonic', return_value=later), self.assertNumQueries(1):
+            self.auth.authenticate_credentials(self.token.key)
+
+    # Test that the API authenticates through the cache
+    def test_api_uses_cached_authentication(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        meme = Meme.objects.create(
+            template=MemeTemplate.objects.create(name="Cached", image_url="https://example.com/cached.jpg"),
+            created_by=self.user,
+        )
+        client.get(reverse('meme-detail', args=[meme.id]))
+        with self.assertNumQueries(1):
+            response = client.get(reverse('meme-detail', args=[meme.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class RequestMetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        counters.discard()
+        self.user = User.objects.create_user(username='metrics', password='password')
+        template = MemeTemplate.objects.create(name="Metrics", image_url="https://example.com/metrics.jpg")
+        self.meme = Meme.objects.create(template=template, created_by=self.user)
+
+    # Test that requests are recorded per route with their query counts
+    def test_metrics_per_route(self):
+        self.client.get(reverse('meme-detail', args=[self.meme.id]))
+        self.client.get(reverse('meme-detail', args=[9999]))
+        self.client.get(reverse('async-meme-detail', args=[self.meme.id]))
+
+        stats = metrics.snapshot()
+        self.assertEqual(stats['meme-detail'].statuses, {200: 1, 404: 1})
+        self.assertEqual(stats['meme-detail'].queries, 2)  # One primary key lookup each
+        self.assertGreater(stats['meme-detail'].response_bytes, 0)
+        self.assertEqual(sum(stats['async-meme-detail'].buckets), 1)
+
+    # Test for GET /metrics (Prometheus text format)
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('meme-list'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE memes_http_request_duration_seconds histogram', body)
+        self.assertIn('memes_http_request_duration_seconds_bucket{route="meme-list",le="+Inf"} 1', body)
+        self.assertIn('memes_http_request_duration_seconds_count{route="meme-list"} 1', body)
+        self.assertIn('memes_http_requests_total{route="meme-list",status="200"} 1', body)
+        self.assertRegex(body, r'memes_db_queries_total\{route="meme-list"\} [1-9]')
+
+
+class ViewCounterTest(TestCase):
+    def setUp(self):
+        counters.discard()
+        user = User.objects.create_user(username='viewer', password='password')
+        template = MemeTemplate.objects.create(name="Views", image_url="https://example.com/views.jpg")
+        self.meme1 = Meme.objects.create(template=template, created_by=user)
+        self.meme2 = Meme.objects.create(template=template, created_by=user)
+
+    # Test that views are buffered and written in one statement
+    def test_views_buffered_and_flushed(self):
+        with self.assertNumQueries(3):  # The reads only
+            for _ in range(3):
+                self.client.get(reverse('meme-detail', args=[self.meme1.id]))
+        self.meme1.refresh_from_db()
+        self.assertEqual(self.meme1.view_count, 0)
+
+        counters.record_view(self.meme2.id)
+        updated_at = self.meme1.updated_at
+        self.assertEqual(counters.flush(), 4)
+        self.meme1.refresh_from_db()
+        self.meme2.refresh_from_db()
+        self.assertEqual((self.meme1.view_count, self.meme2.view_count), (3, 1))
+        self.assertEqual(self.meme1.updated_at, updated_at)
+        self.assertEqual(self.client.get(reverse('meme-detail', args=[self.meme1.id])).data['view_count'], 3)
+
+    # Test that flushed views do not invalidate a client's copy of the meme
+    def test_flushed_views_keep_validators(self):
+        url = reverse('meme-detail', args=[self.meme1.id])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(counters.flush(), 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    # Test that a full buffer is flushed by the view that fills it
+    @override_settings(MEMES_VIEW_COUNT_MAX_PENDING=3)
+    def test_views_flushed_when_buffer_full(self):
+        for _ in range(3):
+            counters.record_view(self.meme1.id)
+        self.meme1.refresh_from_db()
+        self.assertEqual(self.meme1.view_count, 3)
+
+    # Test that views older than the flush interval are written by the next view
+    @override_settings(MEMES_VIEW_COUNT_FLUSH_INTERVAL=0)
+    def test_views_flushed_after_interval(self):
+        self.client.get(reverse('meme-get-random-meme'))
+        self.assertEqual(sum(Meme.objects.values_list('view_count', flat=True)), 1)
+
+    # Test that views survive a failed flush
+    def test_views_kept_when_flush_fails(self):
+        counters.record_view(self.meme1.id)
+        with patch('memes.counters.transaction.atomic', side_effect=DatabaseError):
+            self.assertEqual(counters.flush(), 0)
+        self.assertEqual(counters.flush(), 1)
+        self.meme1.refresh_from_db()
+        self.assertEqual(self.meme1.view_count, 1)
+
+
+class AdminTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(self.admin)
+        self.template = MemeTemplate.objects.create(name="Admin", image_url="https://example.com/admin.jpg")
+
+    def add_memes(self, count):
+        users = User.objects.bulk_create([User(username=f'author{User.objects.count()}-{i}') for i in range(count)])
+        memes = Meme.objects.bulk_create([Meme(template=self.template, created_by=user) for user in users])
+        Rating.objects.bulk_create([Rating(meme=meme, user=user, score=3) for meme, user in zip(memes, users)])
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+            queries = len(captured)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return queries
+
+    # Test that the changelists run the same number of queries whatever the number of rows
+    def test_changelists_query_count_constant(self):
+        for name in ('admin:memes_meme_changelist', 'admin:memes_rating_changelist'):
+            with self.subTest(name):
+                self.add_memes(2)
+                few = self.changelist_queries(reverse(name))
+                self.add_memes(20)
+                self.assertEqual(self.changelist_queries(reverse(name)), few)
+
+    # Test that the change forms do not load every user and meme into dropdowns
+    def test_change_forms_use_raw_ids(self):
+        self.add_memes(1)
+        rating = Rating.objects.get()
+        response = self.client.get(reverse('admin:memes_meme_change', args=[rating.meme_id]))
+        self.assertNotContains(response, '<option value="%d"' % rating.user_id)
+        response = self.client.get(reverse('admin:memes_rating_add'))
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+
+    # Test that ratings saved in the admin update the meme aggregates
+    def test_rating_admin_updates_aggregates(self):
+        meme = Meme.objects.create(template=self.template, created_by=self.admin)
+        response = self.client.post(reverse('admin:memes_rating_add'), {'meme': meme.id, 'user': self.admin.id, 'score': 4})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        rating = Rating.objects.get()
+        self.client.post(reverse('admin:memes_rating_change', args=[rating.id]), {'score': 2})
+
+        meme.refresh_from_db()
+        self.assertEqual((meme.rating_sum, meme.rating_count, meme.rating_2), (2, 1, 1))
+
+    # Test that editing a meme leaves its aggregates alone
+    def test_meme_admin_saves_edited_fields_only(self):
+        meme = Meme.objects.create(template=self.template, created_by=self.admin, top_text='Old')
+        form = {'template': self.template.id, 'top_text': 'New', 'bottom_text': 'Bottom', 'created_by': self.admin.id}
+        save_form = MemeAdmin.save_form
+
+        def count_views_then_save_form(admin, *args, **kwargs):
+            Meme.objects.filter(pk=meme.pk).update(view_count=7)  # Flushed while the request runs
+            return save_form(admin, *args, **kwargs)
+
+        with patch.object(MemeAdmin, 'save_form', count_views_then_save_form):
+            response = self.client.post(reverse('admin:memes_meme_change', args=[meme.id]), form)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+        meme.refresh_from_db()
+        self.assertEqual((meme.top_text, meme.view_count), ('New', 7))
+
+    # Test that large unfiltered changelists use the row estimate and filtered ones count
+    @override_settings(MEMES_ADMIN_ESTIMATED_COUNT_THRESHOLD=1000)
+    def test_estimated_count_paginator(self):
+        self.add_memes(3)
+        with patch.object(EstimatedCountPaginator, '_estimated_count', return_value=250000):
+            self.assertEqual(EstimatedCountPaginator(Meme.objects.order_by('pk'), 100).count, 250000)
+            self.assertEqual(EstimatedCountPaginator(Meme.objects.filter(top_text='Missing').order_by('pk'), 100).count, 0)
+        with patch.object(EstimatedCountPaginator, '_estimated_count', return_value=10):
+            self.assertEqual(EstimatedCountPaginator(Meme.objects.order_by('pk'), 100).count, 3)
+
+
+class ProvisioningTest(TestCase):
+    def write(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    # Test that users are created with tokens from a CSV file, and bad rows are skipped
+    def test_provision_users_command_csv(self):
+        User.objects.create_user(username='taken')
+        path = self.write('users.csv', (
+            'username,email,password,password_hash\n'
+            'alice,alice@example.com,secret-a,\n'
+            f'bob,,,{make_password("secret-b")}\n'
+            'carol,,,\n'
+            'alice,,again,\n'
+            'taken,,,\n'
+            'bad name!,,,\n'
+            'dave,not-an-email,,\n'
+        ))
+        tokens_out = os.path.join(os.path.dirname(path), 'tokens.csv')
+        stderr = StringIO()
+        call_command('provision_users', path, '--workers', '0', '--tokens-out', tokens_out,
+                     stdout=StringIO(), stderr=stderr)
+
+        users = {user.username: user for user in User.objects.filter(username__in=['alice', 'bob', 'carol'])}
+        self.assertEqual(len(users), 3)
+        self.assertTrue(users['alice'].check_password('secret-a'))
+        self.assertEqual(users['alice'].email, 'alice@example.com')
+        self.assertTrue(users['bob'].check_password('secret-b'))
+        self.assertFalse(users['carol'].has_usable_password())
+        self.assertFalse(User.objects.filter(username__in=['bad name!', 'dave']).exists())
+        self.assertEqual(User.objects.filter(username='alice').count(), 1)
+        self.assertEqual([line.split(' ')[1] for line in stderr.getvalue().splitlines()],
+                         ['5', '6', '7', '8'])
+
+        with open(tokens_out) as f:
+            tokens = dict(list(csv.reader(f))[1:])
+        self.assertEqual(tokens, dict(Token.objects.filter(user__in=users.values()).values_list('user__username', 'key')))
+        response = self.client.get(reverse('meme-list'), HTTP_AUTHORIZATION=f"Token {tokens['carol']}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    # Test JSONL input, in chunks smaller than the input
+    def test_provision_users_jsonl_chunks(self):
+        lines = [json.dumps({'username': f'user{i}', 'first_name': f'First {i}'}) for i in range(7)]
+        records = provisioning.read_records(StringIO('\n'.join(lines + ['{oops', '[1]'])), 'jsonl')
+        # Per chunk of 2: existing usernames lookup, then savepoint, users, tokens, release
+        with self.assertNumQueries(4 * 5):
+            result = provisioning.provision_users(records, workers=0, batch_size=2)
+        self.assertEqual(result['created'], 7)
+        self.assertEqual([error['line'] for error in result['errors']], [8, 9])
+        self.assertEqual(Token.objects.filter(user__username__startswith='user').count(), 7)
+        self.assertEqual(User.objects.get(username='user3').first_name, 'First 3')
+
+    # Test that non-string fields are reported per record instead of failing the validators
+    def test_provision_users_rejects_non_strings(self):
+        records = [{'username': 'abc', 'email': 5}, {'username': 7}, {'username': 'ok', 'password': None}]
+        result = provisioning.provision_users(list(enumerate(records, 1)), workers=0)
+        self.assertEqual(result['created'], 0)
+        self.assertEqual([error['error'] for error in result['errors']], ['Every field must be a string.'] * 3)
+
+    # Test that passwords hashed in worker processes are usable
+    def test_hash_passwords_in_workers(self):
+        hashed = provisioning.hash_passwords(['first', 'second'], workers=1)
+        self.assertTrue(check_password('first', hashed[0]))
+        self.assertTrue(check_password('second', hashed[1]))
+
+
+class FeedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='swiper', password='password')
+        self.other = User.objects.create_user(username='other', password='password')
+        template = MemeTemplate.objects.create(name="Feed", image_url="https://example.com/feed.jpg")
+        self.memes = [Meme.objects.create(template=template, created_by=self.other, top_text=f'Feed {i}')
+                      for i in range(30)]
+        self.rated = {meme.id for meme in self.memes[::3]}
+        for meme_id in self.rated:
+            ratings.rate_meme(meme_id, self.user, 4)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, **params):
+        response = self.client.get(reverse('meme-feed'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [meme['id'] for meme in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [meme['id'] for meme in response.data['results']]
+        return ids
+
+    # Test that the feed pages through the unrated memes, newest first, without joining ratings
+    def test_feed_excludes_rated_memes(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('meme-feed'), {'page_size': 5})
+            queries = [query['sql'] for query in captured.captured_queries]
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertFalse(any('JOIN "memes_rating"' in sql for sql in queries))
+
+        expected = [meme.id for meme in reversed(self.memes) if meme.id not in self.rated]
+        self.assertEqual(self.walk(page_size=5), expected)
+        self.assertEqual(self.walk(page_size=100), expected)
+
+    # Test that ratings update the cached seen-set
+    def test_rating_marks_meme_seen(self):
+        feed.seen_ids(self.user.id)
+        newest = self.memes[-1]
+        with self.captureOnCommitCallbacks(execute=True):
+            ratings.rate_meme(newest.id, self.user, 5)
+        self.assertIn(newest.id, feed.seen_ids(self.user.id))
+        self.assertNotIn(newest.id, self.walk())
+
+        Rating.objects.get(user=self.user, meme=newest).delete()
+        self.assertIn(newest.id, self.walk())
+
+    # Test that a stale or truncated seen-set never lets a rated meme through
+    @override_settings(MEMES_FEED_SEEN_MAX_IDS=3)
+    def test_seen_set_is_only_a_hint(self):
+        self.assertEqual(list(feed.seen_ids(self.user.id)), sorted(self.rated)[-3:])
+        Rating.objects.create(user=self.user, meme=self.memes[-2], score=1)  # Not marked as seen
+
+        expected = [meme.id for meme in reversed(self.memes) if meme.id not in self.rated | {self.memes[-2].id}]
+        self.assertEqual(self.walk(page_size=4), expected)
+
+    # Test the popularity ordering
+    def test_feed_popular_order(self):
+        for meme in self.memes[1:3]:
+            ratings.rate_meme(meme.id, self.other, 5)
+        ratings.rate_meme(self.memes[2].id, User.objects.create_user(username='third'), 5)
+
+        ids = self.walk(order='popular', page_size=3)
+        self.assertEqual(ids[:2], [self.memes[2].id, self.memes[1].id])
+        self.assertEqual(sorted(ids), sorted(meme.id for meme in self.memes if meme.id not in self.rated))
+
+    # Test that invalid parameters are rejected and the feed needs a user
+    def test_feed_invalid_requests(self):
+        for params in ({'order': 'random'}, {'page_size': 0}, {'page_size': 'ten'}, {'cursor': 'bad!'},
+                       {'order': 'popular', 'cursor': feed.encode_cursor((7,))}):
+            response = self.client.get(reverse('meme-feed'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('meme-feed')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+# Test the caption search endpoint (in-process index on SQLite, GIN indexes on PostgreSQL)
+class SearchTest(TestCase):
+    def setUp(self):
+        search.reset()
+        self.user = User.objects.create_user(username='seeker', password='password')
+        self.template = MemeTemplate.objects.create(name="Cat", image_url="https://example.com/cat.jpg")
+        self.other_template = MemeTemplate.objects.create(name="Dog", image_url="https://example.com/dog.jpg")
+        captions = [
+            (self.template, 'grumpy cat', 'cat says no'),
+            (self.template, 'cat cat cat', 'so many cats'),
+            (self.other_template, 'dog meets cat', 'chaos follows'),
+            (self.other_template, 'such wow', 'very doge'),
+        ]
+        self.memes = [Meme.objects.create(template=template, created_by=self.user, top_text=top_text,
+                                          bottom_text=bottom_text)
+                      for template, top_text, bottom_text in captions]
+        self.client = APIClient()
+
+    def ids(self, **params):
+        response = self.client.get(reverse('meme-search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [meme['id'] for meme in response.data['results']]
+
+    # Test that every query word must match and that better matches come first
+    def test_search_ranks_matches(self):
+        grumpy, many, dog, doge = self.memes
+        self.assertEqual(self.ids(q='cat'), [many.id, grumpy.id, dog.id])
+        self.assertEqual(self.ids(q='cat dog'), [dog.id])
+        self.assertEqual(self.ids(q='WOW'), [doge.id])
+        self.assertEqual(self.ids(q='giraffe'), [])
+
+    # Test that a misspelled word matches the closest caption words
+    def test_search_fuzzy(self):
+        if connection.vendor == 'postgresql' and not search.has_trigrams():
+            self.skipTest('pg_trgm is not installed')
+        self.assertEqual(self.ids(q='grumpi'), [self.memes[0].id])
+        self.assertEqual(self.ids(q='grumpi cat'), [self.memes[0].id])
+
+    # Test the ?template= filter
+    def test_search_by_template(self):
+        self.assertEqual(self.ids(q='cat', template=self.other_template.id), [self.memes[2].id])
+        self.assertEqual(self.ids(q='doge', template=self.template.id), [])
+
+    # Test that results are paged with a next link
+    def test_search_pages(self):
+        response = self.client.get(reverse('meme-search'), {'q': 'cat', 'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.client.get(response.data['next'])
+        self.assertEqual([meme['id'] for meme in response.data['results']], [self.memes[2].id])
+        self.assertIsNone(response.data['next'])
+
+    # Test that created, edited and deleted memes are reflected in the results
+    def test_search_follows_changes(self):
+        self.assertEqual(self.ids(q='wow'), [self.memes[3].id])
+        index = search.fallback_index() if connection.vendor != 'postgresql' else None
+        with self.captureOnCommitCallbacks(execute=True):
+            new = Meme.objects.create(template=self.template, created_by=self.user, top_text='wow again', bottom_text='')
+        self.assertCountEqual(self.ids(q='wow'), [new.id, self.memes[3].id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.memes[3].top_text = 'such calm'
+            self.memes[3].save()
+        self.assertEqual(self.ids(q='wow'), [new.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            new.delete()
+        self.assertEqual(self.ids(q='wow'), [])
+        if index is not None:
+            # Only the changed memes were reindexed
+            self.assertIs(search.fallback_index(), index)
+
+    # Test that captions edited without signals (another process, queryset updates) are found
+    @patch.object(search, 'RECHECK_INTERVAL', 0)
+    def test_search_finds_edits_from_other_processes(self):
+        self.assertEqual(self.ids(q='wow'), [self.memes[3].id])
+        Meme.objects.filter(pk=self.memes[0].pk).update(top_text='wow', updated_at=timezone.now() + timedelta(seconds=1))
+        self.assertEqual(sorted(self.ids(q='wow')), [self.memes[0].id, self.memes[3].id])
+
+    # Test that invalid parameters are rejected
+    def test_search_invalid_parameters(self):
+        for params in ({}, {'q': '   '}, {'q': 'x' * 201}, {'q': 'cat', 'page': 0}, {'q': 'cat', 'page_size': 101},
+                       {'q': 'cat', 'template': 'cat'}, {'q': 'cat', 'page': 'two'}):
+            with self.subTest(params):
+                response = self.client.get(reverse('meme-search'), params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('error', response.data)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = User.objects.bulk_create([User(username=f'rater{i}') for i in range(20)])
+        template = MemeTemplate.objects.create(name="Ranks", image_url="https://example.com/ranks.jpg")
+        self.one_vote, self.popular, self.disliked = [
+            Meme.objects.create(template=template, created_by=self.users[0]) for _ in range(3)
+        ]
+        ratings.rate_meme(self.one_vote.id, self.users[0], 5)
+        for i, user in enumerate(self.users):
+            ratings.rate_meme(self.popular.id, user, 5 if i % 2 else 4)  # Average 4.5
+        for user in self.users[:2]:
+            ratings.rate_meme(self.disliked.id, user, 1)
+        self.today = ratings.bucket_day(timezone.now())
+
+    def top(self, **params):
+        response = self.client.get(reverse('meme-get-top-rated-memes'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [meme['id'] for meme in response.data['data']]
+
+    # Test that each rank orders the memes by its own measure
+    def test_ranks(self):
+        self.assertEqual(self.top(), [self.one_vote.id, self.popular.id, self.disliked.id])
+        self.assertEqual(self.top(rank='bayes'), [self.popular.id, self.one_vote.id, self.disliked.id])
+        self.assertEqual(self.top(rank='count'), [self.popular.id, self.disliked.id, self.one_vote.id])
+
+        self.popular.refresh_from_db()
+        self.assertAlmostEqual(self.popular.rating_bayes, (3.0 * 10 + 90) / (10 + 20))
+
+    # Test that windowed leaderboards only count the ratings cast within the window
+    def test_windows(self):
+        MemeRatingBucket.objects.filter(meme=self.popular).update(day=self.today - timedelta(days=3))
+        self.assertEqual(self.top(window='day', rank='count'), [self.disliked.id, self.one_vote.id])
+        self.assertEqual(self.top(window='week', rank='count'), [self.popular.id, self.disliked.id, self.one_vote.id])
+        self.assertEqual(self.top(window='week', rank='bayes'), [self.popular.id, self.one_vote.id, self.disliked.id])
+        self.assertEqual(self.top(window='week'), self.top(window='all'))
+
+        # The async endpoint serves the same body
+        response = self.client.get(reverse('async-meme-top'), {'window': 'day', 'rank': 'count'})
+        self.assertEqual([meme['id'] for meme in response.json()['data']], [self.disliked.id, self.one_vote.id])
+
+    # Test that window totals follow rating writes once built and are summed again when the day changes
+    def test_window_totals_follow_writes_and_days(self):
+        self.assertEqual(self.top(window='day', rank='count'), [self.popular.id, self.disliked.id, self.one_vote.id])
+        for user in self.users[1:4]:
+            ratings.rate_meme(self.one_vote.id, user, 1)
+        self.assertEqual(self.top(window='day', rank='count'), [self.popular.id, self.one_vote.id, self.disliked.id])
+        totals = MemeRatingWindow.objects.get(window='day', meme=self.one_vote)
+        self.assertEqual((totals.rating_sum, totals.rating_count), (8, 4))
+        self.assertAlmostEqual(totals.rating_avg, 2.0)
+        self.assertAlmostEqual(totals.rating_bayes, (3.0 * 10 + 8) / (10 + 4))
+
+        # Tomorrow today's ratings are out of the day window and still in the week window
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch('django.utils.timezone.now', return_value=tomorrow):
+            cache.clear()
+            self.assertEqual(self.top(window='day', rank='count'), [])
+            self.assertEqual(self.top(window='week', rank='count'), [self.popular.id, self.one_vote.id, self.disliked.id])
+        self.assertEqual(RatingWindow.objects.get(name='day').start, ratings.bucket_day(tomorrow))
+
+    # Test that changed and deleted ratings update the bucket of the day they were cast
+    def test_buckets_follow_rating_day(self):
+        old = timezone.now() - timedelta(days=3)
+        Rating.objects.filter(meme=self.one_vote).update(created_at=old)
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+
+        ratings.rate_meme(self.one_vote.id, self.users[0], 2)
+        self.assertEqual(list(MemeRatingBucket.objects.filter(meme=self.one_vote).values_list('day', 'rating_sum', 'rating_count')),
+                         [(ratings.bucket_day(old), 2, 1)])
+        self.assertEqual(self.top(window='day', rank='count'), [self.popular.id, self.disliked.id])
+
+        Rating.objects.get(meme=self.one_vote).delete()
+        self.assertEqual(MemeRatingBucket.objects.get(meme=self.one_vote).rating_count, 0)
+        self.one_vote.refresh_from_db()
+        self.assertIsNone(self.one_vote.rating_bayes)
+
+    # Test that invalid leaderboard parameters are rejected
+    def test_invalid_parameters(self):
+        for params in ({'window': 'month'}, {'rank': 'median'}):
+            response = self.client.get(reverse('meme-get-top-rated-memes'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('error', response.data)
+        self.assertEqual(self.client.get(reverse('async-meme-top'), {'window': 'month'}).status_code, 400)
+
+    # Test that compaction drops expired, emptied and orphaned buckets only
+    @override_settings(MEMES_LEADERBOARD_BUCKET_DAYS=8)
+    def test_compact_rating_buckets_command(self):
+        MemeRatingBucket.objects.filter(meme=self.popular).update(day=self.today - timedelta(days=8))
+        Rating.objects.filter(meme=self.one_vote).delete()
+        MemeRatingBucket.objects.create(meme_id=self.disliked.id + 100, day=self.today, rating_sum=3, rating_count=1)
+
+        version = caching.get_version(caching.LEADERBOARD)
+        call_command('compact_rating_buckets', stdout=StringIO())
+        self.assertNotEqual(caching.get_version(caching.LEADERBOARD), version)
+
+        self.assertEqual(list(MemeRatingBucket.objects.values_list('meme', 'day', 'rating_count')),
+                         [(self.disliked.id, self.today, 2)])
+
+    # Test that the rebuild command repairs drifted buckets and Bayesian averages
+    def test_rebuild_repairs_leaderboards(self):
+        MemeRatingBucket.objects.all().delete()
+        Meme.objects.update(rating_bayes=None)
+
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+
+        self.assertEqual(self.top(window='day', rank='bayes'), [self.popular.id, self.one_vote.id, self.disliked.id])
+        self.assertEqual(MemeRatingBucket.objects.get(meme=self.popular).rating_sum, 90)
+
+
+class RandomMemeSamplingTest(TestCase):
+    def setUp(self):
+        sampling.weighted.reset()
+        self.user = User.objects.create_user(username='sampler', password='password')
+        self.template = MemeTemplate.objects.create(name="Template", image_url="https://example.com/t.jpg")
+        self.memes = [
+            Meme.objects.create(template=self.template, top_text=f"Top {i}", bottom_text=f"Bottom {i}", created_by=self.user)
+            for i in range(30)
+        ]
+
+    # Test that picks are uniform over existing memes even with gaps in the id space
+    def test_random_meme_is_uniform_with_gaps(self):
+        for meme in self.memes[::3]:
+            meme.delete()
+        remaining = {meme.id for meme in self.memes[1::3] + self.memes[2::3]}
+
+        random.seed(1234)
+        draws = 4000
+        counts = Counter(sampling.random_meme().id for _ in range(draws))
+        self.assertEqual(set(counts), remaining)
+
+        # Pearson chi-square against the uniform distribution, 19 degrees of freedom
+        expected = draws / len(remaining)
+        chi_square = sum((counts[meme_id] - expected) ** 2 / expected for meme_id in remaining)
+        self.assertLess(chi_square, 43.82)  # Critical value at p = 0.001
+
+    # Test that a very sparse id space still returns an existing meme
+    def test_random_meme_sparse_ids(self):
+        keep = {self.memes[0].id, self.memes[-1].id}
+        Meme.objects.exclude(id__in=keep).delete()
+
+        random.seed(42)
+        for _ in range(50):
+            self.assertIn(sampling.random_meme().id, keep)
+
+    # Test that an empty table returns None
+    def test_random_meme_empty(self):
+        Meme.objects.all().delete()
+        self.assertIsNone(sampling.random_meme())
+
+
+    # Test that alias table picks follow the weights
+    def test_alias_table_matches_weights(self):
+        weights = [1, 2, 3, 4, 10, 0.5]
+        table = sampling.AliasTable(range(len(weights)), weights)
+        random.seed(99)
+        draws = 20000
+        counts = Counter(table.sample() for _ in range(draws))
+
+        # Pearson chi-square against the weights, 5 degrees of freedom
+        total = sum(weights)
+        chi_square = sum((counts[i] - draws * weight / total) ** 2 / (draws * weight / total)
+                         for i, weight in enumerate(weights))
+        self.assertLess(chi_square, 20.52)  # Critical value at p = 0.001
+
+    # Test that weighted picks follow the smoothed ratings of the memes
+    def test_weighted_random_meme_matches_ratings(self):
+        for meme, bayes in zip(self.memes, [4.8, 4.5, 1.2, 2.0, 3.9]):
+            Meme.objects.filter(pk=meme.pk).update(rating_bayes=bayes)
+        weights = dict(Meme.objects.values_list('pk', 'rating_bayes'))
+        weights = {meme_id: 3.0 if bayes is None else bayes for meme_id, bayes in weights.items()}
+
+        random.seed(7)
+        draws = 6000
+        counts = Counter(sampling.weighted_random_meme().id for _ in range(draws))
+        total = sum(weights.values())
+        chi_square = sum((counts[meme_id] - draws * weight / total) ** 2 / (draws * weight / total)
+                         for meme_id, weight in weights.items())
+        self.assertLess(chi_square, 58.30)  # 29 degrees of freedom, p = 0.001
+        self.assertGreater(counts[self.memes[0].id], counts[self.memes[2].id])
+
+    # Test that memes deleted after the table was built are never returned
+    def test_weighted_random_meme_skips_deleted(self):
+        sampling.weighted.rebuild()
+        Meme.objects.exclude(pk=self.memes[4].pk).delete()
+        random.seed(3)
+        for _ in range(20):
+            self.assertEqual(sampling.weighted_random_meme().id, self.memes[4].id)
+        Meme.objects.all().delete()
+        self.assertIsNone(sampling.weighted_random_meme())
+
+    # Test that a rating change rebuilds the table in the background, once at a time
+    @override_settings(MEMES_WEIGHTED_RANDOM_MIN_INTERVAL=0)
+    def test_weighted_table_rebuilt_when_ratings_change(self):
+        table = sampling.weighted.table()
+        with patch.object(sampling.weighted, '_start_background_rebuild') as start:
+            self.assertIs(sampling.weighted.table(), table)
+            start.assert_not_called()
+            ratings.rate_meme(self.memes[0].id, self.user, 5)
+            self.assertIs(sampling.weighted.table(), table)  # The old table serves meanwhile
+            self.assertIs(sampling.weighted.table(), table)
+            start.assert_called_once()
+
+    # Test the ?weighted= parameter of the random endpoints
+    def test_weighted_parameter(self):
+        for name in ('meme-get-random-meme', 'meme-surprise-me'):
+            self.assertEqual(self.client.get(reverse(name), {'weighted': 'rating'}).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(reverse(name), {'weighted': 'views'}).status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+# Small generated PNG used in place of remote template images
+def make_png(size=(120, 80), color=(30, 90, 160)):
+    output = BytesIO()
+    Image.new('RGB', size, color).save(output, 'PNG')
+    return output.getvalue()
+
+
+class MemeImageRenderingTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        settings_override = override_settings(
+            MEMES_RENDER_CACHE_DIR=self.cache_dir,
+            MEMES_TEMPLATE_ASSET_DIR=os.path.join(self.cache_dir, 'assets'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        download = patch('memes.assets.download', return_value=make_png())
+        download.start()
+        self.addCleanup(download.stop)
+
+        user = User.objects.create_user(username='renderer', password='password')
+        template = MemeTemplate.objects.create(name="Template", image_url="https://example.com/t.png")
+        self.meme = Meme.objects.create(template=template, top_text="Top", bottom_text="Bottom", created_by=user)
+
+    # Test that the first request renders and the second is served from the cache
+    def test_render_image_cached(self):
+        url = reverse('meme-render-image', args=[self.meme.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['X-Render-Cache'], 'miss')
+        image = Image.open(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(image.size, (120, 80))
+
+        with patch('memes.rendering.render_meme') as render:
+            response = self.client.get(url)
+            self.assertEqual(response['X-Render-Cache'], 'hit')
+            self.assertTrue(b''.join(response.streaming_content))
+            render.assert_not_called()
+
+        stats = self.client.get(reverse('meme-render-cache-stats')).data
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    # Test that a different size or format is a different cache entry
+    def test_render_image_width_and_type(self):
+        url = reverse('meme-render-image', args=[self.meme.id])
+        response = self.client.get(url, {'width': 60, 'type': 'jpeg'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).size, (60, 40))
+
+        self.assertEqual(self.client.get(url, {'type': 'gif'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'width': 0}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Test that the cache evicts the least recently used renders once it is over its byte budget
+    def test_render_cache_lru_eviction(self):
+        cache = rendering.RenderCache(self.cache_dir, max_bytes=25)
+        cache.put('a', b'x' * 10)
+        cache.put('b', b'x' * 10)
+        self.assertIsNotNone(cache.get('a'))  # 'a' becomes the most recently used
+        cache.put('c', b'x' * 10)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+# Stub image server for template downloads: serves make_png() images and a non-image page
+class StubImageHandler(BaseHTTPRequestHandler):
+    pages = {
+        '/small.png': ('image/png', make_png((120, 80))),
+        '/large.png': ('image/png', make_png((2048, 1024))),
+        '/page.html': ('text/html', b'<html>not an image</html>'),
+    }
+    redirects = {'/moved.png': '/small.png'}
+    requests_served = 0
+    last_host = None
+
+    def do_GET(self):
+        StubImageHandler.requests_served += 1
+        StubImageHandler.last_host = self.headers.get('Host')
+        if self.path in self.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.redirects[self.path])
+            self.end_headers()
+            return
+        if self.path not in self.pages:
+            self.send_error(404)
+            return
+        content_type, body = self.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TemplateAssetStoreTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.asset_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.asset_dir, ignore_errors=True)
+        # The stub server listens on a loopback address
+        settings_override = override_settings(MEMES_TEMPLATE_ASSET_DIR=self.asset_dir, MEMES_TEMPLATE_ALLOW_PRIVATE_URLS=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        assets._decoded.clear()
+
+    # Test that ingesting stores a normalized PNG and records checksum and dimensions
+    def test_ingest_template(self):
+        template = MemeTemplate.objects.create(name="Large", image_url=f"{self.base_url}/large.png")
+        assets.ingest_template(template)
+
+        template.refresh_from_db()
+        self.assertEqual(len(template.image_checksum), 64)
+        self.assertEqual((template.image_width, template.image_height), (1024, 512))  # Fitted into 1024x1024
+        with Image.open(assets.asset_path(template.image_checksum)) as stored:
+            self.assertEqual((stored.format, stored.mode, stored.size), ('PNG', 'RGB', (1024, 512)))
+
+    # Test that a non-image URL is rejected and nothing is recorded
+    def test_ingest_template_invalid_image(self):
+        template = MemeTemplate.objects.create(name="Page", image_url=f"{self.base_url}/page.html")
+        with self.assertRaises(assets.AssetError):
+            assets.ingest_template(template)
+        template.refresh_from_db()
+        self.assertEqual(template.image_checksum, '')
+
+    # Test that loopback, private, non-http and other port URLs are refused before any request is made
+    @override_settings(MEMES_TEMPLATE_ALLOW_PRIVATE_URLS=False)
+    def test_download_refuses_non_public_hosts(self):
+        served = StubImageHandler.requests_served
+        for url in (f'{self.base_url}/small.png', 'http://localhost/a.png', 'http://10.1.2.3/a.png',
+                    'http://169.254.169.254/latest/meta-data/', 'http://[::ffff:127.0.0.1]/a.png', 'file:///etc/passwd',
+                    'http://example.com:8080/a.png'):
+            with self.subTest(url), self.assertRaises(assets.AssetError):
+                assets.download(url)
+        self.assertEqual(StubImageHandler.requests_served, served)
+
+    # Test that the host is resolved once and the download connects to the checked address with
+    # the original Host header, whatever the host resolves to next (DNS rebinding)
+    @override_settings(MEMES_TEMPLATE_ALLOW_PRIVATE_URLS=False)
+    def test_download_connects_to_checked_address(self):
+        port = self.server.server_address[1]
+        real_getaddrinfo = socket.getaddrinfo
+        lookups = []
+
+        def getaddrinfo(host, *args, **kwargs):
+            if host == 'images.example':
+                lookups.append(host)
+                if len(lookups) > 1:
+                    raise socket.gaierror('resolved again')
+                host = '127.0.0.1'
+            return real_getaddrinfo(host, *args, **kwargs)
+
+        # The stub server stands in for a public host
+        with patch('socket.getaddrinfo', getaddrinfo), patch.object(assets, 'ALLOWED_PORTS', (port,)), \
+                patch.object(assets, '_is_public', return_value=True):
+            data = assets.download(f'http://images.example:{port}/small.png')
+        self.assertEqual(data, StubImageHandler.pages['/small.png'][1])
+        self.assertEqual(lookups, ['images.example'])
+        self.assertEqual(StubImageHandler.last_host, f'images.example:{port}')
+
+    # Test that redirects are not followed
+    def test_download_refuses_redirects(self):
+        served = StubImageHandler.requests_served
+        with self.assertRaisesMessage(assets.AssetError, 'redirects to /small.png'):
+            assets.download(f'{self.base_url}/moved.png')
+        self.assertEqual(StubImageHandler.requests_served, served + 1)
+
+    # Test that changing image_url replaces the stored image, and other changes keep it
+    def test_update_template_image_url(self):
+        template = MemeTemplate.objects.create(name="Small", image_url=f"{self.base_url}/small.png")
+        assets.ingest_template(template)
+        url = reverse('template-detail', args=[template.id])
+
+        old_checksum = template.image_checksum
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(url, {'name': 'Renamed'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        template.refresh_from_db()
+        self.assertEqual((template.image_checksum, template.image_width, template.image_height), (old_checksum, 120, 80))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(url, {'image_url': f'{self.base_url}/large.png'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        template.refresh_from_db()
+        self.assertNotEqual(template.image_checksum, old_checksum)
+        self.assertEqual((template.image_width, template.image_height), (1024, 512))
+
+    # Test that a template image is downloaded once and then served from memory
+    def test_load_image_fetches_once(self):
+        template = MemeTemplate.objects.create(name="Small", image_url=f"{self.base_url}/small.png")
+        served = StubImageHandler.requests_served
+        first = assets.load_image(template)
+        second = assets.load_image(MemeTemplate.objects.get(pk=template.pk))
+        self.assertIs(first, second)
+        self.assertEqual(first.size, (120, 80))
+        self.assertEqual(StubImageHandler.requests_served, served + 1)
+
+    # Test the backfill command ingests pending templates and reports failures
+    def test_ingest_template_assets_command(self):
+        good = MemeTemplate.objects.create(name="Small", image_url=f"{self.base_url}/small.png")
+        MemeTemplate.objects.create(name="Missing", image_url=f"{self.base_url}/missing.png")
+        out, err = StringIO(), StringIO()
+        call_command('ingest_template_assets', stdout=out, stderr=err)
+
+        good.refresh_from_db()
+        self.assertTrue(good.image_checksum)
+        self.assertIn('Ingested 1 template images, 1 failed.', out.getvalue())
+        self.assertIn('missing.png', err.getvalue())
+
+
+class ConcurrentRatingTest(TransactionTestCase):
+    THREADS = 8
+    USERS = 4
+    ROUNDS = 5
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'voter{i}', password='password') for i in range(self.USERS)]
+        template = MemeTemplate.objects.create(name="Template", image_url="https://example.com/t.jpg")
+        self.meme = Meme.objects.create(template=template, top_text="Top", bottom_text="Bottom", created_by=self.users[0])
+
+    # Test many threads rating one meme at once (first ratings and updates racing) without errors
+    def test_concurrent_rate_meme(self):
+        url = reverse('meme-rate-meme', args=[self.meme.id])
+        tokens = [Token.objects.get(user=user).key for user in self.users]
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        # Shared-cache in-memory SQLite fails concurrent writers instead of making them wait:
+        # there the requests take turns (still from many threads and connections), elsewhere
+        # they race
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            turns = threading.Lock()
+        else:
+            turns = contextlib.nullcontext()
+
+        def hammer(thread_index):
+            client = APIClient()
+            try:
+                barrier.wait()
+                for round_index in range(self.ROUNDS):
+                    user_index = (thread_index + round_index) % self.USERS
+                    client.credentials(HTTP_AUTHORIZATION='Token ' + tokens[user_index])
+                    with turns:
+                        response = client.post(url, {'rating': 1 + (thread_index + round_index) % 5}, format='json')
+                    if response.status_code != status.HTTP_200_OK:
+                        errors.append(response.status_code)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=hammer, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Rating.objects.filter(meme=self.meme).count(), self.USERS)
+        self.meme.refresh_from_db()
+        scores = list(Rating.objects.filter(meme=self.meme).values_list('score', flat=True))
+        self.assertEqual(self.meme.rating_count, self.USERS)
+        self.assertEqual(self.meme.rating_sum, sum(scores))
+
+
+class LoadSeedingBenchTest(TestCase):
+    # Test that seed_load creates users with tokens and skewed template and meme popularity
+    def test_seed_load(self):
+        added = seeding.seed_load(users=20, templates=10, memes=500, ratings=2000, seed=7)
+        self.assertEqual((added['users'], added['templates'], added['memes']), (20, 10, 500))
+        self.assertEqual(Rating.objects.count(), added['ratings'])
+        self.assertEqual(Token.objects.filter(user__username__startswith='load-7-').count(), 20)
+
+        per_template = sorted(Counter(Meme.objects.values_list('template_id', flat=True)).values())
+        self.assertGreater(per_template[-1], 3 * per_template[0])
+        per_meme = sorted(Counter(Rating.objects.values_list('meme_id', flat=True)).values())
+        self.assertGreater(per_meme[-1], 5 * per_meme[len(per_meme) // 2])
+
+    # Test the in-process bench command and its results file
+    def test_bench_command(self):
+        seeding.seed_load(users=5, templates=2, memes=50, ratings=100)
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        mix, output = os.path.join(directory, 'mix.jsonl'), os.path.join(directory, 'results.json')
+        with open(mix, 'w') as lines:
+            lines.write(json.dumps({'name': 'retrieve', 'path': '/api/memes/{meme}/', 'weight': 3}) + '\n')
+            lines.write(json.dumps({'name': 'rate', 'method': 'POST', 'path': '/api/memes/{meme}/rate/',
+                                    'body': {'rating': '{score}'}, 'auth': True}) + '\n')
+
+        call_command('bench', mix=mix, requests=40, concurrency=1, host='testserver', output=output, stdout=StringIO())
+        with open(output) as results:
+            report = json.load(results)
+        self.assertEqual(report['requests'], 40)
+        endpoints = {endpoint['path']: endpoint for endpoint in report['endpoints']}
+        self.assertEqual(set(endpoints), {'retrieve', 'rate'})
+        self.assertEqual(sum(endpoint['requests'] for endpoint in endpoints.values()), 40)
+        self.assertTrue(all(endpoint['errors'] == 0 for endpoint in endpoints.values()))
+
+
+# Query budget of every API endpoint on the seeded dataset, with caches cold:
+# (label, route name, URL args, method, query params or request body, maximum queries).
+# 'meme', 'template' and 'user' stand for the ids of seeded objects. SAVEPOINT/RELEASE statements
+# are not counted. Budgets are upper bounds for both backends (PostgreSQL locks and upserts
+# ratings in two statements where SQLite needs up to three).
+QUERY_BUDGETS = [
+    ('template list', 'template-list', (), 'get', {}, 1),
+    ('template create', 'template-list', (), 'post', {'name': 'Budget', 'image_url': 'https://example.com/budget.jpg'}, 1),
+    ('meme list', 'meme-list', (), 'get', {}, 2),
+    ('meme list, deep page', 'meme-list', (), 'get', {'page': 250}, 2),
+    ('meme list, cursor', 'meme-list', (), 'get', {'pagination': 'cursor'}, 1),
+    ('meme list, expanded', 'meme-list', (), 'get', {'expand': 'template,created_by', 'fields': 'id,template,created_by'}, 2),
+    ('meme create', 'meme-list', (), 'post', {'template': 'template', 'top_text': 'Budget', 'created_by': 'user'}, 3),
+    ('meme bulk create', 'meme-bulk-create', (), 'post', [{'template': 'template', 'top_text': f'Bulk {i}'} for i in range(50)], 2),
+    ('meme export', 'meme-export', (), 'get', {'type': 'csv'}, 1),
+    ('meme retrieve', 'meme-detail', ('meme',), 'get', {}, 1),
+    ('meme rate', 'meme-rate-meme', ('meme',), 'post', {'rating': 4}, 5),
+    ('meme image', 'meme-render-image', ('meme',), 'get', {}, 3),
+    ('render cache stats', 'meme-render-cache-stats', (), 'get', {}, 0),
+    ('random meme', 'meme-get-random-meme', (), 'get', {}, 3),
+    ('top memes', 'meme-get-top-rated-memes', (), 'get', {}, 1),
+    ('top memes, by count', 'meme-get-top-rated-memes', (), 'get', {'rank': 'count'}, 1),
+    ('top memes, week', 'meme-get-top-rated-memes', (), 'get', {'window': 'week', 'rank': 'bayes'}, 2),
+    ('surprise me', 'meme-surprise-me', (), 'get', {}, 3),
+    ('meme feed', 'meme-feed', (), 'get', {}, 3),
+    ('meme feed, popular', 'meme-feed', (), 'get', {'order': 'popular'}, 3),
+    ('meme search', 'meme-search', (), 'get', {'q': 'top'}, 3),
+    ('rating list', 'rating-list', (), 'get', {}, 1),
+    ('rating list, cursor', 'rating-list', (), 'get', {'pagination': 'cursor'}, 1),
+    ('rating batch', 'rating-batch', (), 'post', [{'meme': 'meme', 'rating': 2}], 7),
+    ('rating export', 'rating-export', (), 'get', {}, 1),
+    ('async template list', 'async-template-list', (), 'get', {}, 1),
+    ('async meme list', 'async-meme-list', (), 'get', {}, 2),
+    ('async meme list, cursor', 'async-meme-list', (), 'get', {'pagination': 'cursor'}, 1),
+    ('async meme retrieve', 'async-meme-detail', ('meme',), 'get', {}, 1),
+    ('async random meme', 'async-meme-random', (), 'get', {}, 3),
+    ('async top memes', 'async-meme-top', (), 'get', {}, 1),
+    ('async top memes, week', 'async-meme-top', (), 'get', {'window': 'week', 'rank': 'bayes'}, 2),
+    ('metrics', 'metrics', (), 'get', {}, 0),
+]
+
+# Queries of every QUERY_BUDGETS endpoint as last accepted, per database vendor, with literals
+# replaced by ?, lists of them by "?, ..." and server-side cursor names by _django_curs. A test over budget prints its queries as a diff against them. After an
+# intended change, rewrite the baseline of the database the tests run on with
+#   MEMES_UPDATE_QUERY_BASELINE=1 python manage.py test memes.tests.QueryBudgetTest.test_query_budgets
+QUERY_BASELINE = Path(__file__).with_name('query_baseline.json')
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    sql = re.sub(r'"_django_curs_\w+"', '"_django_curs"', SQL_LITERALS.sub('?', sql))
+    return re.sub(r'\?(?:, \?)+', '?, ...', sql)
+
+
+def load_query_baseline():
+    if not QUERY_BASELINE.exists():
+        return {}
+    return json.loads(QUERY_BASELINE.read_text()).get(connection.vendor, {})
+
+
+def save_query_baseline(queries):
+    baselines = json.loads(QUERY_BASELINE.read_text()) if QUERY_BASELINE.exists() else {}
+    baselines[connection.vendor] = queries
+    QUERY_BASELINE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+# Endpoints whose queries must not scan a whole table: {label: tables}
+NO_FULL_SCANS = {
+    'meme retrieve': ['memes_meme'],
+    'meme rate': ['memes_meme', 'memes_rating', 'memes_memeratingbucket', 'memes_memeratingwindow'],
+    'rating batch': ['memes_meme', 'memes_rating', 'memes_memeratingbucket', 'memes_memeratingwindow'],
+    'top memes': ['memes_meme', 'memes_rating'],
+    'top memes, by count': ['memes_meme', 'memes_rating'],
+    'meme feed': ['memes_rating'],
+    'meme feed, popular': ['memes_meme', 'memes_rating'],
+    'top memes, week': ['memes_meme', 'memes_rating', 'memes_memeratingbucket', 'memes_memeratingwindow'],
+    'async top memes': ['memes_meme', 'memes_rating'],
+}
+
+
+# Full scans of `table` in the plan of a captured query (PostgreSQL or SQLite)
+def full_scans(sql, table):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}')
+            return [line for line, in cursor.fetchall() if re.search(rf'Seq Scan on {table}\b', line)]
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        # SQLite: "SCAN <table>" (or "SCAN <table> AS <alias>") without USING is a full table scan
+        return [detail for *_, detail in cursor.fetchall()
+                if ' USING ' not in detail and (detail == f'SCAN {table}' or detail.startswith(f'SCAN {table} AS '))]
+
+
+# Index scans of `table` in the plan of a captured query that start at a bound on `column`
+# instead of at the first entry of the index
+def index_ranges(sql, table, column):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}')
+            plan = [line for line, in cursor.fetchall()]
+            return [cond for scan, cond in zip(plan, plan[1:])
+                    if re.search(rf'Index (Only )?Scan.* on {table}\b', scan)
+                    and re.search(rf'Index Cond: .*\b{column} [<>]', cond)]
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        # SQLite: "SEARCH <table> USING INDEX <index> (<column>>?)"
+        return [detail for *_, detail in cursor.fetchall()
+                if re.match(rf'SEARCH {table}\b.* USING (COVERING )?INDEX \w+ \({column}[<>]', detail)]
+
+
+class QueryBudgetTest(TestCase):
+    MEMES = 3000
+    RATERS = 40
+    RATINGS_PER_RATER = 150
+
+    @classmethod
+    def setUpTestData(cls):
+        seeding.seed_memes(cls.MEMES)
+        seeding.seed_ratings(cls.RATERS, cls.RATINGS_PER_RATER)
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.user, cls.template = seeding.seed_owner()
+        cls.meme = Meme.objects.order_by('pk')[cls.MEMES // 2]
+
+    def setUp(self):
+        counters.discard()
+        self.render_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.render_dir, ignore_errors=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _resolve(self, value):
+        return {'meme': self.meme.id, 'template': self.template.id, 'user': self.user.id}.get(value, value) if isinstance(value, str) else value
+
+    def _request(self, route, args, method, data):
+        url = reverse(route, args=[self._resolve(arg) for arg in args])
+        if isinstance(data, list):
+            data = [{key: self._resolve(value) for key, value in item.items()} for item in data]
+        else:
+            data = {key: self._resolve(value) for key, value in data.items()}
+        if method == 'get':
+            response = self.client.get(url, data)
+        else:
+            response = self.client.post(url, data, format='json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    # Test that no endpoint runs more queries than its budget
+    @patch('memes.assets.download', side_effect=lambda url: make_png())
+    def test_query_budgets(self, download):
+        baseline, captured_queries = load_query_baseline(), {}
+        with override_settings(MEMES_RENDER_CACHE_DIR=self.render_dir, MEMES_TEMPLATE_ASSET_DIR=self.render_dir):
+            for label, route, args, method, data, budget in QUERY_BUDGETS:
+                with self.subTest(label):
+                    cache.clear()
+                    with CaptureQueriesContext(connection) as captured:
+                        response = self._request(route, args, method, data)
+                    self.assertLess(response.status_code, 400, f'{label}: {response.status_code}')
+                    queries = [normalize_sql(q['sql']) for q in captured.captured_queries
+                               if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+                    captured_queries[label] = queries
+                    if len(queries) > budget:
+                        # The queries themselves when they are the baseline ones (the budget was lowered)
+                        diff = list(difflib.unified_diff(baseline.get(label, []), queries, 'baseline', 'captured', lineterm=''))
+                        self.fail(f'{label} ran {len(queries)} queries, budget is {budget}, '
+                                  f'{len(baseline.get(label, []))} in {QUERY_BASELINE.name}:\n' +
+                                  '\n'.join(diff or [f'{i}. {sql}' for i, sql in enumerate(queries, 1)]))
+        if os.environ.get('MEMES_UPDATE_QUERY_BASELINE'):
+            save_query_baseline(captured_queries)
+
+    # Test that the hot read and rating paths never fall back to full table scans
+    def test_no_full_table_scans(self):
+        budgets = {label: (route, args, method, data) for label, route, args, method, data, _ in QUERY_BUDGETS}
+        for label, tables in NO_FULL_SCANS.items():
+            with self.subTest(label):
+                cache.clear()
+                with CaptureQueriesContext(connection) as captured:
+                    self._request(*budgets[label])
+                for sql in [q['sql'] for q in captured.captured_queries]:
+                    if sql.startswith(('SAVEPOINT', 'RELEASE')):
+                        continue
+                    for table in tables:
+                        self.assertEqual(full_scans(sql, table), [], f'{label}: full scan of {table} in\n{sql}')
+
+    # Test that cursor pages from the middle of a list, both ways, start their index scan at the
+    # cursor instead of walking the rows before it
+    def test_deep_cursor_pages_use_index_range(self):
+        middle = {
+            'memes_meme': Meme.objects.order_by('created_at', 'id')[self.MEMES // 2],
+            'memes_rating': Rating.objects.order_by('created_at', 'id')[self.RATERS * self.RATINGS_PER_RATER // 2],
+        }
+        for route, table in [('meme-list', 'memes_meme'), ('async-meme-list', 'memes_meme'), ('rating-list', 'memes_rating')]:
+            row = middle[table]
+            for reverse in (False, True):
+                with self.subTest(route, reverse=reverse):
+                    cursor = pagination.encode_cursor((row.created_at, row.pk, reverse))
+                    with CaptureQueriesContext(connection) as captured:
+                        response = self._request(route, (), 'get', {'cursor': cursor})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(response.json()['results']), 10)
+                    page = captured.captured_queries[0]['sql']
+                    self.assertNotEqual(index_ranges(page, table, 'created_at'), [], f'{route}: no index range in\n{page}')
+
+    # Test that refills of the popular feed start their index scan at the position reached
+    def test_popular_feed_continues_with_index_range(self):
+        middle = Meme.objects.order_by('-rating_count', '-id')[self.MEMES // 2]
+        cursor = feed.encode_cursor((middle.rating_count, middle.pk))
+        with CaptureQueriesContext(connection) as captured:
+            response = self._request('meme-feed', (), 'get', {'order': 'popular', 'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        page = next(q['sql'] for q in captured.captured_queries if 'FROM "memes_meme"' in q['sql'])
+        self.assertNotEqual(index_ranges(page, 'memes_meme', 'rating_count'), [], page)
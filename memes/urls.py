@@ -2,6 +2,8 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework.authtoken.views import obtain_auth_token
 from .views import MemeViewSet, MemeTemplateViewSet, RatingViewSet
+from . import async_views
+from .metrics import metrics_view
 
 # Create a router and register our viewsets with it
 router = DefaultRouter()
@@ -10,7 +12,19 @@ router.register(r'templates', MemeTemplateViewSet, basename='template')
 router.register(r'ratings', RatingViewSet, basename='rating')
 
 
+# Async read endpoints (served on the event loop under ASGI), next to the sync API
+async_urlpatterns = [
+    path('templates/', async_views.template_list, name='async-template-list'),
+    path('memes/', async_views.meme_list, name='async-meme-list'),
+    path('memes/random/', async_views.random_meme, name='async-meme-random'),
+    path('memes/top/', async_views.top_rated_memes, name='async-meme-top'),
+    path('memes/<int:pk>/', async_views.meme_detail, name='async-meme-detail'),
+]
+
+
 urlpatterns = [
+    path('api/async/', include(async_urlpatterns)),
     path('api/', include(router.urls)),
     path('api-auth-token/', obtain_auth_token),  # Token generation
+    path('metrics', metrics_view, name='metrics'),  # Prometheus scrape endpoint
 ]
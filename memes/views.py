@@ -2,51 +2,163 @@ from rest_framework import viewsets
 from rest_framework import status
 
 from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.pagination import PageNumberPagination
-from rest_framework.authentication import TokenAuthentication
-from django.db.models import Avg
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import JSONParser
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from .models import Meme, MemeTemplate, Rating
+from .models import MAX_ID, Meme, MemeTemplate, Rating
 from .serializers import MemeSerializer, MemeTemplateSerializer, RatingSerializer
+from . import assets, bulk, caching, conditional, counters, exports, feed, fieldsets, leaderboard, pagination, ratings, rendering, sampling, search
+from .authentication import CachedTokenAuthentication
+from .parsers import NDJSONParser
 
+from functools import partial
 from random import choice
 
 
+# Parse the ?type= and ?since= parameters of an export request, returning (fmt, since, error)
+def export_params(request):
+    fmt = request.query_params.get('type', 'ndjson')
+    if fmt not in exports.CONTENT_TYPES:
+        return None, None, f"type must be one of {', '.join(exports.CONTENT_TYPES)}"
+
+    since = request.query_params.get('since')
+    if since is None:
+        return fmt, None, None
+    try:
+        parsed = parse_datetime(since)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        return None, None, "since must be an ISO 8601 datetime"
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return fmt, parsed, None
+
+
+# Random meme picker for ?weighted= (uniform by default), returning (picker, error)
+def random_picker(request):
+    weighted = request.query_params.get('weighted')
+    if weighted is None:
+        return sampling.random_meme, None
+    if weighted == 'rating':
+        return sampling.weighted_random_meme, None
+    return None, "weighted must be rating"
+
+
+# Body of GET /api/memes/top/ for the top rated memes
+def top_rated_payload(top_memes):
+    # Check if we have fewer than 10 memes
+    if len(top_memes) < 10:
+        return {
+            'message': f'There are only {len(top_memes)} memes available.',
+            'data': MemeSerializer(top_memes, many=True).data
+        }
+
+    return MemeSerializer(top_memes, many=True).data
+
+
+# Queryset of the meme list (sync and async views): in pk order, so page-number pages are the
+# same on every database, and narrowed to `fields` and `expand` plus the updated_at of the page
+# ETag and `extra` fields the caller reads
+def meme_list_queryset(fields, expand, extra=()):
+    return fieldsets.apply(Meme.objects.order_by('pk'), fields, expand, ('updated_at', *extra))
+
+
+# ETag and Last-Modified of a representation of `memes`, from their updated_at. Expanded
+# templates are covered by `template_version`, the template cache version (None when not
+# expanded); authors have no modification time, so representations that inline them get no
+# validators. Takes a DRF or a plain Django (async view) request.
+def meme_validators(request, expand, memes, template_version=None, *parts):
+    if 'created_by' in expand:
+        return None, None
+    if template_version is not None:
+        parts += (template_version,)
+    fmt = request.accepted_renderer.format if hasattr(request, 'accepted_renderer') else 'json'
+    etag = conditional.make_etag([(meme.pk, meme.updated_at) for meme in memes], request.get_full_path(), fmt, *parts)
+    last_modified = max(meme.updated_at for meme in memes) if memes and not expand else None
+    return etag, last_modified
+
+
 class MemeTemplateViewSet(viewsets.ModelViewSet):
     queryset = MemeTemplate.objects.all()
     serializer_class = MemeTemplateSerializer
 
-    # GET /api/templates/ - List all meme templates
+    # GET /api/templates/ - List all meme templates (pre-rendered, cached until templates change)
+    # Conditional requests are answered from the cache version alone, without a query
     def list(self, request):
-        queryset = self.get_queryset()
-        serializer = MemeTemplateSerializer(queryset, many=True)
-        return Response(serializer.data)
+        etag, last_modified = conditional.version_validators(
+            caching.get_version(caching.TEMPLATES), 'templates', request.accepted_renderer.format)
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        body = caching.cached_json(
+            caching.TEMPLATES, 'list',
+            lambda: MemeTemplateSerializer(self.get_queryset(), many=True).data,
+        )
+        return conditional.set_validators(caching.PrerenderedResponse(body), etag, last_modified)
     
     
     # POST /api/templates/ - Create a new meme template
     def create(self, request):
         serializer = MemeTemplateSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            template = serializer.save()
+            # Fetch and store the template image once, after the template row is committed
+            transaction.on_commit(partial(assets.ingest_template_quietly, template.pk))
             return Response(serializer.data, status.HTTP_201_CREATED)
         return Response(serializer.errors,status.HTTP_400_BAD_REQUEST)
+
+
+    # PUT/PATCH /api/templates/<id>/ - A new image_url drops the stored image (renders are keyed
+    # by its checksum) and the new one is fetched after the change is committed
+    def perform_update(self, serializer):
+        image_url = serializer.validated_data.get('image_url', serializer.instance.image_url)
+        if image_url == serializer.instance.image_url:
+            serializer.save()
+            return
+        template = serializer.save(image_checksum='', image_width=None, image_height=None)
+        transaction.on_commit(partial(assets.ingest_template_quietly, template.pk))
     
     
 class MemeViewSet(viewsets.ModelViewSet):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     queryset = Meme.objects.all()
     serializer_class = MemeSerializer
     pagination_class = PageNumberPagination  # This will handle pagination
 
     # GET /api/memes/ - List all memes (with pagination)
+    # GET /api/memes/?pagination=cursor - Keyset pagination on (created_at, id), no total count
+    # ?fields=id,top_text,... returns only these fields, ?expand=template,created_by inlines them
     def list(self, request):
-        queryset = self.get_queryset()
+        try:
+            fields, expand = fieldsets.parse(request.query_params)
+        except fieldsets.FieldsetError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        extra = ()
+        if pagination.wants_cursor(request):
+            self.pagination_class = pagination.CreatedAtCursorPagination
+            extra = self.pagination_class.ordering  # Read from the last row to build the cursors
+        queryset = meme_list_queryset(fields, expand, extra)
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = MemeSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = MemeSerializer(queryset, many=True)
+            # Pages only get an ETag: Last-Modified cannot reflect memes removed from the page
+            count = self.paginator.page.paginator.count if isinstance(self.paginator, PageNumberPagination) else None
+            etag, _ = meme_validators(request, expand, page, self._template_version(expand), count)
+            response = conditional.not_modified(request, etag)
+            if response is not None:
+                return response
+            serializer = MemeSerializer(page, many=True, fields=fields, expand=expand)
+            return conditional.set_validators(self.get_paginated_response(serializer.data), etag)
+        serializer = MemeSerializer(queryset, many=True, fields=fields, expand=expand)
         return Response(serializer.data)
 
 
@@ -59,17 +171,63 @@ class MemeViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     
-    # GET /api/memes/<id>/ - Retrieve a specific meme
+    # POST /api/memes/bulk/ - Create many memes from a JSON array or an NDJSON body
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[JSONParser, NDJSONParser])
+    def bulk_create(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"error": "Expected a list of memes"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.MEMES_BULK_MAX_ITEMS:
+            return Response({"error": f"At most {settings.MEMES_BULK_MAX_ITEMS} memes per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = bulk.create_memes(items, request.user)
+        created = sum(1 for result in results if 'id' in result)
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, status=status.HTTP_201_CREATED if created or not results else status.HTTP_400_BAD_REQUEST)
+    
+    
+    # GET /api/memes/export/ - Stream every meme as NDJSON or CSV (?type=ndjson|csv&since=<ISO datetime>)
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request):
+        fmt, since, error = export_params(request)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        return exports.export_response(Meme.objects.all(), exports.MEME_FIELDS, fmt, 'memes', since)
+    
+    
+    # GET /api/memes/<id>/ - Retrieve a specific meme (accepts ?fields= and ?expand= like the list)
     def retrieve(self, request, pk=None):
-        meme = self.get_object()
-        serializer = MemeSerializer(meme)
-        return Response(serializer.data)
+        try:
+            fields, expand = fieldsets.parse(request.query_params)
+        except fieldsets.FieldsetError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        meme = get_object_or_404(fieldsets.apply(self.get_queryset(), fields, expand, ('updated_at',)), pk=pk)
+        counters.record_view(meme.pk)
+        etag, last_modified = meme_validators(request, expand, [meme], self._template_version(expand))
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        serializer = MemeSerializer(meme, fields=fields, expand=expand)
+        return conditional.set_validators(Response(serializer.data), etag, last_modified)
+
+    # Expanded templates are covered by the template cache version
+    def _template_version(self, expand):
+        return caching.get_version(caching.TEMPLATES) if 'template' in expand else None
     
     
     # POST /api/memes/<id>/rate/: Rate a meme
-    @action(detail=True, methods=['post'], url_path='rate')
+    @action(detail=True, methods=['post'], url_path='rate', permission_classes=[IsAuthenticated])
     def rate_meme(self, request, pk=None):
-        meme = self.get_object()
+        try:
+            meme_id = int(pk)
+        except ValueError:
+            raise Http404
+        if not (1 <= meme_id <= MAX_ID):
+            raise Http404
         rating = request.data.get('rating')
         
         try:
@@ -80,50 +238,128 @@ class MemeViewSet(viewsets.ModelViewSet):
         if not (1 <= rating <= 5):
             return Response({"error": "Rating must be between 1 and 5"}, status=status.HTTP_400_BAD_REQUEST)
 
-        user_rating = meme.ratings.filter(user=request.user)
-        if user_rating.exists():
-            user_rating.update(score=rating)
-        else:
-            meme.ratings.create(user=request.user, score=rating)
+        # Upsert the rating and update the meme's stored aggregates in one transaction,
+        # without loading the meme first
+        try:
+            ratings.rate_meme(meme_id, request.user, rating)
+        except Meme.DoesNotExist:
+            raise Http404
         
         return Response({
                     'status': 'rated successfully',
-                    'meme_id': meme.id,
+                    'meme_id': meme_id,
                     'rating': rating
             }, status=status.HTTP_200_OK)
     
     
-    # GET /api/memes/random/ - Get a random meme
+    # GET /api/memes/<id>/image/ - Render the meme as an image (?width=<px>&type=png|jpeg|webp)
+    @action(detail=True, methods=['get'], url_path='image')
+    def render_image(self, request, pk=None):
+        meme = self.get_object()
+        fmt = request.query_params.get('type', 'png')
+        if fmt not in rendering.FORMATS:
+            return Response({"error": f"type must be one of {', '.join(rendering.FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        width = request.query_params.get('width')
+        try:
+            width = int(width) if width else None
+        except ValueError:
+            return Response({"error": "Invalid width format"}, status=status.HTTP_400_BAD_REQUEST)
+        if width is not None and not (1 <= width <= rendering.MAX_WIDTH):
+            return Response({"error": f"Width must be between 1 and {rendering.MAX_WIDTH}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            path, content_type, hit = rendering.rendered_meme_path(meme, width, fmt)
+        except rendering.RenderError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_502_BAD_GATEWAY)
+
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['X-Render-Cache'] = 'hit' if hit else 'miss'
+        return response
+
+
+    # GET /api/memes/render-cache/ - Hit/miss counters and size of the render cache
+    @action(detail=False, methods=['get'], url_path='render-cache')
+    def render_cache_stats(self, request):
+        return Response(rendering.get_render_cache().stats())
+    
+    
+    # GET /api/memes/random/ - Get a random meme (?weighted=rating favors well rated memes)
     @action(detail=False, methods=['get'], url_path='random')
     def get_random_meme(self, request):
-        random_meme = Meme.objects.order_by('?').first()  # Random meme
+        picker, error = random_picker(request)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        random_meme = picker()  # Random meme (primary key probe, no table sort)
         if random_meme:
+            counters.record_view(random_meme.pk)
             serializer = MemeSerializer(random_meme)
             return Response(serializer.data)
         return Response({"error": "No memes found"}, status=status.HTTP_404_NOT_FOUND)
 
 
-    # GET /api/memes/top/ - Get top 10 rated memes
+    # GET /api/memes/top/ - Get top 10 rated memes (pre-rendered, cached until ratings change)
+    # ?window=day|week|all limits the ratings counted, ?rank=bayes|avg|count picks the order
     @action(detail=False, methods=['get'], url_path='top')
     def get_top_rated_memes(self, request):
-        # Calculate the average rating for each meme
-        top_memes = Meme.objects.annotate(avg_rating=Avg('ratings__score')).filter(avg_rating__isnull=False).order_by('-avg_rating')[:10]
-        
-        # Check if we have fewer than 10 memes
-        if top_memes.count() < 10:
-            return Response({
-                'message': f'There are only {top_memes.count()} memes available.',
-                'data': MemeSerializer(top_memes, many=True).data
-            }, status=status.HTTP_200_OK)
-            
-        serializer = MemeSerializer(top_memes, many=True)
-        return Response(serializer.data)
+        try:
+            window, rank = leaderboard.parse(request.query_params)
+        except leaderboard.LeaderboardError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        body = caching.cached_json(caching.LEADERBOARD, leaderboard.cache_key(window, rank),
+                                   lambda: top_rated_payload(leaderboard.top_memes(window, rank)),
+                                   timeout=caching.leaderboard_timeout())
+        return caching.PrerenderedResponse(body)
+    
+    # GET /api/memes/feed/ - Memes the current user has not rated yet, newest first (or most
+    # rated first with ?order=popular), paged by ?cursor= with up to ?page_size= memes
+    @action(detail=False, methods=['get'], url_path='feed', permission_classes=[IsAuthenticated])
+    def feed(self, request):
+        order = request.query_params.get('order', 'new')
+        if order not in feed.ORDERS:
+            return Response({"error": f"order must be one of {', '.join(feed.ORDERS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page_size = int(request.query_params.get('page_size', feed.PAGE_SIZE))
+        except ValueError:
+            page_size = 0
+        if not 1 <= page_size <= feed.MAX_PAGE_SIZE:
+            return Response({"error": f"page_size must be between 1 and {feed.MAX_PAGE_SIZE}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        position = None
+        if 'cursor' in request.query_params:
+            try:
+                position = feed.decode_cursor(order, request.query_params['cursor'])
+            except feed.FeedError as exc:
+                return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        memes, position = feed.feed_page(request.user, order, position, page_size)
+        next_url = None
+        if position is not None:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', feed.encode_cursor(position))
+        return Response({'next': next_url, 'results': MemeSerializer(memes, many=True).data})
+    
+    # GET /api/memes/search/?q= - Memes whose captions match q, best match first
+    # ?template= keeps the memes of one template, ?page= and ?page_size= page the results
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        try:
+            q, template, page, page_size = search.parse(request.query_params)
+        except search.SearchError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        memes, more = search.search_memes(q, template, page, page_size)
+        next_url = replace_query_param(request.build_absolute_uri(), 'page', page + 1) if more else None
+        return Response({'next': next_url, 'results': MemeSerializer(memes, many=True).data})
     
     ## Bonus endpoint
-     # GET /api/memes/surprise-me/ - Get a random meme with random funny text
+     # GET /api/memes/surprise-me/ - Get a random meme with random funny text (?weighted=rating too)
     @action(detail=False, methods=['get'], url_path='surprise-me')
     def surprise_me(self, request):
-        random_meme = Meme.objects.order_by('?').first()  # Get a random meme
+        picker, error = random_picker(request)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        random_meme = picker()  # Get a random meme
         funny_phrases = [
             "Keep calm and let Django handle the rest.",
             "Python: I speak your language, but Django makes me fluent.",
@@ -138,6 +374,7 @@ class MemeViewSet(viewsets.ModelViewSet):
         ]
 
         if random_meme:
+            counters.record_view(random_meme.pk)
             serializer = MemeSerializer(random_meme)
             return Response({
                 'meme': serializer.data,
@@ -148,12 +385,51 @@ class MemeViewSet(viewsets.ModelViewSet):
 
 ### This class was not require - juts implement it for debugging to check the ratings.
 class RatingViewSet(viewsets.ViewSet):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     serializer_class = RatingSerializer
     queryset = Rating.objects.all()
 
     # GET /api/ratings/ - List all ratings
+    # GET /api/ratings/?pagination=cursor - Keyset pagination on (created_at, id), no total count
     def list(self, request):
         ratings = Rating.objects.all()
+        if pagination.wants_cursor(request):
+            paginator = pagination.CreatedAtCursorPagination()
+            page = paginator.paginate_queryset(ratings, request, view=self)
+            return paginator.get_paginated_response(RatingSerializer(page, many=True).data)
         serializer = RatingSerializer(ratings, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+    # GET /api/ratings/export/ - Stream every rating as NDJSON or CSV (?type=ndjson|csv&since=<ISO datetime>)
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request):
+        fmt, since, error = export_params(request)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        return exports.export_response(Rating.objects.all(), exports.RATING_FIELDS, fmt, 'ratings', since)
+
+
+    # POST /api/ratings/batch/ - Rate many memes at once: [{"meme": <id>, "rating": 1-5}, ...]
+    @action(detail=False, methods=['post'], url_path='batch', permission_classes=[IsAuthenticated],
+            parser_classes=[JSONParser, NDJSONParser])
+    def batch(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"error": "Expected a list of ratings"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.MEMES_BULK_MAX_ITEMS:
+            return Response({"error": f"At most {settings.MEMES_BULK_MAX_ITEMS} ratings per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results = ratings.rate_batch(request.user, items)
+        except Meme.DoesNotExist:
+            # A meme was deleted while the batch was being written; nothing was saved
+            return Response({"error": "Some memes were deleted during the request, please retry"},
+                            status=status.HTTP_409_CONFLICT)
+        rated = sum(1 for result in results if 'rating' in result)
+        return Response({
+            'rated': rated,
+            'failed': sum(1 for result in results if 'errors' in result),
+            'results': results,
+        }, status=status.HTTP_200_OK if rated or not results else status.HTTP_400_BAD_REQUEST)